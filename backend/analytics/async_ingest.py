@@ -0,0 +1,101 @@
+"""Micro-batching for the async /track/async/ endpoint.
+
+Requests waiting on an ASGI event loop hand their validated events to the loop's
+EventBatcher and await a future. The batcher stores everything that arrived within
+TRACK_ASYNC_FLUSH_MS (or TRACK_ASYNC_BATCH_SIZE events) with a single store_events call
+in Django's sync thread, so thousands of open beacons cost one bulk insert (or one queue
+append) per flush instead of a worker each. On shutdown (the ASGI lifespan protocol, see
+`lifespan`), the batch still waiting is stored and the running stores are awaited.
+"""
+import asyncio
+import logging
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .ingest import store_events
+
+logger = logging.getLogger(__name__)
+
+class EventBatcher:
+    def __init__(self):
+        self.pending = []  # [(events, future)]
+        self.size = 0
+        self.timer = None
+        self.tasks = set()  # running stores: the event loop only keeps weak references to tasks
+
+    async def submit(self, events):
+        """Wait until `events` are stored; returns True when they were queued (see store_events)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((events, future))
+        self.size += len(events)
+        if self.size >= settings.TRACK_ASYNC_BATCH_SIZE:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(settings.TRACK_ASYNC_FLUSH_MS / 1000, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.size = self.pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._store(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self._stored)
+
+    def _stored(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("storing a batch of async events failed", exc_info=task.exception())
+
+    async def aclose(self):
+        """Store what is still waiting and wait for every running store."""
+        self.flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _store(self, batch):
+        try:
+            queued = await sync_to_async(store_events)([e for events, _ in batch for e in events])
+        except Exception as e:
+            # every request of the batch fails the same way (e.g. QueueFull -> 503)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise  # logged by _stored
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(queued)
+
+
+_batchers = weakref.WeakKeyDictionary()  # event loop -> EventBatcher
+
+
+async def submit(events):
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = EventBatcher()
+    return await batcher.submit(events)
+
+
+async def shutdown():
+    batcher = _batchers.get(asyncio.get_running_loop())
+    if batcher is not None:
+        await batcher.aclose()
+
+
+async def lifespan(receive, send):
+    """ASGI lifespan protocol (Django's handler only speaks HTTP): flushes the batcher on shutdown."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,125 @@
+"""Benchmarks for ingest and the dashboard endpoints (`manage.py benchmark`).
+
+Each scale is seeded with seed_event into a throwaway test database; every case is then
+timed over `repeat` calls (p50/p95/p99, throughput), and run once more under
+CaptureQueriesContext for the query count and once under tracemalloc for peak memory,
+so neither instrumentation skews the timings.
+"""
+import math
+import time
+import tracemalloc
+import uuid
+
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+ANALYTICS_CASES = {
+    "kpis": "/api/analytics/kpis/{site}/?days=30",
+    "kpis_compare": "/api/analytics/kpis/{site}/?days=30&compare=1",
+    "kpis_segment": "/api/analytics/kpis/{site}/?days=30&services=google,twitter&posts=/blog/",
+    "page_views": "/api/analytics/pages/{site}/?days=30",
+    "sessions_metrics": "/api/analytics/sessions/{site}/?days=30",
+    "new_vs_returning": "/api/analytics/new-vs-returning/{site}/?days=30",
+    "sources": "/api/analytics/sources/{site}/?days=30",
+    "devices": "/api/analytics/devices/{site}/?days=30",
+    "browsers": "/api/analytics/browsers/{site}/?days=30",
+    "geography": "/api/analytics/geography/{site}/?days=30",
+    "dashboard": "/api/analytics/dashboard/{site}/?days=30",
+}
+# metrics compared against a baseline; lower is better for all of them
+COMPARED = ("p95_ms", "queries", "peak_kb")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(latencies, queries, peak_bytes):
+    total = sum(latencies)
+    return {
+        "n": len(latencies),
+        "mean_ms": round(total / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_per_s": round(len(latencies) / total, 1) if total else None,
+        "queries": queries,
+        "peak_kb": round(peak_bytes / 1024, 1),
+    }
+
+
+def measure(call, repeat, warmup=2):
+    for _ in range(warmup):
+        call()
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+    reset_queries()  # the log is a bounded deque; seeding alone can fill it
+    with CaptureQueriesContext(connection) as ctx:
+        call()
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return summarize(latencies, len(ctx.captured_queries), peak)
+
+
+def track_payload(site_id):
+    return {
+        "site_id": site_id,
+        "url": "/bench",
+        "session_id": uuid.uuid4().hex,
+        "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Safari/537.36",
+        "referrer": "https://google.com",
+        "timestamp": timezone.now().isoformat(),
+    }
+
+
+def run_cases(client, site_id, repeat, cases=None):
+    """{case: summary} for /track/ ingest and the analytics views, using an authenticated client."""
+    results = {}
+
+    def track():
+        res = client.post("/track/", track_payload(site_id), format="json")
+        assert res.status_code in (201, 202), res.status_code
+
+    results["track_event"] = measure(track, repeat)
+    for name, url in ANALYTICS_CASES.items():
+        if cases and name not in cases:
+            continue
+        path = url.format(site=site_id)
+
+        def get():
+            res = client.get(path)
+            assert res.status_code == 200, (path, res.status_code)
+
+        results[name] = measure(get, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Regressions of `results` against `baseline` ({scale: {case: summary}}): a list of
+    (scale, case, metric, baseline value, current value) where current > baseline * (1 + threshold).
+    Query counts regress on any increase.
+    """
+    regressions = []
+    for scale, cases in results.items():
+        for case, summary in cases.items():
+            before = baseline.get(scale, {}).get(case)
+            if not before:
+                continue
+            for metric in COMPARED:
+                old, new = before.get(metric), summary.get(metric)
+                if old is None or new is None:
+                    continue
+                limit = old if metric == "queries" else old * (1 + threshold)
+                if new > limit:
+                    regressions.append((scale, case, metric, old, new))
+    return regressions
@@ -0,0 +1,196 @@
+"""Small in-process caches for the ingest and dashboard hot paths."""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+
+from .response_cache import generation
+
+_MISSING = object()
+
+
+class TTLLRUCache:
+    """Thread-safe LRU map with a per-entry TTL. Bounded to `max_entries` items."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """Set `key` unless it holds a live entry; True when it was added. Atomic."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and item[1] >= now:
+                return False
+            self._data[key] = (value, now + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# normalized site_id -> Site pk, or None for ids known not to exist
+site_cache = TTLLRUCache(settings.SITE_CACHE_MAX_ENTRIES, settings.SITE_CACHE_TTL)
+
+
+def normalize_site_id(site_id):
+    return str(site_id or "").strip().lower()
+
+
+def _iexact(keys):
+    # rows saved before Site.save lowercased site_ids (or written by bulk/update queries)
+    # may have other casing; only keys the indexed exact match missed get this slower lookup
+    cond = Q()
+    for key in keys:
+        cond |= Q(site_id__iexact=key)
+    return cond
+
+
+def resolve_site_pk(site_id):
+    """Return the pk of the Site for `site_id`, or None. Warm lookups don't touch the database."""
+    from .models import Site
+
+    key = normalize_site_id(site_id)
+    if not key:
+        return None
+    pk = site_cache.get(key, _MISSING)
+    if pk is not _MISSING:
+        return pk
+    # site_ids are stored lowercased, so an exact match can use the unique index
+    pk = Site.objects.filter(site_id=key).values_list("pk", flat=True).first()
+    if pk is None:
+        pk = Site.objects.filter(_iexact([key])).values_list("pk", flat=True).first()
+    # unknown ids are cached for a shorter time so a site created by another worker shows up soon
+    site_cache.set(key, pk, ttl=None if pk is not None else settings.SITE_CACHE_NEGATIVE_TTL)
+    return pk
+
+
+def resolve_site_pks(site_ids):
+    """Batch variant of resolve_site_pk: {normalized site_id: pk or None} with one query for the misses."""
+    from .models import Site
+
+    keys = {normalize_site_id(s) for s in site_ids} - {""}
+    resolved = {}
+    misses = set()
+    for key in keys:
+        pk = site_cache.get(key, _MISSING)
+        if pk is _MISSING:
+            misses.add(key)
+        else:
+            resolved[key] = pk
+    if misses:
+        found = dict(Site.objects.filter(site_id__in=misses).values_list("site_id", "pk"))
+        rest = misses - found.keys()
+        if rest:
+            found.update((normalize_site_id(s), pk) for s, pk in Site.objects.filter(_iexact(rest)).values_list("site_id", "pk"))
+        for key in misses:
+            pk = found.get(key)
+            site_cache.set(key, pk, ttl=None if pk is not None else settings.SITE_CACHE_NEGATIVE_TTL)
+            resolved[key] = pk
+    return resolved
+
+
+async def aresolve_site_pks(site_ids):
+    """resolve_site_pks for async views; cache hits never leave the event loop."""
+    from .models import Site
+
+    keys = {normalize_site_id(s) for s in site_ids} - {""}
+    resolved = {}
+    misses = set()
+    for key in keys:
+        pk = site_cache.get(key, _MISSING)
+        if pk is _MISSING:
+            misses.add(key)
+        else:
+            resolved[key] = pk
+    if misses:
+        found = {site_id: pk async for site_id, pk in Site.objects.filter(site_id__in=misses).values_list("site_id", "pk")}
+        rest = misses - found.keys()
+        if rest:
+            found.update({normalize_site_id(s): pk async for s, pk in Site.objects.filter(_iexact(rest)).values_list("site_id", "pk")})
+        for key in misses:
+            pk = found.get(key)
+            site_cache.set(key, pk, ttl=None if pk is not None else settings.SITE_CACHE_NEGATIVE_TTL)
+            resolved[key] = pk
+    return resolved
+
+
+def invalidate_site(site_id):
+    site_cache.delete(normalize_site_id(site_id))
+    owned_site_cache.delete(normalize_site_id(site_id))
+
+
+# Dashboard reads: verified access token -> validated token, str(user pk) -> User, and
+# site_id -> (Site, its response cache generation); ownership is checked against owner_id.
+# Entries live for AUTH_CACHE_TTL seconds; signals drop a user or site entry when it changes
+# in this process, and a Site whose generation moved on is read again (see site_for_owner).
+token_cache = TTLLRUCache(settings.AUTH_CACHE_MAX_ENTRIES, settings.AUTH_CACHE_TTL)
+user_cache = TTLLRUCache(settings.AUTH_CACHE_MAX_ENTRIES, settings.AUTH_CACHE_TTL)
+owned_site_cache = TTLLRUCache(settings.AUTH_CACHE_MAX_ENTRIES, settings.AUTH_CACHE_TTL)
+
+
+def site_for_owner(user, site_id):
+    """The Site `site_id` if `user` owns it, else None. Warm lookups don't touch the database."""
+    from .models import Site
+
+    key = normalize_site_id(site_id)
+    cached = owned_site_cache.get(key)
+    if cached is not None:
+        site, token = cached
+        # purged_before, timezone and retention_days also change in other processes (purge_events,
+        # partition expiry, other workers); every Site save bumps the generation, which those
+        # see when the analytics cache is shared (ANALYTICS_CACHE_BACKEND=file)
+        current = generation(site.pk)
+        if current != token:
+            site = Site.objects.filter(pk=site.pk).first()
+            if site is None:
+                owned_site_cache.delete(key)
+                return None
+            owned_site_cache.set(key, (site, current))
+    else:
+        # only existing sites are cached; a miss for an unknown id stays a single indexed query
+        site = Site.objects.filter(site_id=key).first() or Site.objects.filter(_iexact([key])).first()
+        if site is None:
+            return None
+        owned_site_cache.set(key, (site, generation(site.pk)))
+    return site if site.owner_id == user.pk else None
+
+
+def invalidate_user(user_pk):
+    user_cache.delete(str(user_pk))
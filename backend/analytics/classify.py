@@ -0,0 +1,86 @@
+"""Classification helpers shared by ingest, the rollup job and the backfill command."""
+import re
+from functools import lru_cache
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+SOURCE_MAX_LENGTH = 255
+
+
+def device_class(user_agent):
+    # naive device classification by user_agent string
+    ua = (user_agent or "").lower()
+    if "mobile" in ua and "tablet" not in ua:
+        return "mobile"
+    if "tablet" in ua or "ipad" in ua:
+        return "tablet"
+    if "bot" in ua or "spider" in ua or "crawl" in ua:
+        return "bot"
+    if ua:
+        return "desktop"
+    return "unknown"
+
+
+def browser_family(user_agent):
+    # naive browser family extraction
+    ua_low = (user_agent or "").lower()
+    if "chrome" in ua_low and "edg" not in ua_low and "chromium" not in ua_low:
+        return "Chrome"
+    if "firefox" in ua_low:
+        return "Firefox"
+    if "safari" in ua_low and "chrome" not in ua_low:
+        return "Safari"
+    if "edg" in ua_low or "edge" in ua_low:
+        return "Edge"
+    if "opr" in ua_low or "opera" in ua_low:
+        return "Opera"
+    return "other"
+
+
+def os_family(user_agent):
+    ua = (user_agent or "").lower()
+    if not ua:
+        return "unknown"
+    if "windows" in ua:
+        return "Windows"
+    if "android" in ua:
+        return "Android"
+    if "iphone" in ua or "ipad" in ua or "ipod" in ua:
+        return "iOS"
+    if "mac os x" in ua or "macintosh" in ua:
+        return "macOS"
+    if "cros" in ua:
+        return "ChromeOS"
+    if "linux" in ua:
+        return "Linux"
+    return "other"
+
+
+# the number of distinct UA strings is small, so classify each one once per process
+@lru_cache(maxsize=settings.UA_CLASSIFIER_CACHE_SIZE)
+def classify_user_agent(user_agent):
+    """(device, browser, os) for a raw user agent string."""
+    return device_class(user_agent), browser_family(user_agent), os_family(user_agent)
+
+
+# crawlers, link previews, monitors, headless browsers and HTTP libraries (TRACK_BOT_PATTERN)
+BOT_RE = re.compile(settings.TRACK_BOT_PATTERN, re.IGNORECASE)
+
+
+@lru_cache(maxsize=settings.UA_CLASSIFIER_CACHE_SIZE)
+def is_bot(user_agent):
+    """True for user agents ingest drops as automated traffic (a missing UA is not one)."""
+    return bool(user_agent) and BOT_RE.search(user_agent) is not None
+
+
+def source_key(utm_source, referrer):
+    # use utm_source if present else derive from referrer host (both lowercased)
+    if utm_source:
+        return utm_source.lower()[:SOURCE_MAX_LENGTH]
+    if referrer:
+        try:
+            return urlparse(referrer).netloc.lower()[:SOURCE_MAX_LENGTH] or "direct"
+        except Exception:
+            return "referral"
+    return "direct"
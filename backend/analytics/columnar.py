@@ -0,0 +1,224 @@
+"""Optional columnar copy of closed days for long-window aggregations.
+
+`manage.py compact_events` writes one compressed .npz file per site and day under
+COLUMNAR_PATH with dictionary-encoded url, country, source and session columns
+(`<col>_dict` holds the distinct values, `<col>_codes` one int32 index per event).
+Counting is then np.bincount over the codes, and segment filters are evaluated once
+against the dictionary instead of once per row. Days after the compaction watermark
+(always including today) are read through the ORM, as the rollups do.
+
+Needs numpy and COLUMNAR_ENABLED=true; the views use it only for windows of at least
+COLUMNAR_MIN_DAYS days.
+"""
+import os
+import shutil
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Event, RollupState
+from .rollups import BREAKDOWN_DEFAULTS, _ranges_q, day_start, raw_counts, split_window_at
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+STATE_NAME = "columnar"
+DIMENSIONS = ("url", "country", "source")
+
+
+def enabled():
+    return settings.COLUMNAR_ENABLED and np is not None
+
+
+def use_for(since, until=None, site=None):
+    """Whether a window is long enough to be worth reading from the columnar files.
+    Windows reaching back past a site's purge horizon stay on the rollups, which keep the
+    downsampled days (purge_events removes their day files with the raw events).
+    """
+    if site is not None and site.purged_before is not None and since < site.purged_before:
+        return False
+    return enabled() and ((until or timezone.now()) - since) >= timedelta(days=settings.COLUMNAR_MIN_DAYS)
+
+
+def day_path(site_pk, day):
+    return os.path.join(settings.COLUMNAR_PATH, str(site_pk), f"{day.isoformat()}.npz")
+
+
+def remove_site_files(site_pk):
+    shutil.rmtree(os.path.join(settings.COLUMNAR_PATH, str(site_pk)), ignore_errors=True)
+
+
+def _encode(values):
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return dictionary, codes.astype(np.int32)
+
+
+def compact_day(site_pk, day):
+    """(Re)write the file for one site and day; returns the number of events in it."""
+    rows = list(
+        Event.objects.filter(site_id=site_pk, timestamp__gte=day_start(day), timestamp__lt=day_start(day + timedelta(days=1)))
+        .values_list("url", "country", "source", "session_id")
+        .iterator()
+    )
+    path = day_path(site_pk, day)
+    if not rows:
+        if os.path.exists(path):
+            os.remove(path)
+        return 0
+    url, country, source, session = zip(*rows)
+    columns = {
+        "url": url,
+        "country": [c or BREAKDOWN_DEFAULTS["country"] for c in country],
+        "source": [s or BREAKDOWN_DEFAULTS["source"] for s in source],
+        "session": session,
+    }
+    arrays = {}
+    for name, values in columns.items():
+        arrays[f"{name}_dict"], arrays[f"{name}_codes"] = _encode(values)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, path)  # readers never see a half-written file
+    return len(rows)
+
+
+def run_compaction(rebuild=False):
+    """Compact the closed (site, day) pairs touched by events past the watermark, plus every
+    day that closed since the previous run. Returns the number of files written.
+    """
+    if np is None:
+        raise RuntimeError("columnar compaction needs numpy")
+    state, _ = RollupState.objects.get_or_create(name=STATE_NAME)
+    today = day_start(timezone.localdate())
+    max_id = Event.objects.aggregate(m=Max("id"))["m"] or 0
+    if rebuild:
+        shutil.rmtree(settings.COLUMNAR_PATH, ignore_errors=True)
+        low, closed_since = 0, None
+    else:
+        low = max(state.last_event_id - settings.ROLLUP_WATERMARK_OVERLAP, 0)
+        closed_since = state.covered_until
+
+    touched = Event.objects.filter(id__gt=low, id__lte=max_id)
+    if closed_since is not None:
+        touched = Event.objects.filter(Q(id__gt=low, id__lte=max_id) | Q(timestamp__gte=closed_since))
+    pairs = sorted(set(
+        touched.filter(timestamp__lt=today).annotate(day=TruncDate("timestamp")).values_list("site_id", "day").distinct()
+    ))
+    for site_pk, day in pairs:
+        compact_day(site_pk, day)
+
+    state.last_event_id = max_id
+    state.covered_until = today
+    state.save()
+    return len(pairs)
+
+
+def coverage():
+    state = RollupState.objects.filter(name=STATE_NAME).first()
+    return state.covered_until if state else None
+
+
+def _segment_q(services, prefixes):
+    cond = Q()
+    if services:
+        cond &= Q(source__in=services)
+    if prefixes:
+        any_prefix = Q()
+        for prefix in prefixes:
+            any_prefix |= Q(url__startswith=prefix)
+        cond &= any_prefix
+    return cond
+
+
+def _segment_mask(data, services, prefixes):
+    """Row mask for the segment filters, evaluated on the (small) dictionaries."""
+    mask = None
+    if services:
+        mask = np.isin(data["source_codes"], np.flatnonzero(np.isin(data["source_dict"], services)))
+    if prefixes:
+        matching = np.zeros(len(data["url_dict"]), dtype=bool)
+        for prefix in prefixes:
+            matching |= np.char.startswith(data["url_dict"], prefix)
+        url_mask = matching[data["url_codes"]]
+        mask = url_mask if mask is None else mask & url_mask
+    return mask
+
+
+def _window(site, since, until, services=(), prefixes=()):
+    """(loaded day files, raw Event queryset for the rest of the window)."""
+    days, ranges = split_window_at(since, until, coverage())
+    files = []
+    if days:
+        day = days[0]
+        while day < days[1]:
+            path = day_path(site.pk, day)
+            if os.path.exists(path):
+                with np.load(path) as npz:
+                    files.append((day, {name: npz[name] for name in npz.files}))
+            day += timedelta(days=1)
+    in_window = _ranges_q(ranges)
+    if until is not None:
+        in_window |= Q(timestamp=until)  # the views' windows include `until` (timestamp__lte)
+    raw = Event.objects.filter(site=site).filter(in_window).filter(_segment_q(services, prefixes))
+    return files, raw
+
+
+def _counts(data, column, mask):
+    codes = data[f"{column}_codes"]
+    if mask is not None:
+        codes = codes[mask]
+    counts = np.bincount(codes, minlength=len(data[f"{column}_dict"]))
+    present = np.flatnonzero(counts)
+    return data[f"{column}_dict"][present], counts[present]
+
+
+def _merge(parts, raw):
+    """Sum [(keys, counts)] arrays from several days with a {key: count} dict from raw rows."""
+    if raw:
+        parts = parts + [(np.array(list(raw), dtype=str), np.array(list(raw.values())))]
+    if not parts:
+        return {}
+    keys, inverse = np.unique(np.concatenate([k for k, _ in parts]), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate([c for _, c in parts]))
+    return dict(zip(keys.tolist(), totals.astype(np.int64).tolist()))
+
+
+def dimension_counts(site, dimension, since, until=None, services=(), prefixes=()):
+    """{key: count} for url, country or source over the window."""
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"unknown columnar dimension: {dimension}")
+    files, raw = _window(site, since, until, services, prefixes)
+    parts = [_counts(data, dimension, _segment_mask(data, services, prefixes)) for _, data in files]
+    return _merge(parts, raw_counts(raw, dimension))
+
+
+def daily_views(site, since, until=None):
+    """[(day, views)] over the window."""
+    files, raw = _window(site, since, until)
+    trend = {day: len(data["url_codes"]) for day, data in files}
+    for r in raw.annotate(day=TruncDate("timestamp")).values("day").annotate(v=Count("id")):
+        trend[r["day"]] = trend.get(r["day"], 0) + r["v"]
+    return sorted(trend.items())
+
+
+def kpi_totals(site, since, until, services=(), prefixes=()):
+    """(page_views, distinct sessions, top country or None) over the window."""
+    files, raw = _window(site, since, until, services, prefixes)
+    page_views = raw.count()
+    sessions = [np.array(list(raw.order_by().values_list("session_id", flat=True).distinct()), dtype=str)]
+    countries = []
+    for _, data in files:
+        mask = _segment_mask(data, services, prefixes)
+        page_views += len(data["url_codes"]) if mask is None else int(mask.sum())
+        sessions.append(_counts(data, "session", mask)[0])
+        countries.append(_counts(data, "country", mask))
+    country_counts = _merge(countries, raw_counts(raw, "country"))
+    # same tie-break as the ORM path: most events, then the alphabetically first country
+    top_country = min(country_counts, key=lambda c: (-country_counts[c], c)) if country_counts else None
+    return page_views, len(np.unique(np.concatenate(sessions))), top_country
@@ -0,0 +1,128 @@
+"""Streaming export of raw events as CSV, NDJSON or Parquet.
+
+Rows are read in keyset pages ordered by (timestamp, id), each page through a server-side
+cursor, and every writer yields one chunk per page, so memory stays flat however many
+rows the window holds. Parquet needs the optional `pyarrow` package.
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Event
+
+FIELDS = (
+    "id", "timestamp", "event_type", "url", "referrer", "utm_source", "source", "session_id",
+    "user_agent", "device", "browser", "os", "language", "screen_width", "screen_height",
+    "ip_address", "country",
+)
+INT_FIELDS = {"id", "screen_width", "screen_height"}
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+PARQUET_COMPRESSIONS = ("zstd", "snappy", "gzip", "none")
+
+
+class ExportError(Exception):
+    pass
+
+
+def event_pages(site, since, until, chunk_size=None):
+    """Yield lists of row tuples (in FIELDS order) for the site's events in [since, until]."""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    base = Event.objects.filter(site=site, timestamp__gte=since, timestamp__lte=until).order_by("timestamp", "id")
+    last = None
+    while True:
+        qs = base
+        if last is not None:
+            qs = qs.filter(Q(timestamp__gt=last[0]) | Q(timestamp=last[0], id__gt=last[1]))
+        page = list(qs.values_list(*FIELDS)[:chunk_size].iterator(chunk_size=chunk_size))
+        if not page:
+            return
+        yield page
+        if len(page) < chunk_size:
+            return
+        last = (page[-1][1], page[-1][0])
+
+
+def _text(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def csv_chunks(pages):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    yield buf.getvalue()
+    for page in pages:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([[_text(v) for v in row] for row in page])
+        yield buf.getvalue()
+
+
+def ndjson_chunks(pages):
+    for page in pages:
+        yield "".join(json.dumps(dict(zip(FIELDS, map(_text, row)))) + "\n" for row in page)
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands its bytes out as they are written."""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.parts.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_chunks(pages, compression="zstd"):
+    """One row group per page. Raises ExportError before yielding if pyarrow is missing."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("Parquet export needs the pyarrow package")
+    if compression not in PARQUET_COMPRESSIONS:
+        raise ExportError(f"compression must be one of: {', '.join(PARQUET_COMPRESSIONS)}")
+
+    schema = pa.schema([
+        (name, pa.int64() if name in INT_FIELDS else pa.timestamp("us", tz="UTC") if name == "timestamp" else pa.string())
+        for name in FIELDS
+    ])
+
+    def generate():
+        sink = _Sink()
+        writer = pq.ParquetWriter(sink, schema, compression=compression)
+        for page in pages:
+            columns = list(zip(*page))
+            writer.write_table(pa.Table.from_arrays([pa.array(col, type=schema.field(i).type) for i, col in enumerate(columns)], schema=schema))
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    return generate()
+
+
+def export_chunks(output, pages, compression="zstd"):
+    if output == "csv":
+        return csv_chunks(pages)
+    if output == "ndjson":
+        return ndjson_chunks(pages)
+    if output == "parquet":
+        return parquet_chunks(pages, compression)
+    raise ExportError(f"output must be one of: {', '.join(FORMATS)}")
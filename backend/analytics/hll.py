@@ -0,0 +1,105 @@
+"""HyperLogLog sketches for approximate distinct counts (unique sessions per site and day).
+
+A sketch with precision p has m = 2**p one-byte registers. The relative standard error
+of the estimate is about 1.04 / sqrt(m):
+
+    p = 10 -> 3.25%    p = 12 -> 1.63%    p = 14 -> 0.81% (default)    p = 16 -> 0.41%
+
+so ~99.7% of estimates fall within three times that. Sketches of the same precision merge
+losslessly (register-wise max): the sketch of a window is the merge of its daily sketches.
+Cardinality is estimated with Ertl's improved estimator ("New cardinality estimation
+algorithms for HyperLogLog sketches", 2017), which stays unbiased from tiny to very
+large counts without HLL++'s empirical bias tables.
+"""
+import hashlib
+import math
+import zlib
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+def relative_error(precision):
+    return 1.04 / math.sqrt(1 << precision)
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y, z = 1.0, 1.0 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1.0 - x) ** 2 * y
+        if z == z_old:
+            return z / 3.0
+
+
+class HyperLogLog:
+    def __init__(self, precision=14, registers=None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"precision must be between {MIN_PRECISION} and {MAX_PRECISION}")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m) if registers is None else bytearray(registers)
+        if len(self.registers) != self.m:
+            raise ValueError("register count does not match precision")
+
+    def add(self, value):
+        x = _hash64(value)
+        q = 64 - self.precision
+        index = x >> q
+        rest = x & ((1 << q) - 1)
+        rank = q - rest.bit_length() + 1  # position of the leftmost 1-bit, q + 1 if none
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = self.m
+        q = 64 - self.precision
+        counts = [self.registers.count(k) for k in range(q + 2)]
+        if counts[0] == m:
+            return 0
+        z = m * _tau(1.0 - counts[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * _sigma(counts[0] / m)
+        return int(round(m * m / (2 * math.log(2)) / z))
+
+    def to_bytes(self):
+        # mostly-empty sketches (small sites, quiet days) compress to a few bytes
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], zlib.decompress(data[1:]))
@@ -0,0 +1,211 @@
+"""Shared ingest helpers for the tracking endpoints (/track/ and /track/batch/)."""
+import json
+import logging
+
+import dateutil.parser
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import QueryDict
+from django.utils import timezone
+
+from . import ingest_filters, ingest_queue, live, response_cache
+from .caching import TTLLRUCache, aresolve_site_pks, normalize_site_id, resolve_site_pks
+from .classify import classify_user_agent, source_key
+from .models import Event, IngestQueueCheckpoint, Site, VisitorFirstSeen
+from .serializers import EventSerializer
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_payload(data):
+    """Parse the client timestamp, falling back to server time when missing or invalid."""
+    if "timestamp" in data and data["timestamp"]:
+        try:
+            data["timestamp"] = dateutil.parser.isoparse(str(data["timestamp"]))
+        except Exception:
+            data["timestamp"] = timezone.now()
+    else:
+        data["timestamp"] = timezone.now()
+    return data
+
+
+def parse_batch_body(raw):
+    """Decode a batch body: a JSON array, {"events": [...]} or NDJSON (one event per line).
+    Raises ValueError when the body can't be decoded.
+    """
+    text = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+    text = text.strip()
+    if not text:
+        return []
+    try:
+        body = json.loads(text)
+    except ValueError:
+        # not a single JSON document, try NDJSON
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(body, dict):
+        body = body.get("events", [body])
+    if not isinstance(body, list):
+        raise ValueError("expected a JSON array of events")
+    return body
+
+
+def enrich(event):
+    """Fill the columns derived from the raw payload (device/browser/os and source)."""
+    event.device, event.browser, event.os = classify_user_agent(event.user_agent)
+    event.source = source_key(event.utm_source, event.referrer)
+    return event
+
+
+def validate_events(payloads, ip=None):
+    """Validate a list of raw payloads in one pass.
+    Returns (events, results): unsaved Event instances for the accepted rows and
+    one {"index", "status", "errors"?, "reason"?} result per payload, in input order.
+    `ip` is the sender's address, checked against the ingest denylist (ingest_filters).
+    """
+    valid, results = check_payloads(payloads)
+    # resolve every site_id in the batch through the site cache (one query for the misses)
+    site_pks = resolve_site_pks(data["site_id"] for _, data, _ in valid)
+    return build_events(valid, site_pks, results, ip), results
+
+
+async def avalidate_events(payloads, ip=None):
+    """validate_events for async views: only the site lookup of cache misses awaits the database."""
+    valid, results = check_payloads(payloads)
+    site_pks = await aresolve_site_pks(data["site_id"] for _, data, _ in valid)
+    return build_events(valid, site_pks, results, ip), results
+
+
+def check_payloads(payloads):
+    """Field validation only (no database): ([(index, validated_data, client_stamped)], results
+    with the rejects filled in). client_stamped is False when the server supplied the timestamp.
+    """
+    results = [None] * len(payloads)
+    valid = []
+    for index, payload in enumerate(payloads):
+        if not isinstance(payload, dict):
+            results[index] = {"index": index, "status": "rejected", "errors": {"non_field_errors": ["expected an object"]}}
+            continue
+        # a form post's QueryDict maps each field to a list of values; .dict() keeps the last one
+        data = payload.dict() if isinstance(payload, QueryDict) else dict(payload)
+        serializer = EventSerializer(data=normalize_payload(data))
+        if not serializer.is_valid():
+            results[index] = {"index": index, "status": "rejected", "errors": serializer.errors}
+            continue
+        valid.append((index, serializer.validated_data, bool(payload.get("timestamp"))))
+    return valid, results
+
+
+def build_events(valid, site_pks, results, ip=None):
+    events = []
+    filtered = []
+    for index, data, client_stamped in valid:
+        data = dict(data)
+        raw_site_id = data.pop("site_id", None)
+        site_pk = site_pks.get(normalize_site_id(raw_site_id))
+        if site_pk is None:
+            results[index] = {"index": index, "status": "rejected", "errors": {"site_id": [f"invalid site_id: {raw_site_id!r}"]}}
+            continue
+        reason = ingest_filters.reject_reason(site_pk, data, ip, dedupe=client_stamped)
+        if reason:
+            results[index] = {"index": index, "status": "filtered", "reason": reason}
+            filtered.append(reason)
+            continue
+        events.append(enrich(Event(site_id=site_pk, **data)))
+        results[index] = {"index": index, "status": "accepted"}
+    ingest_filters.count_filtered(filtered)
+    return events
+
+
+def save_events(events):
+    """Write events with bulk_create in chunks of TRACK_BATCH_CHUNK_SIZE."""
+    if events:
+        Event.objects.bulk_create(events, batch_size=settings.TRACK_BATCH_CHUNK_SIZE)
+        record_first_seen(events)
+        response_cache.invalidate_for_events(events)
+    return len(events)
+
+
+# (site pk, session_id) pairs this process already recorded in VisitorFirstSeen
+known_sessions = TTLLRUCache(settings.FIRST_SEEN_CACHE_SIZE, settings.FIRST_SEEN_CACHE_TTL)
+
+
+def record_first_seen(events):
+    """Insert VisitorFirstSeen rows for sessions not seen before; existing rows are left alone
+    (rollup_events lowers first_seen if an older event shows up later).
+    """
+    firsts = {}
+    for event in events:
+        key = (event.site_id, event.session_id)
+        if known_sessions.get(key):
+            continue
+        if key not in firsts or event.timestamp < firsts[key]:
+            firsts[key] = event.timestamp
+    if not firsts:
+        return
+    VisitorFirstSeen.objects.bulk_create(
+        [VisitorFirstSeen(site_id=site_pk, session_id=session_id, first_seen=ts) for (site_pk, session_id), ts in firsts.items()],
+        batch_size=settings.TRACK_BATCH_CHUNK_SIZE,
+        ignore_conflicts=True,
+    )
+    for key in firsts:
+        known_sessions.set(key, True)
+
+
+def queue_mode():
+    return settings.INGEST_MODE == "queue"
+
+
+def store_events(events):
+    """Persist validated events: written directly, or appended to the write-behind
+    spool when INGEST_MODE=queue (raises ingest_queue.QueueFull on backpressure).
+    Returns True when the events were queued rather than written.
+    """
+    try:
+        if queue_mode():
+            ingest_queue.enqueue(events)
+        else:
+            save_events(events)
+    except Exception:
+        ingest_filters.forget(events)
+        raise
+    live.publish(events)
+    return queue_mode()
+
+
+def drain_queue(limit):
+    """Move up to `limit` spooled events into Event. Returns the number written.
+    The checkpoint is advanced in the same transaction as the insert, so rows left in
+    the spool by a crash between commit and ack are dropped instead of replayed twice.
+    Events of sites deleted while they were queued are dropped and counted, so they
+    never block the spool.
+    """
+    checkpoint, _ = IngestQueueCheckpoint.objects.get_or_create(queue_id=ingest_queue.queue_id())
+    ingest_queue.ack(checkpoint.last_id)
+    batch = ingest_queue.read_batch(limit, after_id=checkpoint.last_id)
+    if not batch:
+        return 0
+    last_id = batch[-1][0]
+    try:
+        written = _write_batch(checkpoint, batch, last_id)
+    except IntegrityError:
+        # foreign keys are checked at commit: a site deleted after the check below; check again
+        written = _write_batch(checkpoint, batch, last_id)
+    ingest_queue.ack(last_id)
+    dropped = len(batch) - written
+    if dropped:
+        logger.warning("dropped %d queued events of deleted sites", dropped)
+        ingest_filters.count_filtered(["deleted_site"] * dropped)
+    return written
+
+
+def _write_batch(checkpoint, batch, last_id):
+    """Insert the events of sites that still exist and advance the checkpoint past the whole batch."""
+    events = [event for _, event in batch]
+    sites = set(Site.objects.filter(pk__in={e.site_id for e in events}).values_list("pk", flat=True))
+    events = [e for e in events if e.site_id in sites]
+    for event in events:
+        event.pk = None  # set by an attempt that failed at commit
+    with transaction.atomic():
+        save_events(events)
+        IngestQueueCheckpoint.objects.filter(pk=checkpoint.pk).update(last_id=last_id)
+    return len(events)
@@ -0,0 +1,85 @@
+"""Ingest-stage filters: events they drop are counted in the metrics, never stored.
+
+In order: the IP and user-agent denylists, the bot matcher (classify.is_bot) and a
+short-window dedupe of repeated beacons (double-fired handlers, client retries) keyed on
+(site, session_id, url, TRACK_DEDUPE_SECONDS bucket of the timestamp) in a bounded
+in-process TTLLRUCache. The dedupe only sees the beacons of its own process.
+"""
+import ipaddress
+import re
+from functools import lru_cache
+
+from django.conf import settings
+
+from .caching import TTLLRUCache
+from .classify import is_bot
+from .metrics import registry
+
+recent_beacons = TTLLRUCache(settings.TRACK_DEDUPE_MAX_ENTRIES, settings.TRACK_DEDUPE_SECONDS)
+
+
+def client_ip(request):
+    """The caller's address: REMOTE_ADDR, or the first X-Forwarded-For hop when the
+    app runs behind a proxy that sets it (TRACK_TRUST_X_FORWARDED_FOR)."""
+    if settings.TRACK_TRUST_X_FORWARDED_FOR:
+        forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return request.META.get("REMOTE_ADDR")
+
+
+@lru_cache(maxsize=4)
+def denylist(ips, user_agents):
+    """(networks, UA regex or None) compiled once per pair of setting values."""
+    networks = tuple(ipaddress.ip_network(item.strip(), strict=False) for item in ips.split(",") if item.strip())
+    agents = [re.escape(item.strip()) for item in user_agents.split(",") if item.strip()]
+    return networks, re.compile("|".join(agents), re.IGNORECASE) if agents else None
+
+
+def _denied_ip(networks, ip):
+    if not ip or not networks:
+        return False
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def reject_reason(site_pk, data, ip=None, dedupe=True):
+    """Why a validated payload should be dropped ("denylist", "bot" or "duplicate"), or None.
+    Only payloads carrying the client's own timestamp are deduplicated (`dedupe`): a retried
+    beacon repeats it, while server-stamped repeats can't be told apart from real ones.
+    """
+    user_agent = data.get("user_agent") or ""
+    networks, agents = denylist(settings.TRACK_DENY_IPS, settings.TRACK_DENY_USER_AGENTS)
+    if _denied_ip(networks, ip) or _denied_ip(networks, data.get("ip_address")) or (agents and agents.search(user_agent)):
+        return "denylist"
+    if settings.TRACK_FILTER_BOTS and is_bot(user_agent):
+        return "bot"
+    if dedupe and settings.TRACK_DEDUPE_SECONDS > 0:
+        key = beacon_key(site_pk, data["session_id"], data["url"], data["timestamp"])
+        if not recent_beacons.add(key, True, ttl=settings.TRACK_DEDUPE_SECONDS):
+            return "duplicate"
+    return None
+
+
+def beacon_key(site_pk, session_id, url, timestamp):
+    return (site_pk, session_id, url, int(timestamp.timestamp() // settings.TRACK_DEDUPE_SECONDS))
+
+
+def forget(events):
+    """Drop the dedupe keys of events that could not be stored, so the client's retry
+    (e.g. after a 503 with Retry-After) is accepted instead of filtered as a duplicate."""
+    if settings.TRACK_DEDUPE_SECONDS > 0:
+        for event in events:
+            recent_beacons.delete(beacon_key(event.site_id, event.session_id, event.url, event.timestamp))
+
+
+def count_filtered(reasons):
+    if reasons:
+        registry.record_filtered(reasons)
+
+
+def reset():
+    recent_beacons.clear()
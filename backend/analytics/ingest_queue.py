@@ -0,0 +1,94 @@
+"""Durable local spool used by the write-behind ingest mode (INGEST_MODE=queue).
+
+Tracking endpoints validate events and append them here; the drain_ingest_queue
+management command moves them into Event with bulk_create. The spool is a SQLite
+database in WAL mode so appends from several workers are cheap and survive crashes.
+"""
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+import dateutil.parser
+from django.conf import settings
+
+from .models import Event
+
+_local = threading.local()
+
+
+class QueueFull(Exception):
+    """Raised when the spool is deeper than INGEST_QUEUE_MAX_DEPTH."""
+
+
+def _connect():
+    # one connection per thread (and per process, so forked workers never share one)
+    path = str(settings.INGEST_QUEUE_PATH)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key == (os.getpid(), path):
+        return conn
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('queue_id', ?)", (str(uuid.uuid4()),))
+    _local.conn = conn
+    _local.key = (os.getpid(), path)
+    return conn
+
+
+def queue_id():
+    """Random id of this spool file, used to key the drain checkpoint."""
+    return _connect().execute("SELECT value FROM meta WHERE key = 'queue_id'").fetchone()[0]
+
+
+def depth():
+    # ids are drained from the head in order, so the id span is the depth (and O(1) to read)
+    lo, hi = _connect().execute("SELECT MIN(id), MAX(id) FROM spool").fetchone()
+    return 0 if lo is None else hi - lo + 1
+
+
+def _serialize(event):
+    row = {}
+    for field in Event._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        value = getattr(event, field.attname)
+        row[field.attname] = value.isoformat() if hasattr(value, "isoformat") else value
+    return json.dumps(row)
+
+
+def enqueue(events):
+    """Append validated (unsaved) events to the spool. Raises QueueFull for backpressure."""
+    if not events:
+        return 0
+    if depth() + len(events) > settings.INGEST_QUEUE_MAX_DEPTH:
+        raise QueueFull()
+    conn = _connect()
+    rows = [(_serialize(e),) for e in events]
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO spool (payload) VALUES (?)", rows)
+    return len(rows)
+
+
+def read_batch(limit, after_id=0):
+    """Oldest queued rows with id > after_id, as (id, Event) pairs."""
+    cur = _connect().execute(
+        "SELECT id, payload FROM spool WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+    )
+    batch = []
+    for row_id, payload in cur.fetchall():
+        data = json.loads(payload)
+        data["timestamp"] = dateutil.parser.isoparse(data["timestamp"])
+        batch.append((row_id, Event(**data)))
+    return batch
+
+
+def ack(up_to_id):
+    """Remove everything up to and including up_to_id once it is safely in the database."""
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM spool WHERE id <= ?", (up_to_id,))
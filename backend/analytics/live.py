@@ -0,0 +1,112 @@
+"""Live visitors: an in-memory sliding window per site, streamed over Server-Sent Events.
+
+store_events publishes every accepted event here. Each site keeps the hits of the last
+LIVE_WINDOW_SECONDS with running per-session and per-URL counts, so a snapshot never
+reads the database. Snapshots are rebuilt at most every LIVE_SNAPSHOT_SECONDS and shared
+by every viewer of the site. The window lives in the process that ingested the events:
+run ingest and the live endpoint in one worker, or accept a per-worker view.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+from django.utils import timezone
+
+
+class SiteWindow:
+    def __init__(self):
+        self.hits = deque()  # (arrival, session_id, url), oldest first
+        self.sessions = Counter()
+        self.pages = Counter()
+        self.snapshot = None
+        self.snapshot_at = 0.0
+
+    def add(self, now, session_id, url):
+        self.hits.append((now, session_id, url))
+        self.sessions[session_id] += 1
+        self.pages[url] += 1
+        while len(self.hits) > settings.LIVE_MAX_HITS_PER_SITE:
+            self._drop()
+
+    def expire(self, now):
+        cutoff = now - settings.LIVE_WINDOW_SECONDS
+        while self.hits and self.hits[0][0] < cutoff:
+            self._drop()
+
+    def _drop(self):
+        _, session_id, url = self.hits.popleft()
+        for counts, key in ((self.sessions, session_id), (self.pages, url)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+
+_windows = {}  # site pk -> SiteWindow
+_lock = threading.Lock()
+
+
+def publish(events):
+    """Add freshly ingested events; backfilled ones older than the window are skipped."""
+    now = time.monotonic()
+    oldest = timezone.now().timestamp() - settings.LIVE_WINDOW_SECONDS
+    with _lock:
+        for event in events:
+            if event.timestamp.timestamp() < oldest:
+                continue
+            window = _windows.get(event.site_id)
+            if window is None:
+                window = _windows[event.site_id] = SiteWindow()
+            window.add(now, event.session_id, event.url)
+
+
+def snapshot(site_pk):
+    """{active_visitors, pageviews, top_pages, window_seconds, time} for the current window."""
+    now = time.monotonic()
+    with _lock:
+        window = _windows.get(site_pk)
+        if window is None:
+            window = _windows[site_pk] = SiteWindow()
+        if window.snapshot is None or now - window.snapshot_at >= settings.LIVE_SNAPSHOT_SECONDS:
+            window.expire(now)
+            window.snapshot = {
+                "active_visitors": len(window.sessions),
+                "pageviews": len(window.hits),
+                "top_pages": [{"url": url, "views": n} for url, n in window.pages.most_common(settings.LIVE_TOP_PAGES)],
+                "window_seconds": settings.LIVE_WINDOW_SECONDS,
+                "time": timezone.now().isoformat(),
+            }
+            window.snapshot_at = now
+        return window.snapshot
+
+
+def reset():
+    with _lock:
+        _windows.clear()
+
+
+def _frame(site_pk):
+    return f"data: {json.dumps(snapshot(site_pk))}\n\n"
+
+
+def poll(site_pk):
+    """One SSE response body for WSGI workers: a single snapshot, with `retry` set so
+    EventSource asks again after LIVE_INTERVAL_SECONDS. A sync worker is never held by
+    an open stream; long-lived streams are served by astream under ASGI only.
+    """
+    return f"retry: {int(settings.LIVE_INTERVAL_SECONDS * 1000)}\n\n" + _frame(site_pk)
+
+
+async def astream(site_pk):
+    """SSE frames for ASGI servers, where an idle viewer costs a coroutine instead of a
+    worker: one snapshot every LIVE_INTERVAL_SECONDS. The stream ends after
+    LIVE_STREAM_SECONDS so it is rebalanced from time to time; EventSource reconnects."""
+    yield f"retry: {settings.LIVE_RETRY_MS}\n\n"
+    deadline = time.monotonic() + settings.LIVE_STREAM_SECONDS
+    while True:
+        yield _frame(site_pk)
+        if time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(settings.LIVE_INTERVAL_SECONDS)
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.classify import classify_user_agent, source_key
+from analytics.models import Event
+
+# name -> (derived columns, source columns, function of the source values returning the derived values)
+BACKFILLS = {
+    "ua": (("device", "browser", "os"), ("user_agent",), classify_user_agent),
+    "source": (("source",), ("utm_source", "referrer"), lambda utm, ref: (source_key(utm, ref),)),
+}
+
+
+class Command(BaseCommand):
+    help = "Fill ingest-time derived Event columns for rows stored before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fields", default=",".join(BACKFILLS), help=f"comma-separated subset of: {', '.join(BACKFILLS)}")
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **opts):
+        names = [n.strip() for n in opts["fields"].split(",") if n.strip()]
+        unknown = set(names) - set(BACKFILLS)
+        if unknown:
+            raise CommandError(f"unknown fields: {', '.join(sorted(unknown))}")
+        for name in names:
+            updated = self.backfill(*BACKFILLS[name], chunk_size=opts["chunk_size"])
+            self.stdout.write(self.style.SUCCESS(f"{name}: updated {updated} events"))
+
+    def backfill(self, targets, sources, derive, chunk_size):
+        pending = Event.objects.filter(**{f"{targets[0]}__isnull": True})
+        last_id = 0
+        updated = 0
+        while True:
+            rows = list(
+                pending.filter(id__gt=last_id).order_by("id").values_list("id", *sources)[:chunk_size]
+            )
+            if not rows:
+                return updated
+            last_id = rows[-1][0]
+            # one UPDATE per distinct derived value in the chunk, not per row
+            groups = {}
+            for row_id, *values in rows:
+                groups.setdefault(derive(*values), []).append(row_id)
+            for derived, ids in groups.items():
+                Event.objects.filter(id__in=ids).update(**dict(zip(targets, derived)))
+            updated += len(rows)
+            self.stdout.write(f"  ... {updated} events (last id {last_id})")
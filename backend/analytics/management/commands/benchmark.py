@@ -0,0 +1,97 @@
+import io
+import json
+import platform
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from analytics.benchmarks import ANALYTICS_CASES, compare, run_cases
+from analytics.models import Site
+
+DAYS = 30
+EVENTS_PER_SESSION = 3  # seed_event averages 1-5 pageviews per session
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark /track/ ingest and the analytics views on seeded datasets in a throwaway test "
+        "database; writes JSON and optionally fails on regressions against a baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scales", default="1000,10000,100000", help="comma-separated dataset sizes (events)")
+        parser.add_argument("--repeat", type=int, default=30, help="timed calls per case")
+        parser.add_argument("--cases", help=f"comma-separated subset of: {', '.join(ANALYTICS_CASES)} (track_event always runs)")
+        parser.add_argument("--output", help="write the JSON results here (default: stdout)")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="allowed relative increase of p95 latency and peak memory (0.2 = 20%%)")
+        parser.add_argument("--no-rollup", action="store_true", help="don't run rollup_events after seeding")
+        parser.add_argument("--cache", action="store_true", help="keep the analytics response cache on (measures hits)")
+
+    def handle(self, *args, **opts):
+        try:
+            scales = [int(s) for s in opts["scales"].split(",") if s.strip()]
+        except ValueError:
+            raise CommandError("--scales must be comma-separated integers")
+        cases = {c.strip() for c in opts["cases"].split(",") if c.strip()} if opts["cases"] else None
+        baseline = None
+        if opts["baseline"]:
+            with open(opts["baseline"]) as f:
+                baseline = json.load(f)["results"]
+
+        results = {}
+        setup_test_environment()
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(ANALYTICS_CACHE_ENABLED=opts["cache"]):
+                for scale in scales:
+                    self.stderr.write(f"seeding {scale} events...")
+                    results[str(scale)] = self.run_scale(scale, opts["repeat"], cases, not opts["no_rollup"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            "meta": {
+                "created": timezone.now().isoformat(),
+                "database": connection.vendor,
+                "python": platform.python_version(),
+                "repeat": opts["repeat"],
+                "cache": opts["cache"],
+            },
+            "results": results,
+        }
+        text = json.dumps(report, indent=2)
+        if opts["output"]:
+            with open(opts["output"], "w") as f:
+                f.write(text + "\n")
+        else:
+            self.stdout.write(text)
+
+        if baseline is not None:
+            regressions = compare(results, baseline, opts["threshold"])
+            for scale, case, metric, old, new in regressions:
+                self.stderr.write(self.style.ERROR(f"{scale} {case} {metric}: {old} -> {new}"))
+            if regressions:
+                raise CommandError(f"{len(regressions)} regression(s) beyond the threshold")
+            self.stderr.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def run_scale(self, scale, repeat, cases, rollup):
+        sessions = max(scale // (DAYS * EVENTS_PER_SESSION), 1)
+        quiet = io.StringIO()
+        call_command("seed_event", "--days", str(DAYS), "--sessions", str(sessions), "--seed", "1",
+                     "--distribution", "weekly", stdout=quiet)
+        if rollup:
+            call_command("rollup_events", stdout=quiet)
+        site = Site.objects.get(domain="example.com", owner__username="demo")
+        client = APIClient()
+        # real JWT authentication on every request, like the dashboard
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(site.owner).access_token}")
+        return run_cases(client, site.site_id, repeat, cases)
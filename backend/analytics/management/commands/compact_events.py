@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.columnar import np, run_compaction
+
+
+class Command(BaseCommand):
+    help = "Compact closed days of events into per-site, per-day columnar files (run it periodically, e.g. nightly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="delete every file and compact all closed days again")
+
+    def handle(self, *args, **opts):
+        if np is None:
+            raise CommandError("compact_events needs numpy (pip install numpy)")
+        days = run_compaction(rebuild=opts["rebuild"])
+        self.stdout.write(self.style.SUCCESS(f"Compacted {days} site-days"))
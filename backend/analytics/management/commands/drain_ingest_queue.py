@@ -0,0 +1,47 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analytics import ingest_queue
+from analytics.ingest import drain_queue
+
+
+class Command(BaseCommand):
+    help = "Drain the write-behind ingest spool (INGEST_MODE=queue) into Event in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--flush-size", type=int, default=settings.INGEST_QUEUE_FLUSH_SIZE,
+                            help="max events written per bulk_create transaction")
+        parser.add_argument("--flush-interval", type=float, default=settings.INGEST_QUEUE_FLUSH_INTERVAL,
+                            help="seconds to wait for a full batch before flushing a partial one")
+        parser.add_argument("--once", action="store_true", help="drain what is queued now and exit")
+
+    def handle(self, *args, **opts):
+        flush_size = opts["flush_size"]
+        interval = opts["flush_interval"]
+        self._stopping = False
+        # finish the current batch on SIGTERM/SIGINT instead of dying mid-transaction
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        total = 0
+        last_flush = time.monotonic()
+        while not self._stopping:
+            pending = ingest_queue.depth()
+            if pending >= flush_size or (pending and (opts["once"] or time.monotonic() - last_flush >= interval)):
+                written = drain_queue(flush_size)
+                total += written
+                last_flush = time.monotonic()
+                if written:
+                    self.stdout.write(f"drained {written} events ({max(pending - written, 0)} pending)")
+                continue
+            if opts["once"]:
+                break
+            time.sleep(min(interval, 0.5))
+
+        self.stdout.write(self.style.SUCCESS(f"Drained {total} events"))
+
+    def _stop(self, signum, frame):
+        self._stopping = True
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.caching import normalize_site_id
+from analytics.export import FORMATS, PARQUET_COMPRESSIONS, ExportError, event_pages, export_chunks
+from analytics.models import Site
+from analytics.views import parse_date_range
+
+
+class Command(BaseCommand):
+    help = "Stream a site's raw events for a date window to a file (or stdout) as CSV, NDJSON or Parquet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("site_id")
+        parser.add_argument("--start", help="YYYY-MM-DD (with --end)")
+        parser.add_argument("--end", help="YYYY-MM-DD (with --start)")
+        parser.add_argument("--preset", help="last_7d, last_14d, last_30d, this_month or last_month")
+        parser.add_argument("--days", help="last N days (default 30)")
+        parser.add_argument("--output", choices=list(FORMATS), default="csv")
+        parser.add_argument("--compression", choices=PARQUET_COMPRESSIONS, default="zstd", help="parquet only")
+        parser.add_argument("--out", help="file to write; stdout if omitted (not for parquet)")
+        parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **opts):
+        site = Site.objects.filter(site_id=normalize_site_id(opts["site_id"])).first()
+        if not site:
+            raise CommandError(f"unknown site: {opts['site_id']}")
+        if opts["output"] == "parquet" and not opts["out"]:
+            raise CommandError("parquet output needs --out")
+
+        since, until = parse_date_range({k: opts[k] for k in ("start", "end", "preset", "days")})
+        try:
+            chunks = export_chunks(opts["output"], event_pages(site, since, until, opts["chunk_size"]), opts["compression"])
+        except ExportError as e:
+            raise CommandError(str(e))
+
+        if not opts["out"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+        binary = opts["output"] == "parquet"
+        with open(opts["out"], "wb" if binary else "w", newline=None if binary else "") as out:
+            for chunk in chunks:
+                out.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Exported {site.site_id} events {since:%Y-%m-%d} to {until:%Y-%m-%d} into {opts['out']}"))
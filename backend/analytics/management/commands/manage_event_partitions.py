@@ -0,0 +1,235 @@
+from datetime import date, datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from analytics import retention
+from analytics.models import Event, Site
+
+TABLE = Event._meta.db_table
+PARTITION_PREFIX = f"{TABLE}_p"  # analytics_event_pYYYYMM
+DETACHED_PREFIX = f"{TABLE}_detached_p"  # expired without --drop; dropped by a later --drop run
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def _add_months(d, n):
+    years, month = divmod(d.month - 1 + n, 12)
+    return date(d.year + years, month + 1, 1)
+
+
+def _start(d):
+    return datetime(d.year, d.month, d.day, tzinfo=dt_timezone.utc)
+
+
+def _bound(d):
+    return _start(d).isoformat()
+
+
+def _partition_month(name, prefix=PARTITION_PREFIX):
+    """The month of a partition named <prefix>YYYYMM, or None (the default partition)."""
+    suffix = name[len(prefix):]
+    if not name.startswith(prefix) or len(suffix) != 6 or not suffix.isdigit():
+        return None
+    return date(int(suffix[:4]), int(suffix[4:]), 1)
+
+
+def _expire_cutoff(today, retain_months):
+    """First month kept by --retain: partitions ending on or before it expire."""
+    return _add_months(today.replace(day=1), -retain_months)
+
+
+def _is_expired(month, cutoff):
+    return _add_months(month, 1) <= cutoff
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage monthly range partitions of the Event table (PostgreSQL only): convert the table "
+        "once with --convert, then run periodically to create future partitions and expire old ones"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--convert", action="store_true",
+                            help="one-time conversion of the existing table into a partitioned one (copies every row)")
+        parser.add_argument("--ahead", type=int, default=settings.EVENT_PARTITION_MONTHS_AHEAD,
+                            help="months of partitions to create ahead of the current one")
+        parser.add_argument("--retain", type=int, default=settings.EVENT_PARTITION_RETAIN_MONTHS,
+                            help="detach partitions that ended more than this many months ago (0 keeps everything); "
+                                 "their days are downsampled into the rollups first, and partitions holding events "
+                                 "a site's retention_days still keeps are skipped")
+        parser.add_argument("--drop", action="store_true",
+                            help="drop expired partitions, and those detached by earlier runs, instead of only detaching them")
+        parser.add_argument("--dry-run", action="store_true", help="print the SQL without running it")
+
+    def handle(self, *args, **opts):
+        if connection.vendor != "postgresql":
+            raise CommandError("Event partitioning requires PostgreSQL")
+        self.dry_run = opts["dry_run"]
+
+        with transaction.atomic(), connection.cursor() as cur:
+            self.cur = cur
+            if opts["convert"]:
+                self.convert(opts["ahead"])
+            elif not self.is_partitioned():
+                raise CommandError(f"{TABLE} is not partitioned yet; run with --convert first")
+            else:
+                this_month = timezone.now().date().replace(day=1)
+                self.create_partitions(this_month, _add_months(this_month, opts["ahead"]))
+            if opts["retain"]:
+                self.expire(opts["retain"], opts["drop"])
+            if opts["drop"]:
+                self.drop_detached()
+            if self.dry_run:
+                transaction.set_rollback(True)
+
+    def run(self, sql, params=None):
+        self.stdout.write(sql if params is None else f"{sql}  -- {params}")
+        if not self.dry_run:
+            self.cur.execute(sql, params)
+
+    def relkind(self, name):
+        self.cur.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = current_schema()::regnamespace", [name])
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def is_partitioned(self):
+        return self.relkind(TABLE) == "p"
+
+    def create_partitions(self, first_month, last_month):
+        has_default = self.relkind(DEFAULT_PARTITION) is not None
+        month = first_month
+        while month <= last_month:
+            name = f"{PARTITION_PREFIX}{month:%Y%m}"
+            start, end = _bound(month), _bound(_add_months(month, 1))
+            if has_default and self.relkind(name) is None and self.default_rows(start, end):
+                self.move_out_of_default(name, start, end)
+            else:
+                self.run(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE}" '
+                    f"FOR VALUES FROM ('{start}') TO ('{end}')"
+                )
+            month = _add_months(month, 1)
+
+    def default_rows(self, start, end):
+        self.cur.execute(
+            f'SELECT COUNT(*) FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s', [start, end]
+        )
+        return self.cur.fetchone()[0]
+
+    def move_out_of_default(self, name, start, end):
+        """Create a month's partition while the default partition holds rows for it (late or
+        backfilled events, a missed run). Postgres refuses CREATE ... PARTITION OF then, so the
+        table is created detached, the rows are moved into it and it is attached, all inside
+        the command's transaction."""
+        self.stdout.write(f"{DEFAULT_PARTITION} holds {self.default_rows(start, end)} rows for {name}; moving them")
+        self.run(f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS)')
+        self.run(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+            f'INSERT INTO "{name}" SELECT * FROM moved',
+            [start, end],
+        )
+        # attaching creates the parent's indexes and constraints on the new partition
+        self.run(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" ' f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+    def convert(self, ahead):
+        if self.is_partitioned():
+            raise CommandError(f"{TABLE} is already partitioned")
+        old = f"{TABLE}_unpartitioned"
+        cur = self.cur
+
+        # keep the secondary index definitions so they can be recreated on the partitioned parent
+        cur.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+            [TABLE],
+        )
+        indexes = cur.fetchall()
+        pkey = next(name for name, definition in indexes if definition.startswith("CREATE UNIQUE") and name.endswith("_pkey"))
+        index_defs = [definition for name, definition in indexes if name != pkey]
+        cur.execute(f'SELECT MIN("timestamp"), MAX("timestamp") FROM "{TABLE}"')
+        oldest, newest = cur.fetchone()
+
+        self.run(f'ALTER TABLE "{TABLE}" RENAME TO "{old}"')
+        self.run(f'ALTER TABLE "{old}" RENAME CONSTRAINT "{pkey}" TO "{old}_pkey"')
+        self.run(
+            f'CREATE TABLE "{TABLE}" (LIKE "{old}" INCLUDING DEFAULTS INCLUDING IDENTITY) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+        # the partition key has to be part of the primary key
+        self.run(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{pkey}" PRIMARY KEY ("id", "timestamp")')
+        self.run(
+            f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_site_id_fk" FOREIGN KEY ("site_id") '
+            f'REFERENCES "{Event._meta.get_field("site").related_model._meta.db_table}" ("id") DEFERRABLE INITIALLY DEFERRED'
+        )
+
+        this_month = timezone.now().date().replace(day=1)
+        first = min(oldest.date().replace(day=1), this_month) if oldest else this_month
+        last = max(newest.date().replace(day=1), this_month) if newest else this_month
+        self.create_partitions(first, _add_months(last, ahead))
+        # catches rows outside every monthly range (e.g. bogus client timestamps)
+        self.run(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+
+        self.run(f'INSERT INTO "{TABLE}" OVERRIDING SYSTEM VALUE SELECT * FROM "{old}"')
+        self.run(f"SELECT setval(pg_get_serial_sequence('\"{TABLE}\"', 'id'), COALESCE((SELECT MAX(id) FROM \"{TABLE}\"), 1))")
+        self.run(f'DROP TABLE "{old}"')
+        for definition in index_defs:
+            # created on the parent, so every current and future partition gets the index
+            self.run(definition)
+
+    def tables(self, sql, params):
+        self.cur.execute(sql, params)
+        return [name for (name,) in self.cur.fetchall()]
+
+    def expire(self, retain_months, drop):
+        cutoff = _expire_cutoff(timezone.now().date(), retain_months)
+        partitions = self.tables(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s ORDER BY c.relname",
+            [TABLE],
+        )
+        for name in partitions:
+            month = _partition_month(name)
+            if month is None or not _is_expired(month, cutoff):
+                continue  # default partition, or still retained
+            if not self.prepare_expiry(name, _start(_add_months(month, 1))):
+                continue
+            self.run(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+            if drop:
+                self.run(f'DROP TABLE "{name}"')
+            else:
+                self.run(f'ALTER TABLE "{name}" RENAME TO "{DETACHED_PREFIX}{month:%Y%m}"')
+
+    def prepare_expiry(self, name, end):
+        """Retention bookkeeping before a partition's events go away, as purge_events does:
+        every site with events in it is downsampled into the rollups and its purge horizon
+        moved to the partition's end. False (partition kept) when a site's retention_days
+        still keeps some of those events."""
+        self.cur.execute(f'SELECT DISTINCT "site_id" FROM "{name}"')
+        sites = list(Site.objects.filter(pk__in=[pk for (pk,) in self.cur.fetchall()]))
+        keeping = []
+        for site in sites:
+            if site.retention_days is None:
+                continue  # no site-specific retention: --retain decides
+            cutoff = retention.cutoff_for(site)
+            if cutoff is None or cutoff < end:
+                keeping.append(site.site_id)
+        if keeping:
+            self.stdout.write(self.style.WARNING(f"keeping {name}: retention_days of {', '.join(sorted(keeping))} still covers it"))
+            return False
+        for site in sites:
+            days = retention.prepare_purge(site, end)
+            if not self.dry_run:
+                retention.remove_day_files(site, end)
+            self.stdout.write(f"{name}: downsampled {days} days of {site.site_id}")
+        return True
+
+    def drop_detached(self):
+        for name in self.tables(
+            "SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r' "
+            "AND relnamespace = current_schema()::regnamespace ORDER BY relname",
+            [f"{DETACHED_PREFIX}%"],
+        ):
+            if _partition_month(name, DETACHED_PREFIX) is not None:
+                self.run(f'DROP TABLE "{name}"')
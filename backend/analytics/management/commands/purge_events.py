@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from analytics.models import Event, Site
+from analytics.retention import cutoff_for, expired_days, purge_site, retention_days
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete raw events older than each site's retention (Site.retention_days or EVENT_RETENTION_DAYS), "
+        "downsampling them into the daily rollups first (run it periodically, e.g. nightly)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--site", help="only purge this site_id")
+        parser.add_argument("--dry-run", action="store_true", help="report what would be downsampled and deleted, change nothing")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="events deleted per statement/transaction")
+        parser.add_argument("--sleep", type=float, default=0.1, help="seconds to pause between chunks")
+        parser.add_argument("--no-downsample", action="store_true", help="delete without rebuilding the rollups of expired days")
+
+    def handle(self, *args, **opts):
+        if opts["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        sites = Site.objects.order_by("pk")
+        if opts["site"]:
+            sites = sites.filter(site_id=opts["site"].strip().lower())
+            if not sites.exists():
+                raise CommandError(f"unknown site_id: {opts['site']}")
+
+        total = 0
+        for site in sites:
+            cutoff = cutoff_for(site)
+            if cutoff is None:
+                continue
+            if opts["dry_run"]:
+                expired = Event.objects.filter(site=site, timestamp__lt=cutoff).count()
+                days = 0 if opts["no_downsample"] else len(expired_days(site, cutoff))
+                self.stdout.write(
+                    f"{site.site_id}: keep {retention_days(site)} days (from {cutoff:%Y-%m-%d}), "
+                    f"{expired} events to delete in {-(-expired // opts['chunk_size'])} chunks, {days} days to downsample"
+                )
+                total += expired
+                continue
+
+            def progress(deleted, site=site):
+                self.stdout.write(f"{site.site_id}: {deleted} events deleted")
+
+            days, deleted, files = purge_site(
+                site, opts["chunk_size"], opts["sleep"], downsample=not opts["no_downsample"],
+                progress=progress if opts["verbosity"] > 1 else None,
+            )
+            self.stdout.write(
+                f"{site.site_id}: downsampled {days} days, deleted {deleted} events before {cutoff:%Y-%m-%d}"
+                + (f" and {files} columnar day files" if files else "")
+            )
+            total += deleted
+
+        verb = "Would delete" if opts["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {total} expired events"))
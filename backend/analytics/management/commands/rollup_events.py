@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from analytics.rollups import run_rollup
+
+
+class Command(BaseCommand):
+    help = "Incrementally roll up new events into DailyRollup (run it periodically, e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="drop all rollups and recompute them from raw events")
+
+    def handle(self, *args, **opts):
+        days = run_rollup(rebuild=opts["rebuild"])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {days} site-days"))
@@ -1,96 +1,236 @@
+import csv
+import io
+import multiprocessing
 import random
-from datetime import timedelta
-from django.core.management.base import BaseCommand
+import time
+import uuid
+from datetime import datetime, timedelta
+
 from django.contrib.auth.models import User
-from analytics.models import Site, Event
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
 from django.utils import timezone
-import uuid
+
+from analytics.classify import classify_user_agent, source_key
+from analytics.columnar import remove_site_files
+from analytics.models import DailyRollup, DailySketch, Event, Site, VisitorFirstSeen
+from analytics.response_cache import bump_generation
+from analytics.retention import delete_in_chunks
+
+countries = ["India", "USA", "Germany", "France", "Brazil", "UK", "Canada"]
+utm_sources = ["google", "twitter", "facebook", "newsletter", "linkedin", None]
+referrers = [
+    "https://google.com",
+    "https://twitter.com",
+    "https://facebook.com",
+    "https://news.example.com",
+    "",
+]
+devices = [
+    # desktop
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Safari/537.36", 1920, 1080),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 13_6_6) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Safari/605.1.15", 1440, 900),
+    # mobile
+    ("Mozilla/5.0 (Linux; Android 14; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Mobile Safari/537.36", 390, 844),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Mobile/15E148 Safari/604.1", 414, 896),
+    # tablet
+    ("Mozilla/5.0 (iPad; CPU OS 16_7 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1", 1024, 1366),
+]
+url_pool = [
+    "/",
+    "/page1",
+    "/page2",
+    "/landing/service-a",
+    "/landing/service-b",
+    "/blog/page1",
+    "/blog/page2",
+    "/docs/install",
+    "/docs/usage",
+]
+
+# Zipf-like popularity for the "weekly" distribution: a few pages and sources get most traffic
+URL_WEIGHTS = [1 / (rank + 1) for rank in range(len(url_pool))]
+SOURCE_WEIGHTS = [1 / (rank + 1) for rank in range(len(utm_sources))]
+# Mon..Sun and hour-of-day traffic multipliers for the "weekly" distribution
+WEEKDAY_FACTOR = [1.0, 1.05, 1.05, 1.0, 0.9, 0.6, 0.55]
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 3, 5, 7, 8, 8, 8, 7, 7, 8, 8, 7, 6, 6, 6, 5, 4, 3, 2]
+
+COLUMNS = (
+    "site_id", "event_type", "url", "referrer", "utm_source", "user_agent", "language", "screen_width",
+    "screen_height", "session_id", "ip_address", "country", "timestamp", "device", "browser", "os", "source",
+)
+
+
+def generate_day(site_pk, site_index, day, base, opts):
+    """Rows (in COLUMNS order) for one site and day. The RNG is seeded from (seed, site, day),
+    so the output does not depend on how days are spread over workers.
+    """
+    rng = random.Random(f"{opts['seed']}:{site_index}:{day}")
+    weekly = opts["distribution"] == "weekly"
+    day_dt = base - timedelta(days=day)
+    low, high = opts["sessions"]
+    sessions_today = rng.randint(low, high)
+    if weekly:
+        sessions_today = round(sessions_today * WEEKDAY_FACTOR[day_dt.weekday()])
+
+    rows = []
+    for _ in range(sessions_today):
+        session_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        ua, sw, sh = rng.choice(devices)
+        src = rng.choices(utm_sources, SOURCE_WEIGHTS)[0] if weekly else rng.choice(utm_sources)
+        ref = rng.choice(referrers) or None
+        country = rng.choice(countries)
+        device, browser, os_name = classify_user_agent(ua)
+        source = source_key(src, ref)
+
+        # each session has 1-5 pageviews spread across the day
+        pageviews = rng.randint(1, 5)
+        if weekly:
+            start = day_dt.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(
+                hours=rng.choices(range(24), HOUR_WEIGHTS)[0], minutes=rng.randint(0, 59))
+        else:
+            start = day_dt - timedelta(minutes=rng.randint(0, 1200))
+        for j in range(pageviews):
+            if weekly:
+                timestamp = start + timedelta(minutes=j * rng.randint(1, 30))
+                url = rng.choices(url_pool, URL_WEIGHTS)[0]
+            else:
+                timestamp = start - timedelta(minutes=j * rng.randint(1, 30))
+                url = rng.choice(url_pool)
+            rows.append((
+                site_pk, "pageview", url, ref, src, ua, "en-US", sw, sh, session_id, "127.0.0.1", country,
+                timestamp, device, browser, os_name, source,
+            ))
+    return rows
+
+
+def write_rows(rows, method, chunk_size):
+    if method == "copy":
+        copy_rows(rows)
+    else:
+        Event.objects.bulk_create((Event(**dict(zip(COLUMNS, row))) for row in rows), batch_size=chunk_size)
+
+
+def copy_rows(rows):
+    """COPY rows into the Event table (PostgreSQL only); much faster than INSERT for big loads."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["" if v is None else v.isoformat() if isinstance(v, datetime) else v for v in row])
+    buf.seek(0)
+    columns = ", ".join(connection.ops.quote_name(c) for c in COLUMNS)
+    with connection.cursor() as cur:
+        cur.cursor.copy_expert(f"COPY {connection.ops.quote_name(Event._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def seed_task(task):
+    """Generate and write the days of one task; runs in the parent or in a worker process."""
+    site_pk, site_index, days, base, opts = task
+    written = 0
+    rows = []
+    for day in days:
+        rows.extend(generate_day(site_pk, site_index, day, base, opts))
+        if len(rows) >= opts["chunk_size"]:
+            write_rows(rows, opts["method"], opts["chunk_size"])
+            written += len(rows)
+            rows = []
+    if rows:
+        write_rows(rows, opts["method"], opts["chunk_size"])
+        written += len(rows)
+    return written
+
 
 class Command(BaseCommand):
-    help = "Seed dummy events for testing analytics"
+    help = "Seed dummy events for testing analytics (and synthetic datasets for benchmarks)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sites", type=int, default=1, help="number of demo sites to fill")
+        parser.add_argument("--days", type=int, default=60, help="days of history, ending today")
+        parser.add_argument("--sessions", default="15-40", help="sessions per site and day: N or MIN-MAX")
+        parser.add_argument("--distribution", choices=["uniform", "weekly"], default="uniform",
+                            help="uniform: flat picks; weekly: weekday/hour-of-day seasonality and Zipf page/source popularity")
+        parser.add_argument("--seed", type=int, help="makes runs reproducible (together with --end-date)")
+        parser.add_argument("--end-date", help="YYYY-MM-DD of the newest day (default: now)")
+        parser.add_argument("--workers", type=int, default=1, help="generate and write in this many processes (PostgreSQL)")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="rows per bulk_create / COPY")
+        parser.add_argument("--method", choices=["bulk", "copy"], default="bulk", help="copy uses PostgreSQL COPY")
+        parser.add_argument("--keep", action="store_true", help="keep the sites' existing events (and their rollups)")
+
+    def handle(self, *args, **opts):
+        try:
+            low, _, high = opts["sessions"].partition("-")
+            sessions = (int(low), int(high or low))
+        except ValueError:
+            raise CommandError("--sessions must be N or MIN-MAX")
+        if connection.vendor != "postgresql":
+            if opts["method"] == "copy":
+                raise CommandError("--method copy needs PostgreSQL")
+            if opts["workers"] > 1:
+                raise CommandError("--workers needs PostgreSQL (SQLite allows a single writer)")
+
+        if opts["end_date"]:
+            end = datetime.fromisoformat(opts["end_date"])
+            base = timezone.make_aware(end.replace(hour=23, minute=59)) if timezone.is_naive(end) else end
+        else:
+            base = timezone.now()
 
-    def handle(self, *args, **kwargs):
         # Create a test user
         user, _ = User.objects.get_or_create(username="demo")
         user.set_password("demo123")
         user.save()
 
-        # Create or get a demo site
-        site, created = Site.objects.get_or_create(
-            owner=user,
-            domain="example.com",
-            defaults={"site_id": str(uuid.uuid4())},
-        )
-
-        # Remove old events for a clean slate
-        Event.objects.filter(site=site).delete()
-
-        now = timezone.now()
-        countries = ["India", "USA", "Germany", "France", "Brazil", "UK", "Canada"]
-        utm_sources = ["google", "twitter", "facebook", "newsletter", "linkedin", None]
-        referrers = [
-            "https://google.com",
-            "https://twitter.com",
-            "https://facebook.com",
-            "https://news.example.com",
-            "",
-        ]
-        devices = [
-            # desktop
-            ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Safari/537.36", 1920, 1080),
-            ("Mozilla/5.0 (Macintosh; Intel Mac OS X 13_6_6) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Safari/605.1.15", 1440, 900),
-            # mobile
-            ("Mozilla/5.0 (Linux; Android 14; Pixel 7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Mobile Safari/537.36", 390, 844),
-            ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Mobile/15E148 Safari/604.1", 414, 896),
-            # tablet
-            ("Mozilla/5.0 (iPad; CPU OS 16_7 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1", 1024, 1366),
-        ]
-        url_pool = [
-            "/",
-            "/page1",
-            "/page2",
-            "/landing/service-a",
-            "/landing/service-b",
-            "/blog/page1",
-            "/blog/page2",
-            "/docs/install",
-            "/docs/usage",
+        # Create or get the demo sites; the first keeps the original example.com site
+        sites = []
+        for i in range(opts["sites"]):
+            site, created = Site.objects.get_or_create(
+                owner=user,
+                domain="example.com" if i == 0 else f"site{i}.example.com",
+                defaults={"site_id": str(uuid.uuid4())},
+            )
+            sites.append(site)
+
+        if not opts["keep"]:
+            # Remove old events for a clean slate, in chunks so big demo sites don't lock the table
+            delete_in_chunks(Event.objects.filter(site__in=sites), opts["chunk_size"])
+            # and what was derived from them, or the rollup-backed and first-seen widgets would
+            # merge the old seed into the new one; rollup_events rebuilds it from the new events
+            for model in (DailyRollup, DailySketch, VisitorFirstSeen):
+                model.objects.filter(site__in=sites).delete()
+            for site in sites:
+                remove_site_files(site.pk)
+
+        task_opts = {
+            "seed": opts["seed"] if opts["seed"] is not None else random.randrange(2 ** 32),
+            "sessions": sessions,
+            "distribution": opts["distribution"],
+            "chunk_size": opts["chunk_size"],
+            "method": opts["method"],
+        }
+        # one task per site and week keeps tasks small enough to balance across workers
+        tasks = [
+            (site.pk, i, range(first, min(first + 7, opts["days"])), base, task_opts)
+            for i, site in enumerate(sites)
+            for first in range(0, opts["days"], 7)
         ]
 
-        # Generate data for the last 60 days
-        for day in range(60):
-            day_dt = now - timedelta(days=day)
-            # sessions per day
-            sessions_today = random.randint(15, 40)
-            for _ in range(sessions_today):
-                session_id = str(uuid.uuid4())
-                ua, sw, sh = random.choice(devices)
-                src = random.choice(utm_sources)
-                ref = random.choice(referrers)
-                country = random.choice(countries)
-
-                # each session has 1-5 pageviews spread across the day
-                pageviews = random.randint(1, 5)
-                start_min = random.randint(0, 1200)
-                for j in range(pageviews):
-                    timestamp = day_dt - timedelta(minutes=start_min + j * random.randint(1, 30))
-                    url = random.choice(url_pool)
-                    Event.objects.create(
-                        site=site,
-                        event_type="pageview",
-                        url=url,
-                        referrer=ref if ref else None,
-                        utm_source=src,
-                        user_agent=ua,
-                        language="en-US",
-                        screen_width=sw,
-                        screen_height=sh,
-                        session_id=session_id,
-                        ip_address="127.0.0.1",
-                        country=country,
-                        timestamp=timestamp,
-                    )
+        started = time.monotonic()
+        written = 0
+        if opts["workers"] > 1:
+            # forked workers must not share the parent's database connection
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(opts["workers"]) as pool:
+                for n in pool.imap_unordered(seed_task, tasks):
+                    written += n
+        else:
+            for task in tasks:
+                written += seed_task(task)
+        elapsed = time.monotonic() - started
+        for site in sites:
+            bump_generation(site.pk)  # the new history lands in closed days
 
         self.stdout.write(self.style.SUCCESS("✅ Dummy events created successfully!"))
-        self.stdout.write(self.style.SUCCESS(f"Site domain: {site.domain}"))
-        self.stdout.write(self.style.SUCCESS(f"Site ID: {site.site_id}"))
+        self.stdout.write(self.style.SUCCESS(f"{written} events in {elapsed:.1f}s ({written / max(elapsed, 1e-9):,.0f}/s), seed {task_opts['seed']}"))
+        for site in sites:
+            self.stdout.write(self.style.SUCCESS(f"Site domain: {site.domain}"))
+            self.stdout.write(self.style.SUCCESS(f"Site ID: {site.site_id}"))
+        self.stdout.write("Run `python manage.py rollup_events` to build rollups and first-seen rows for the new events.")
@@ -0,0 +1,197 @@
+"""Per-request timing and SQL instrumentation with in-process Prometheus-style metrics.
+
+QueryMetricsMiddleware wraps each sync request's database calls with a light execute wrapper
+(two perf_counter calls and a few additions per statement) and records, per view: wall
+time, statement count, SQL time, rows fetched (as reported by the driver's rowcount;
+SQLite reports none for SELECTs) and the slowest statement. Requests slower than
+METRICS_QUERY_LOG_THRESHOLD_MS have their full query list logged for a
+METRICS_QUERY_LOG_SAMPLE_RATE fraction of them. Metrics are per process; scrape every
+worker, or run one.
+"""
+import logging
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labelnames=("view",)):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.series = {}  # label values -> [per-bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=("view",)):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in sorted(self.series.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class MaxGauge(Counter):
+    kind = "gauge"
+
+    def observe(self, labels, value):
+        if value > self.series.get(labels, 0):
+            self.series[labels] = value
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_seconds = Histogram("analytics_request_duration_seconds", "Wall time per request.", DURATION_BUCKETS)
+        self.queries = Histogram("analytics_request_queries", "SQL statements per request.", QUERY_BUCKETS)
+        self.sql_seconds = Histogram("analytics_request_sql_duration_seconds", "Total SQL time per request.", DURATION_BUCKETS)
+        self.rows = Counter("analytics_sql_rows_fetched_total", "Rows reported by the database driver.")
+        self.slowest = MaxGauge("analytics_slowest_query_seconds", "Slowest single statement seen since start.")
+        self.filtered = Counter("analytics_ingest_filtered_total", "Events dropped at ingest.", labelnames=("reason",))
+
+    def record(self, view, wall, stats=None):
+        """Observe one request; `stats` None (SQL not measured) leaves the SQL series alone."""
+        labels = (view,)
+        with self.lock:
+            self.request_seconds.observe(labels, wall)
+            if stats is None:
+                return
+            self.queries.observe(labels, stats.count)
+            self.sql_seconds.observe(labels, stats.sql_time)
+            self.rows.inc(labels, stats.rows)
+            self.slowest.observe(labels, stats.slowest_time)
+
+    def record_filtered(self, reasons):
+        with self.lock:
+            for reason in reasons:
+                self.filtered.inc((reason,))
+
+    def render(self):
+        with self.lock:
+            metrics = [self.request_seconds, self.queries, self.sql_seconds, self.rows, self.slowest, self.filtered]
+            return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+
+class QueryStats:
+    """execute_wrapper collecting the statements of one request."""
+
+    def __init__(self, keep_log):
+        self.count = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+        self.log = [] if keep_log else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.sql_time += elapsed
+            rowcount = getattr(context["cursor"], "rowcount", -1)
+            if rowcount and rowcount > 0:
+                self.rows += rowcount
+            if elapsed > self.slowest_time:
+                self.slowest_time, self.slowest_sql = elapsed, sql
+            if self.log is not None:
+                self.log.append((round(elapsed * 1000, 3), sql))
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    return (match.url_name or match.view_name) if match else "unmatched"
+
+
+class QueryMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        threshold = settings.METRICS_QUERY_LOG_THRESHOLD_MS
+        sample = threshold > 0 and random.random() < settings.METRICS_QUERY_LOG_SAMPLE_RATE
+        stats = QueryStats(keep_log=sample)
+        started = time.perf_counter()
+        with connection.execute_wrapper(stats):
+            response = self.get_response(request)
+        wall = time.perf_counter() - started
+        view = view_name(request)
+        registry.record(view, wall, stats)
+        if sample and wall * 1000 >= threshold:
+            logger.warning(
+                "slow request %s %s (%s): %.1f ms, %d queries, %.1f ms SQL, slowest %.1f ms: %s\n%s",
+                request.method, request.path, view, wall * 1000, stats.count, stats.sql_time * 1000,
+                stats.slowest_time * 1000, stats.slowest_sql,
+                "\n".join(f"  {ms} ms  {sql}" for ms, sql in stats.log),
+            )
+        return response
+
+    async def __acall__(self, request):
+        # under ASGI the ORM runs in sync_to_async threads, out of reach of an execute wrapper
+        # installed here, so async requests record wall time only (zeros would skew the SQL series)
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        registry.record(view_name(request), time.perf_counter() - started)
+        return response
@@ -1,10 +1,23 @@
 from django.db import models
 from django.contrib.auth.models import User
 
+from .caching import normalize_site_id
+
 class Site(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sites")
     site_id = models.CharField(max_length=100, unique=True)
     domain = models.CharField(max_length=255)
+    # IANA zone used for ?granularity= trend buckets
+    timezone = models.CharField(max_length=64, default="UTC")
+    # days of raw events kept by `manage.py purge_events` (None: EVENT_RETENTION_DAYS)
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # raw events before this were purged (older days live on in DailyRollup only)
+    purged_before = models.DateTimeField(null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        # lowercased like the ingest lookups (caching.normalize_site_id), so they hit the unique index
+        self.site_id = normalize_site_id(self.site_id)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.domain} ({self.site_id})"
@@ -24,6 +37,87 @@ class Event(models.Model):
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     country = models.CharField(max_length=100, null=True, blank=True)  # optional geo
     timestamp = models.DateTimeField()
+    # derived from user_agent at ingest (see classify.classify_user_agent)
+    device = models.CharField(max_length=10, null=True, blank=True)
+    browser = models.CharField(max_length=20, null=True, blank=True)
+    os = models.CharField(max_length=20, null=True, blank=True)
+    # normalized traffic source: lowercased utm_source, else referrer host, else "direct"
+    source = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # every analytics query filters by site and a timestamp window
+            models.Index(fields=["site", "timestamp"]),
+            models.Index(fields=["site", "session_id", "timestamp"]),
+            # text_pattern_ops (Postgres only) so the `posts` url prefix filter can use it too
+            models.Index(fields=["site", "url", "timestamp"], name="event_site_url_ts_idx", opclasses=["", "text_pattern_ops", ""]),
+            models.Index(fields=["site", "timestamp", "device"]),
+            models.Index(fields=["site", "timestamp", "browser"]),
+            models.Index(fields=["site", "source", "timestamp"]),
+        ]
 
     def __str__(self):
         return f"Event {self.event_type} @ {self.url} ({self.site_id if hasattr(self,'site') else ''})"
+
+class IngestQueueCheckpoint(models.Model):
+    # last spool row written to Event by drain_ingest_queue, updated in the same
+    # transaction as the insert so a crashed drain never replays rows twice
+    queue_id = models.CharField(max_length=36, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"IngestQueueCheckpoint {self.queue_id} @ {self.last_id}"
+
+class DailyRollup(models.Model):
+    # pre-aggregated daily counts per site and dimension, maintained by `manage.py rollup_events`
+    DIMENSIONS = ("url", "source", "device", "browser", "country", "sessions")
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name="rollups")
+    day = models.DateField()
+    dimension = models.CharField(max_length=20)
+    key = models.TextField(blank=True, default="")  # "" for the sessions count
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["site", "dimension", "day"])]
+
+    def __str__(self):
+        return f"{self.site_id} {self.day} {self.dimension}={self.key!r}: {self.count}"
+
+class RollupState(models.Model):
+    # watermark of the incremental rollup job: events with a larger id are not rolled up yet,
+    # and days that closed before covered_until are complete in DailyRollup
+    name = models.CharField(max_length=50, unique=True)
+    last_event_id = models.BigIntegerField(default=0)
+    covered_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"RollupState {self.name} @ {self.last_event_id}"
+
+class VisitorFirstSeen(models.Model):
+    # first event time per (site, session_id); inserted at ingest, corrected and backfilled by rollup_events
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name="visitors")
+    session_id = models.CharField(max_length=100)
+    first_seen = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["site", "session_id"], name="visitor_first_seen_unique")]
+        indexes = [models.Index(fields=["site", "first_seen"])]
+
+    def __str__(self):
+        return f"{self.session_id} first seen {self.first_seen}"
+
+class DailySketch(models.Model):
+    # HyperLogLog of the distinct session_ids per site and day (see hll.py), built by rollup_events
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name="sketches")
+    day = models.DateField()
+    precision = models.PositiveSmallIntegerField()
+    sketch = models.BinaryField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["site", "day"], name="daily_sketch_unique")]
+
+    def __str__(self):
+        return f"DailySketch {self.site_id} {self.day} (p={self.precision})"
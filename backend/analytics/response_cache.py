@@ -0,0 +1,123 @@
+"""Cache of computed analytics responses, keyed on (site, endpoint, normalized query).
+
+Every key also carries the site's current generation token. Ingest bumps the token when
+it writes events behind the ingest watermark (the start of today); the rollup job, the
+purge job and Site changes bump it too. Windows reaching into today only live for
+ANALYTICS_CACHE_LIVE_TTL seconds. Closed windows are kept until evicted only with the
+shared file backend: with a per-process backend a bump made by another worker, the ingest
+service or a management command never reaches this one, so they expire after
+ANALYTICS_CACHE_CLOSED_TTL seconds.
+"""
+import hashlib
+import threading
+import uuid
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+# params whose comma-separated values are a set, so their order doesn't change the answer
+LIST_PARAMS = {"services": str.lower, "posts": str, "widgets": str}
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+
+def cache():
+    return caches[settings.ANALYTICS_CACHE_ALIAS]
+
+
+def ingest_watermark():
+    """Events older than this land in a closed day."""
+    return timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _generation_key(site_pk):
+    return f"analytics:gen:{site_pk}"
+
+
+def generation(site_pk):
+    token = cache().get(_generation_key(site_pk))
+    if token is None:
+        token = bump_generation(site_pk)
+    return token
+
+
+def bump_generation(site_pk):
+    """Orphan every cached response of a site; they age out of the LRU."""
+    token = uuid.uuid4().hex
+    cache().set(_generation_key(site_pk), token, timeout=None)
+    return token
+
+
+def invalidate_for_events(events):
+    """Called after events are written: bump the sites that got events for a closed day."""
+    watermark = ingest_watermark()
+    for site_pk in {e.site_id for e in events if e.timestamp < watermark}:
+        bump_generation(site_pk)
+
+
+def normalize_params(params):
+    items = []
+    for name, values in params.lists():
+        for value in values:
+            value = value.strip()
+            if not value:
+                continue
+            if name in LIST_PARAMS:
+                parts = sorted({LIST_PARAMS[name](p.strip()) for p in value.split(",") if p.strip()})
+                value = ",".join(parts)
+            items.append((name, value))
+    return urlencode(sorted(items))
+
+
+def cache_key(site_pk, endpoint, params):
+    digest = hashlib.md5(normalize_params(params).encode()).hexdigest()
+    return f"analytics:{site_pk}:{generation(site_pk)}:{endpoint}:{digest}"
+
+
+def get_or_compute(site, endpoint, params, compute, until=None):
+    """Return the cached response for this query, or compute() and cache it.
+    `until` is the end of the requested window; None means the window includes now.
+    """
+    if not settings.ANALYTICS_CACHE_ENABLED:
+        return compute()
+    key = cache_key(site.pk, endpoint, params)
+    data = cache().get(key)
+    if data is not None:
+        _count("hits")
+        return data
+    _count("misses")
+    data = compute()
+    closed = until is not None and until < ingest_watermark()
+    cache().set(key, data, timeout=closed_ttl() if closed else settings.ANALYTICS_CACHE_LIVE_TTL)
+    return data
+
+
+def closed_ttl():
+    """Lifetime of a closed window's entry: unbounded only when invalidation is shared."""
+    return None if settings.ANALYTICS_CACHE_BACKEND == "file" else settings.ANALYTICS_CACHE_CLOSED_TTL
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    """Hit/miss counters of this process since start (or the last reset)."""
+    with _stats_lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+    total = hits + misses
+    return {
+        "backend": settings.ANALYTICS_CACHE_BACKEND,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.update(hits=0, misses=0)
@@ -0,0 +1,93 @@
+"""Retention of raw events (`manage.py purge_events`).
+
+Each site keeps `retention_days` of raw events (EVENT_RETENTION_DAYS when unset; 0 keeps
+everything). Expired whole days are first downsampled into DailyRollup/DailySketch with
+rollups.rebuild_day, then deleted in small id chunks, each its own short transaction.
+Site.purged_before records the horizon before the deletes start: the rollup job never
+rebuilds a day before it (that would overwrite the downsampled rows with whatever raw
+events are left), and a rerun after an interruption only finishes the deletes.
+"""
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Event
+from .rollups import day_start, rebuild_day
+
+
+def retention_days(site):
+    return site.retention_days if site.retention_days is not None else settings.EVENT_RETENTION_DAYS
+
+
+def cutoff_for(site, today=None):
+    """Start of the oldest local day that is kept, or None when the site keeps everything."""
+    days = retention_days(site)
+    if not days:
+        return None
+    return day_start((today or timezone.localdate()) - timedelta(days=days))
+
+
+def expired_days(site, cutoff):
+    """Days with raw events before `cutoff` that are not downsampled yet."""
+    qs = Event.objects.filter(site=site, timestamp__lt=cutoff)
+    if site.purged_before is not None:
+        qs = qs.filter(timestamp__gte=site.purged_before)
+    return sorted(set(qs.annotate(day=TruncDate("timestamp")).values_list("day", flat=True).distinct()))
+
+
+def delete_in_chunks(qs, chunk_size, sleep=0, progress=None):
+    """Delete the rows of an Event queryset `chunk_size` ids at a time, oldest id first,
+    sleeping `sleep` seconds between chunks. Returns the number of rows deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(qs.order_by("id").values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += Event.objects.filter(id__in=ids).delete()[0]
+        if progress:
+            progress(deleted)
+        if sleep:
+            time.sleep(sleep)
+
+
+def remove_day_files(site, cutoff):
+    """Delete the site's columnar day files before `cutoff`; they hold per-event rows too."""
+    folder = os.path.join(settings.COLUMNAR_PATH, str(site.pk))
+    if not os.path.isdir(folder):
+        return 0
+    last = timezone.localdate(cutoff).isoformat()
+    removed = 0
+    for name in os.listdir(folder):
+        if name.endswith(".npz") and name[:-4] < last:
+            os.remove(os.path.join(folder, name))
+            removed += 1
+    return removed
+
+
+def prepare_purge(site, cutoff, downsample=True):
+    """Downsample the site's raw days before `cutoff` and move its horizon there; run before
+    deleting those events (here, or by dropping an Event partition). Returns the days rebuilt."""
+    days = expired_days(site, cutoff) if downsample else []
+    for day in days:
+        rebuild_day(site.pk, day)
+    if site.purged_before is None or site.purged_before < cutoff:
+        site.purged_before = cutoff
+        # a save (not an update) so the signals drop cached Site rows and responses
+        site.save(update_fields=["purged_before"])
+    return len(days)
+
+
+def purge_site(site, chunk_size, sleep=0, downsample=True, progress=None):
+    """Downsample, then delete the site's expired raw events. Returns (days downsampled,
+    events deleted, day files removed); (0, 0, 0) when nothing has expired."""
+    cutoff = cutoff_for(site)
+    if cutoff is None:
+        return 0, 0, 0
+    days = prepare_purge(site, cutoff, downsample)
+    deleted = delete_in_chunks(Event.objects.filter(site=site, timestamp__lt=cutoff), chunk_size, sleep, progress)
+    return days, deleted, remove_day_files(site, cutoff)
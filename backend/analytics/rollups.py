@@ -0,0 +1,317 @@
+"""Daily pre-aggregated rollups feeding the dashboard breakdowns.
+
+`manage.py rollup_events` recomputes the (site, day) rollups touched by events newer
+than its watermark. Dashboard views read closed days from DailyRollup and only scan
+raw events for the partial days at the edges of the requested window.
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum, TextField, Value
+from django.db.models.functions import Coalesce, NullIf, TruncDate
+from django.utils import timezone
+
+from .hll import HyperLogLog
+from .models import DailyRollup, DailySketch, Event, RollupState, Site
+from .response_cache import bump_generation
+from .sql import ranked_page, upsert_first_seen
+
+STATE_NAME = "daily"
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def raw_counts(qs, dimension):
+    """Counts per key for one dimension over an Event queryset, grouped in the database."""
+    if dimension == "url":
+        rows = ((r["url"], r["c"]) for r in qs.values("url").annotate(c=Count("id")))
+    elif dimension == "country":
+        rows = ((r["country"] or "Unknown", r["c"]) for r in qs.values("country").annotate(c=Count("id")))
+    elif dimension == "source":
+        rows = ((r["source"] or "direct", r["c"]) for r in qs.values("source").annotate(c=Count("id")))
+    elif dimension == "device":
+        rows = ((r["device"] or "unknown", r["c"]) for r in qs.values("device").annotate(c=Count("id")))
+    elif dimension == "browser":
+        rows = ((r["browser"] or "other", r["c"]) for r in qs.values("browser").annotate(c=Count("id")))
+    elif dimension == "sessions":
+        rows = [("", qs.values("session_id").distinct().count())]
+    else:
+        raise ValueError(f"unknown rollup dimension: {dimension}")
+
+    counts = {}
+    for key, c in rows:
+        counts[key] = counts.get(key, 0) + c
+    return counts
+
+
+# fallback key raw_counts uses for empty values of each dimension
+BREAKDOWN_DEFAULTS = {"url": "", "source": "direct", "device": "unknown", "browser": "other", "country": "Unknown"}
+
+
+def window_breakdown(qs):
+    """({dimension: {key: count}}, [(day, views)]) for an Event queryset from one grouped
+    query, for windows the rollups can't answer (segment filters).
+    """
+    rows = (
+        qs.order_by()
+        .annotate(day=TruncDate("timestamp"))
+        .values("day", *BREAKDOWN_DEFAULTS)
+        .annotate(c=Count("id"))
+    )
+    counts = {dimension: {} for dimension in BREAKDOWN_DEFAULTS}
+    daily = {}
+    for r in rows.iterator():
+        daily[r["day"]] = daily.get(r["day"], 0) + r["c"]
+        for dimension, default in BREAKDOWN_DEFAULTS.items():
+            key = r[dimension] or default
+            counts[dimension][key] = counts[dimension].get(key, 0) + r["c"]
+    return counts, sorted(daily.items())
+
+
+def rebuild_day(site_pk, day):
+    """Recompute every dimension and the sessions sketch of one (site, day) from raw events."""
+    qs = Event.objects.filter(site_id=site_pk, timestamp__gte=day_start(day), timestamp__lt=day_start(day + timedelta(days=1)))
+    rows = [
+        DailyRollup(site_id=site_pk, day=day, dimension=dimension, key=key, count=c)
+        for dimension in DailyRollup.DIMENSIONS
+        for key, c in raw_counts(qs, dimension).items()
+        if c
+    ]
+    sessions = HyperLogLog(settings.HLL_PRECISION).update(
+        qs.order_by().values_list("session_id", flat=True).distinct().iterator()
+    )
+    with transaction.atomic():
+        DailyRollup.objects.filter(site_id=site_pk, day=day).delete()
+        DailyRollup.objects.bulk_create(rows, batch_size=1000)
+        DailySketch.objects.filter(site_id=site_pk, day=day).delete()
+        if rows:
+            DailySketch.objects.create(site_id=site_pk, day=day, precision=sessions.precision, sketch=sessions.to_bytes())
+    return len(rows)
+
+
+def run_rollup(rebuild=False):
+    """Roll up every (site, day) touched by events past the watermark.
+    Returns the number of (site, day) pairs recomputed.
+    """
+    state, _ = RollupState.objects.get_or_create(name=STATE_NAME)
+    started = timezone.now()
+    max_id = Event.objects.aggregate(m=Max("id"))["m"] or 0
+    # days whose raw events were purged only exist as rollups; never rebuild them
+    horizons = purge_horizons()
+    if rebuild:
+        kept = Q(pk__in=[])
+        for site_pk, first_day in horizons.items():
+            kept |= Q(site_id=site_pk, day__lt=first_day)
+        DailyRollup.objects.exclude(kept).delete()
+        DailySketch.objects.exclude(kept).delete()
+        low = 0
+    else:
+        # re-scan a few ids below the watermark to catch inserts that committed out of id order
+        low = max(state.last_event_id - settings.ROLLUP_WATERMARK_OVERLAP, 0)
+
+    touched = (
+        Event.objects.filter(id__gt=low, id__lte=max_id)
+        .annotate(day=TruncDate("timestamp"))
+        .values_list("site_id", "day")
+        .distinct()
+    )
+    pairs = sorted(
+        (site_pk, day) for site_pk, day in set(touched)
+        if site_pk not in horizons or day >= horizons[site_pk]
+    )
+    for site_pk, day in pairs:
+        rebuild_day(site_pk, day)
+
+    # backfill / correct first-seen times, in id chunks to keep each statement small
+    for chunk_low in range(low, max_id, settings.ROLLUP_FIRST_SEEN_CHUNK):
+        upsert_first_seen(chunk_low, min(chunk_low + settings.ROLLUP_FIRST_SEEN_CHUNK, max_id))
+
+    state.last_event_id = max(max_id, state.last_event_id)
+    state.covered_until = started
+    state.save()
+    # rebuilt sketches can change approximate answers already cached
+    for site_pk in {site_pk for site_pk, _ in pairs}:
+        bump_generation(site_pk)
+    return len(pairs)
+
+
+def purge_horizons():
+    """{site pk: first local day that still has raw events} for sites purge_events has purged."""
+    return {
+        pk: timezone.localdate(purged_before)
+        for pk, purged_before in Site.objects.exclude(purged_before=None).values_list("pk", "purged_before")
+    }
+
+
+def rollup_coverage():
+    state = RollupState.objects.filter(name=STATE_NAME).first()
+    return state.covered_until if state else None
+
+
+# `covered` default of the helpers below: read RollupState. Callers answering several
+# widgets at once (the dashboard) read it once and pass it instead.
+LOAD_COVERAGE = object()
+
+
+def split_window(since, until=None, covered=LOAD_COVERAGE):
+    """Split [since, until) into closed days answered from DailyRollup and raw edge ranges.
+    Returns ((first_day, end_day) or None, [(start, end_or_None), ...]).
+    """
+    return split_window_at(since, until, rollup_coverage() if covered is LOAD_COVERAGE else covered)
+
+
+def split_window_at(since, until, covered):
+    """split_window against an explicit coverage time (None: nothing is pre-aggregated)."""
+    if covered is None:
+        return None, [(since, until)]
+    limit = min(until, covered) if until else covered
+    first = timezone.localdate(since)
+    if day_start(first) < since:
+        first += timedelta(days=1)
+    end = timezone.localdate(limit)  # exclusive: the day containing `limit` is not complete
+    if first >= end:
+        return None, [(since, until)]
+    ranges = []
+    if since < day_start(first):
+        ranges.append((since, day_start(first)))
+    ranges.append((day_start(end), until))
+    return (first, end), ranges
+
+
+def _ranges_q(ranges):
+    cond = Q()
+    for start, end in ranges:
+        part = Q(timestamp__gte=start)
+        if end is not None:
+            part &= Q(timestamp__lt=end)
+        cond |= part
+    return cond
+
+
+def dimension_counts(site, dimension, since, until=None, covered=LOAD_COVERAGE):
+    """{key: count} for a dimension over the window, merging rollups and raw edge days."""
+    days, ranges = split_window(since, until, covered)
+    counts = {}
+    if days:
+        rolled = (
+            DailyRollup.objects.filter(site=site, dimension=dimension, day__gte=days[0], day__lt=days[1])
+            .values("key")
+            .annotate(c=Sum("count"))
+        )
+        for r in rolled:
+            counts[r["key"]] = r["c"]
+    raw = raw_counts(Event.objects.filter(site=site).filter(_ranges_q(ranges)), dimension)
+    for key, c in raw.items():
+        counts[key] = counts.get(key, 0) + c
+    return counts
+
+
+def merged_breakdown(site, since, until=None, covered=LOAD_COVERAGE):
+    """window_breakdown for a whole site, merging rollups and raw edge days: every
+    dimension and the daily views from two DailyRollup queries and one grouped raw pass.
+    """
+    days, ranges = split_window(since, until, covered)
+    counts, daily = window_breakdown(Event.objects.filter(site=site).filter(_ranges_q(ranges)))
+    daily = dict(daily)
+    if days:
+        rolled = DailyRollup.objects.filter(site=site, day__gte=days[0], day__lt=days[1])
+        for r in rolled.filter(dimension__in=BREAKDOWN_DEFAULTS).values("dimension", "key").annotate(c=Sum("count")):
+            keys = counts[r["dimension"]]
+            keys[r["key"]] = keys.get(r["key"], 0) + r["c"]
+        for r in rolled.filter(dimension="url").values("day").annotate(v=Sum("count")):
+            daily[r["day"]] = daily.get(r["day"], 0) + r["v"]
+    return counts, sorted(daily.items())
+
+
+def _ranked_result(rows, total, passing, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    # the "other" bucket: everything ranked after this page, including keys below min_count
+    other = total - rows[-1][2] if rows else total - passing
+    return [(key, count) for key, count, _ in rows], other, has_more
+
+
+def ranked_counts(site, dimension, since, until=None, limit=10, offset=0, after=None, min_count=1, covered=LOAD_COVERAGE):
+    """One page of a dimension's keys ranked by count, merged and sorted in the database.
+    Returns ([(key, count)], other, has_more); see sql.ranked_page for the paging arguments.
+    """
+    days, ranges = split_window(since, until, covered)
+    parts = []
+    if days:
+        parts.append(
+            DailyRollup.objects.filter(site=site, dimension=dimension, day__gte=days[0], day__lt=days[1])
+            .order_by()
+            .annotate(k=F("key"))
+            .values("k")
+            .annotate(c=Sum("count"))
+        )
+    # same empty-value fallbacks as raw_counts
+    key = Coalesce(NullIf(dimension, Value("")), Value(BREAKDOWN_DEFAULTS[dimension]), output_field=TextField())
+    parts.append(
+        Event.objects.filter(site=site).filter(_ranges_q(ranges))
+        .order_by()
+        .annotate(k=key)
+        .values("k")
+        .annotate(c=Count("id"))
+    )
+    return _ranked_result(*ranked_page(parts, limit, offset, after, min_count), limit)
+
+
+def rank_counts(counts, limit=10, offset=0, after=None, min_count=1):
+    """ranked_counts for {key: count} already in memory (columnar files, segment filters)."""
+    rows = []
+    running = 0
+    for key, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+        if count < min_count:
+            break
+        running += count
+        rows.append((key, count, running))
+    passing = running
+    if after is not None:
+        rows = [r for r in rows if r[1] < after[0] or (r[1] == after[0] and r[0] > after[1])]
+    return _ranked_result(rows[offset:offset + limit + 1], sum(counts.values()), passing, limit)
+
+
+def daily_views(site, since, until=None, covered=LOAD_COVERAGE):
+    """[(day, views)] over the window, merging rollups and raw edge days."""
+    days, ranges = split_window(since, until, covered)
+    trend = {}
+    if days:
+        rolled = (
+            DailyRollup.objects.filter(site=site, dimension="url", day__gte=days[0], day__lt=days[1])
+            .values("day")
+            .annotate(v=Sum("count"))
+        )
+        for r in rolled:
+            trend[r["day"]] = r["v"]
+    raw = (
+        Event.objects.filter(site=site)
+        .filter(_ranges_q(ranges))
+        .annotate(day=TruncDate("timestamp"))
+        .values("day")
+        .annotate(v=Count("id"))
+    )
+    for r in raw:
+        trend[r["day"]] = trend.get(r["day"], 0) + r["v"]
+    return sorted(trend.items())
+
+
+def approx_distinct_sessions(site, since, until=None, covered=LOAD_COVERAGE):
+    """HyperLogLog estimate of the distinct sessions in the window: the daily sketches of
+    closed days merged with the sessions of the raw edge days. Needs sketches built with
+    the current HLL_PRECISION (run `rollup_events --rebuild` after changing it).
+    """
+    days, ranges = split_window(since, until, covered)
+    sketch = HyperLogLog(settings.HLL_PRECISION)
+    if days:
+        stored = DailySketch.objects.filter(
+            site=site, day__gte=days[0], day__lt=days[1], precision=settings.HLL_PRECISION
+        ).values_list("sketch", flat=True)
+        for data in stored.iterator():
+            sketch.merge(HyperLogLog.from_bytes(data))
+    raw = Event.objects.filter(site=site).filter(_ranges_q(ranges)).order_by()
+    sketch.update(raw.values_list("session_id", flat=True).distinct().iterator())
+    return sketch.count()
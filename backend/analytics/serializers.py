@@ -24,15 +24,16 @@ class EventSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         raw_site_id = validated_data.pop("site_id", None)
-        site_id = (raw_site_id or "").strip()
-        from .models import Site
-        site = Site.objects.filter(site_id__iexact=site_id).first()
-        if not site:
+        from .caching import resolve_site_pk
+        site_pk = resolve_site_pk(raw_site_id)
+        if site_pk is None:
             raise serializers.ValidationError({"site_id": f"invalid site_id: {raw_site_id!r}"})
-        event = Event.objects.create(site=site, **validated_data)
+        from .ingest import enrich
+        event = enrich(Event(site_id=site_pk, **validated_data))
+        event.save()
         return event
 
 class SiteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Site
-        fields = ["id", "site_id", "domain"]
+        fields = ["id", "site_id", "domain", "timezone"]
@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import invalidate_site, invalidate_user
+from .models import Site
+from .response_cache import bump_generation
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def drop_cached_site(sender, instance, **kwargs):
+    # also clears a cached "unknown site" entry when the site is created
+    invalidate_site(instance.site_id)
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def drop_cached_responses(sender, instance, **kwargs):
+    # a reused pk must not see responses cached for the previous site
+    bump_generation(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    # deactivation and password changes must not wait for the auth cache TTL
+    invalidate_user(instance.pk)
@@ -0,0 +1,208 @@
+"""Raw SQL aggregations that the ORM can't express in a single grouped query.
+
+Inner queries are still built with the ORM and compiled; only the outer aggregation
+is hand-written, using the backend's own date helpers so the same code runs on
+Postgres and on the SQLite development database.
+"""
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+from django.db import connection
+from django.db.models import Max, Min
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def date_sql(expr):
+    """SQL (and params) casting a datetime expression to a date in the current time zone."""
+    return connection.ops.datetime_cast_date_sql(expr, (), timezone.get_current_timezone_name())
+
+
+def seconds_between_sql(start, end):
+    if connection.vendor == "postgresql":
+        return f"EXTRACT(EPOCH FROM ({end} - {start}))"
+    if connection.vendor == "sqlite":
+        return f"((julianday({end}) - julianday({start})) * 86400.0)"
+    raise NotImplementedError(f"unsupported database vendor: {connection.vendor}")
+
+
+def as_date(value):
+    # SQLite hands dates back as strings
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def session_stats(qs):
+    """Per-day session starts and total session duration for an Event queryset, in one query.
+    Sessions are grouped in a subquery, so memory stays flat however many sessions the
+    window holds. Returns [(day, sessions, total_duration_seconds)] ordered by day.
+    """
+    per_session = (
+        qs.order_by()
+        .values("session_id")
+        .annotate(session_start=Min("timestamp"), session_end=Max("timestamp"))
+    )
+    inner_sql, inner_params = per_session.query.sql_with_params()
+    qn = connection.ops.quote_name
+    start, end = f"s.{qn('session_start')}", f"s.{qn('session_end')}"
+    day, day_params = date_sql(start)
+    duration = seconds_between_sql(start, end)
+    sql = (
+        f"SELECT {day} AS day, COUNT(*), COALESCE(SUM({duration}), 0) "
+        f"FROM ({inner_sql}) s GROUP BY 1 ORDER BY 1"
+    )
+    with connection.cursor() as cur:
+        cur.execute(sql, (*day_params, *inner_params))
+        return [(as_date(d), n, float(total)) for d, n, total in cur.fetchall()]
+
+
+def upsert_first_seen(low_id, high_id):
+    """Fold MIN(timestamp) per (site, session) of events with low_id < id <= high_id into
+    VisitorFirstSeen, keeping the earlier time when a row already exists.
+    """
+    from .models import Event, VisitorFirstSeen
+
+    firsts = (
+        Event.objects.filter(id__gt=low_id, id__lte=high_id)
+        .order_by()
+        .values("site_id", "session_id")
+        .annotate(first=Min("timestamp"))
+    )
+    select_sql, params = firsts.query.sql_with_params()
+    qn = connection.ops.quote_name
+    table = qn(VisitorFirstSeen._meta.db_table)
+    least = "LEAST" if connection.vendor == "postgresql" else "MIN"
+    sql = (
+        f"INSERT INTO {table} ({qn('site_id')}, {qn('session_id')}, {qn('first_seen')}) {select_sql} "
+        f"ON CONFLICT ({qn('site_id')}, {qn('session_id')}) DO UPDATE "
+        f"SET {qn('first_seen')} = {least}({table}.{qn('first_seen')}, excluded.{qn('first_seen')})"
+    )
+    with connection.cursor() as cur:
+        cur.execute(sql, params)
+
+
+def new_vs_returning(qs, site_pk, since):
+    """Split the sessions active in an Event queryset into new (first seen at or after
+    `since`, or not recorded yet) and returning, by joining VisitorFirstSeen.
+    Returns ((new, returning), [(day, new, returning)]).
+    """
+    from .models import VisitorFirstSeen
+
+    qn = connection.ops.quote_name
+    table = qn(VisitorFirstSeen._meta.db_table)
+    since_param = connection.ops.adapt_datetimefield_value(since)
+    is_new = f"(f.{qn('first_seen')} IS NULL OR f.{qn('first_seen')} >= %s)"
+    join = f"LEFT JOIN {table} f ON f.{qn('site_id')} = %s AND f.{qn('session_id')} = w.{qn('session_id')}"
+
+    sessions_sql, sessions_params = qs.order_by().values("session_id").distinct().query.sql_with_params()
+    daily_sql, daily_params = (
+        qs.order_by().annotate(day=TruncDate("timestamp")).values("day", "session_id").distinct().query.sql_with_params()
+    )
+    with connection.cursor() as cur:
+        cur.execute(
+            f"SELECT COALESCE(SUM(CASE WHEN {is_new} THEN 1 ELSE 0 END), 0), "
+            f"COALESCE(SUM(CASE WHEN {is_new} THEN 0 ELSE 1 END), 0) "
+            f"FROM ({sessions_sql}) w {join}",
+            (since_param, since_param, *sessions_params, site_pk),
+        )
+        totals = tuple(cur.fetchone())
+        cur.execute(
+            f"SELECT w.{qn('day')}, SUM(CASE WHEN {is_new} THEN 1 ELSE 0 END), "
+            f"SUM(CASE WHEN {is_new} THEN 0 ELSE 1 END) "
+            f"FROM ({daily_sql}) w {join} GROUP BY w.{qn('day')} ORDER BY w.{qn('day')}",
+            (since_param, since_param, *daily_params, site_pk),
+        )
+        daily = [(as_date(d), n, r) for d, n, r in cur.fetchall()]
+    return totals, daily
+
+
+def ranked_page(parts, limit, offset=0, after=None, min_count=1):
+    """Rank keys by count over the union of (k, c) querysets, entirely in the database.
+
+    `parts` are ORM querysets selecting a key column `k` and a partial count `c`; rows of
+    the same key are summed. Returns (rows, total, passing): up to `limit` + 1 keys with at
+    least `min_count` as [(key, count, running total through this key)], ranked by count
+    desc then key and starting after `offset` rows or after the keyset `after` = (count, key);
+    the grand total; and the total of the keys with at least `min_count`.
+    """
+    union_sql, union_params = [], []
+    for qs in parts:
+        part_sql, part_params = qs.query.sql_with_params()
+        union_sql.append(f"SELECT * FROM ({part_sql}) p{len(union_sql)}")
+        union_params.extend(part_params)
+    qn = connection.ops.quote_name
+    k, c = qn("k"), qn("c")
+    page_where = f"{c} >= %s"
+    page_params = [min_count]
+    if after is not None:
+        page_where += f" AND ({c} < %s OR ({c} = %s AND {k} > %s))"
+        page_params += [after[0], after[0], after[1]]
+    sql = (
+        f"WITH g AS (SELECT {k}, SUM({c}) AS {c} FROM ({' UNION ALL '.join(union_sql)}) u GROUP BY {k}) "
+        f"SELECT p.{k}, p.{c}, p.upto, t.total, t.passing FROM ("
+        f"SELECT COALESCE(SUM({c}), 0) AS total, COALESCE(SUM(CASE WHEN {c} >= %s THEN {c} ELSE 0 END), 0) AS passing FROM g"
+        f") t LEFT JOIN ("
+        f"SELECT {k}, {c}, upto FROM (SELECT {k}, {c}, SUM({c}) OVER (ORDER BY {c} DESC, {k} ROWS UNBOUNDED PRECEDING) AS upto FROM g) r "
+        f"WHERE {page_where} ORDER BY {c} DESC, {k} LIMIT %s OFFSET %s"
+        f") p ON 1 = 1 ORDER BY p.{c} DESC, p.{k}"
+    )
+    with connection.cursor() as cur:
+        cur.execute(sql, (*union_params, min_count, *page_params, limit + 1, offset))
+        rows = cur.fetchall()
+    # Postgres sums bigints into numerics
+    total, passing = int(rows[0][3]), int(rows[0][4])
+    return [(key, int(count), int(upto)) for key, count, upto, _, _ in rows if count is not None], total, passing
+
+
+# bucket widths in seconds; weeks start on Monday like TruncWeek
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400}
+WEEK_ORIGIN = 4 * 86400  # 1970-01-05 was a Monday
+
+
+def local_epoch(value, tzname):
+    """Seconds from 1970-01-01 00:00 to `value` read on the wall clock of `tzname`."""
+    local = timezone.localtime(value, ZoneInfo(tzname)).replace(tzinfo=None)
+    return int((local - datetime(1970, 1, 1)).total_seconds())
+
+
+def bucket_of(epoch, width, origin=0):
+    return origin + (epoch - origin) // width * width
+
+
+def bucket_sql(expr, tzname, width, origin):
+    """SQL for the local_epoch bucket of a datetime column: the start of its `width`-second bucket."""
+    trunc, params = connection.ops.datetime_trunc_sql("minute", expr, (), tzname)
+    if connection.vendor == "postgresql":
+        epoch = f"EXTRACT(EPOCH FROM {trunc})"
+        return f"(FLOOR(({epoch} - {origin}) / {width}) * {width} + {origin})::bigint", params
+    if connection.vendor == "sqlite":
+        # integer division floors here since local epochs are positive
+        epoch = f"CAST(strftime('%%s', {trunc}) AS INTEGER)"
+        return f"(({epoch} - {origin}) / {width} * {width} + {origin})", params
+    raise NotImplementedError(f"unsupported database vendor: {connection.vendor}")
+
+
+def dense_buckets(qs, column, since, until, tzname, width, origin=0):
+    """Rows of an ORM queryset counted per bucket of `column`, for every bucket between
+    `since` and `until` in `tzname`, empty ones included: [(bucket local epoch, count)].
+    The bucket series comes from generate_series on Postgres and a recursive CTE on SQLite,
+    so gaps are filled by the LEFT JOIN rather than in Python.
+    """
+    inner_sql, inner_params = qs.order_by().values(column).query.sql_with_params()
+    qn = connection.ops.quote_name
+    bucket, bucket_params = bucket_sql(f"t.{qn(column)}", tzname, width, origin)
+    counts = f"SELECT {bucket} AS b, COUNT(*) AS n FROM ({inner_sql}) t GROUP BY 1"
+    first = bucket_of(local_epoch(since, tzname), width, origin)
+    last = bucket_of(local_epoch(until, tzname), width, origin)
+    if connection.vendor == "postgresql":
+        series = "generate_series(%s::bigint, %s::bigint, %s::bigint) AS s(b)"
+        series_params = (first, last, width)
+        sql = f"SELECT s.b, COALESCE(c.n, 0) FROM {series} LEFT JOIN ({counts}) c ON c.b = s.b ORDER BY s.b"
+    else:
+        series_params = (first, width, width, last)
+        sql = (
+            "WITH RECURSIVE s(b) AS (SELECT %s UNION ALL SELECT b + %s FROM s WHERE b + %s <= %s) "
+            f"SELECT s.b, COALESCE(c.n, 0) FROM s LEFT JOIN ({counts}) c ON c.b = s.b ORDER BY s.b"
+        )
+    with connection.cursor() as cur:
+        cur.execute(sql, (*series_params, *bucket_params, *inner_params))
+        return [(int(b), n) for b, n in cur.fetchall()]
@@ -1,3 +1,1214 @@
-from django.test import TestCase
+import gzip
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
 
-# Create your tests here.
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import columnar
+from .ingest import enrich
+from .models import Event, Site
+
+
+class TrackBatchTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+
+    def test_json_array_accepts_valid_and_rejects_bad_rows(self):
+        body = [
+            {"site_id": "site-a", "url": "/", "session_id": "s1"},
+            {"site_id": "missing", "url": "/", "session_id": "s2"},
+            {"site_id": "SITE-A", "url": "/about", "session_id": "s1", "timestamp": "2025-01-01T10:00:00Z"},
+            {"site_id": "site-a", "session_id": "s3"},
+        ]
+        res = self.client.post("/track/batch/", data=json.dumps(body), content_type="text/plain")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["accepted"], 2)
+        self.assertEqual([r["status"] for r in res.data["results"]], ["accepted", "rejected", "accepted", "rejected"])
+        self.assertIn("site_id", res.data["results"][1]["errors"])
+        self.assertIn("url", res.data["results"][3]["errors"])
+        self.assertEqual(Event.objects.filter(site=self.site).count(), 2)
+
+    def test_ndjson_body(self):
+        lines = "\n".join(json.dumps({"site_id": "site-a", "url": f"/p{i}", "session_id": "s1"}) for i in range(3))
+        res = self.client.post("/track/batch/", data=lines, content_type="application/x-ndjson")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["accepted"], 3)
+        self.assertEqual(Event.objects.count(), 3)
+
+    def test_invalid_body(self):
+        res = self.client.post("/track/batch/", data="{not json", content_type="text/plain")
+        self.assertEqual(res.status_code, 400)
+
+    def test_single_event_as_form_data(self):
+        from urllib.parse import urlencode
+
+        body = urlencode({"site_id": "site-a", "url": "/form", "session_id": "s1", "timestamp": "2025-01-01T10:00:00Z"})
+        res = self.client.post("/track/", data=body, content_type="application/x-www-form-urlencoded")
+        self.assertEqual(res.status_code, 201)
+        event = Event.objects.get()
+        self.assertEqual((event.url, event.session_id, event.timestamp.year), ("/form", "s1", 2025))
+
+
+class WriteBehindQueueTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=owner, site_id="site-a", domain="a.example.com")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.client = APIClient()
+
+    def test_track_queues_then_drain_writes_once(self):
+        from .ingest import drain_queue
+
+        with override_settings(INGEST_MODE="queue", INGEST_QUEUE_PATH=f"{self.tmp.name}/q.sqlite3"):
+            for i in range(5):
+                res = self.client.post("/track/", {"site_id": "site-a", "url": f"/p{i}", "session_id": "s1"}, format="json")
+                self.assertEqual(res.status_code, 202)
+            self.assertEqual(Event.objects.count(), 0)
+
+            self.assertEqual(drain_queue(3), 3)
+            self.assertEqual(drain_queue(3), 2)
+            self.assertEqual(drain_queue(3), 0)
+            self.assertEqual(Event.objects.count(), 5)
+
+    def test_deleted_site_does_not_block_the_spool(self):
+        from . import ingest_queue
+        from .ingest import drain_queue
+        from .metrics import registry
+
+        before = registry.filtered.series.get(("deleted_site",), 0)
+        other = Site.objects.create(owner=self.site.owner, site_id="site-b", domain="b.example.com")
+        with override_settings(INGEST_MODE="queue", INGEST_QUEUE_PATH=f"{self.tmp.name}/q.sqlite3"):
+            for site_id in ("site-a", "site-b", "site-a"):
+                self.client.post("/track/", {"site_id": site_id, "url": "/", "session_id": "s1"}, format="json")
+            other.delete()
+            with self.assertLogs("analytics.ingest", "WARNING"):
+                self.assertEqual(drain_queue(10), 2)
+            self.assertEqual(ingest_queue.depth(), 0)
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(registry.filtered.series[("deleted_site",)], before + 1)
+
+    def test_backpressure_returns_503(self):
+        with override_settings(INGEST_MODE="queue", INGEST_QUEUE_PATH=f"{self.tmp.name}/q.sqlite3", INGEST_QUEUE_MAX_DEPTH=1):
+            payload = {"site_id": "site-a", "url": "/", "session_id": "s1"}
+            self.assertEqual(self.client.post("/track/", payload, format="json").status_code, 202)
+            res = self.client.post("/track/", payload, format="json")
+            self.assertEqual(res.status_code, 503)
+            self.assertIn("Retry-After", res)
+
+
+class IngestFilterTests(TestCase):
+    def setUp(self):
+        from . import ingest_filters
+
+        ingest_filters.reset()
+        owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+
+    def test_bots_are_counted_not_stored(self):
+        from .metrics import registry
+
+        before = registry.filtered.series.get(("bot",), 0)
+        for ua in ("Mozilla/5.0 (compatible; Googlebot/2.1)", "curl/8.4.0", "Mozilla/5.0 HeadlessChrome/125.0"):
+            res = self.client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1", "user_agent": ua}, format="json")
+            self.assertEqual((res.status_code, res.data), (202, {"status": "filtered", "reason": "bot"}))
+        self.assertFalse(Event.objects.exists())
+        self.assertEqual(registry.filtered.series[("bot",)], before + 3)
+        res = self.client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1", "user_agent": "Mozilla/5.0 Chrome/125.0"}, format="json")
+        self.assertEqual(res.status_code, 201)
+
+    @override_settings(TRACK_DENY_IPS="10.0.0.0/8, 192.0.2.1", TRACK_DENY_USER_AGENTS="LoadTester")
+    def test_denylist(self):
+        payload = {"site_id": "site-a", "url": "/", "session_id": "s1"}
+        self.assertEqual(self.client.post("/track/", payload, format="json", REMOTE_ADDR="10.1.2.3").data["reason"], "denylist")
+        self.assertEqual(self.client.post("/track/", {**payload, "user_agent": "loadtester/1"}, format="json").data["reason"], "denylist")
+        self.assertEqual(self.client.post("/track/", {**payload, "ip_address": "192.0.2.1"}, format="json").data["reason"], "denylist")
+        # X-Forwarded-For is ignored unless the proxy is trusted
+        self.assertEqual(self.client.post("/track/", payload, format="json", HTTP_X_FORWARDED_FOR="10.0.0.1").status_code, 201)
+        with override_settings(TRACK_TRUST_X_FORWARDED_FOR=True):
+            res = self.client.post("/track/", payload, format="json", HTTP_X_FORWARDED_FOR="10.0.0.1, 203.0.113.5")
+            self.assertEqual(res.data["reason"], "denylist")
+        self.assertEqual(Event.objects.count(), 1)
+
+    def test_duplicate_beacons_in_a_batch(self):
+        beacon = {"site_id": "site-a", "url": "/", "session_id": "s1", "timestamp": "2025-01-01T10:00:00.250Z"}
+        body = [beacon, beacon, {**beacon, "url": "/other"}, {**beacon, "timestamp": "2025-01-01T10:05:00Z"}, {"site_id": "missing"}]
+        res = self.client.post("/track/batch/", data=json.dumps(body), content_type="text/plain")
+        self.assertEqual((res.data["accepted"], res.data["filtered"], res.data["rejected"]), (3, 1, 1))
+        self.assertEqual(res.data["results"][1], {"index": 1, "status": "filtered", "reason": "duplicate"})
+        # server-stamped events are never treated as duplicates
+        for _ in range(2):
+            self.client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1"}, format="json")
+        self.assertEqual(Event.objects.count(), 5)
+
+    def test_retry_after_503_is_stored(self):
+        from .ingest import drain_queue
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        first = {"site_id": "site-a", "url": "/", "session_id": "s1", "timestamp": "2025-01-01T10:00:00Z"}
+        retried = {**first, "url": "/next"}
+        with override_settings(INGEST_MODE="queue", INGEST_QUEUE_PATH=f"{tmp.name}/q.sqlite3", INGEST_QUEUE_MAX_DEPTH=1):
+            self.assertEqual(self.client.post("/track/", first, format="json").status_code, 202)
+            self.assertEqual(self.client.post("/track/", retried, format="json").status_code, 503)
+            drain_queue(10)
+            res = self.client.post("/track/", retried, format="json")
+            self.assertEqual((res.status_code, res.data), (202, {"status": "queued"}))
+            drain_queue(10)
+        self.assertEqual(sorted(Event.objects.values_list("url", flat=True)), ["/", "/next"])
+
+
+class SiteCacheTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+
+    def test_warm_ingest_does_not_query_site(self):
+        payload = {"site_id": "site-a", "url": "/", "session_id": "s1"}
+        self.client.post("/track/", payload, format="json")
+        with self.assertNumQueries(1):  # just the insert
+            res = self.client.post("/track/", payload, format="json")
+        self.assertEqual(res.status_code, 201)
+
+    def test_unknown_site_is_cached_until_created(self):
+        from .caching import resolve_site_pk
+
+        self.assertIsNone(resolve_site_pk("site-b"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(resolve_site_pk("site-b"))
+        site = Site.objects.create(owner=self.owner, site_id="site-b", domain="b.example.com")
+        self.assertEqual(resolve_site_pk(" SITE-B "), site.pk)
+        site.delete()
+        self.assertIsNone(resolve_site_pk("site-b"))
+
+    def test_mixed_case_site_ids(self):
+        from .caching import owned_site_cache, resolve_site_pks, site_cache
+
+        self.addCleanup(site_cache.clear)
+        self.addCleanup(owned_site_cache.clear)
+        self.assertEqual(Site.objects.create(owner=self.owner, site_id="Site-B", domain="b.example.com").site_id, "site-b")
+        # rows saved with other casing (before save lowercased them, or by update()) still resolve
+        Site.objects.filter(site_id="site-b").update(site_id="Site-B")
+        Site.objects.filter(site_id="site-a").update(site_id="SITE-A")
+        site_b = Site.objects.get(site_id="Site-B")
+        self.assertEqual(resolve_site_pks(["site-a", "site-b", "site-c"]), {"site-a": self.site.pk, "site-b": site_b.pk, "site-c": None})
+        res = self.client.post("/track/", {"site_id": "site-b", "url": "/", "session_id": "s1"}, format="json")
+        self.assertEqual(res.status_code, 201)
+        self.client.force_authenticate(self.owner)
+        self.assertEqual(self.client.get("/api/analytics/kpis/site-b/").status_code, 200)
+
+
+class RollupTests(TestCase):
+    ENDPOINTS = ["pages", "sources", "devices", "browsers", "geography"]
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        agents = [
+            "Mozilla/5.0 (Windows NT 10.0) Chrome/125.0 Safari/537.36",
+            "Mozilla/5.0 (iPhone) Version/17.5 Mobile/15E148 Safari/604.1",
+            "Googlebot/2.1",
+        ]
+        Event.objects.bulk_create(
+            enrich(Event(
+                site=self.site, url=f"/p{i % 4}", session_id=f"s{i % 7}", user_agent=agents[i % 3],
+                utm_source="Google" if i % 5 == 0 else None, referrer="https://news.example.com/x" if i % 2 else None,
+                country="India" if i % 3 else None, timestamp=now - timedelta(hours=7 * i),
+            ))
+            for i in range(60)
+        )
+
+    def fetch_all(self):
+        return {name: self.client.get(f"/api/analytics/{name}/site-a/?days=30").data for name in self.ENDPOINTS}
+
+    def test_rollups_match_raw_scan(self):
+        from .rollups import run_rollup
+
+        raw = self.fetch_all()
+        self.assertGreater(run_rollup(), 0)
+        self.assertEqual(self.fetch_all(), raw)
+
+    @override_settings(ROLLUP_WATERMARK_OVERLAP=0)
+    def test_incremental_run_picks_up_late_events(self):
+        from .models import DailyRollup
+        from .rollups import run_rollup
+
+        run_rollup()
+        Event.objects.create(site=self.site, url="/late", session_id="late", timestamp=timezone.now() - timedelta(days=3))
+        self.assertEqual(run_rollup(), 1)
+        self.assertTrue(DailyRollup.objects.filter(site=self.site, dimension="url", key="/late").exists())
+        raw = self.fetch_all()
+        run_rollup(rebuild=True)
+        self.assertEqual(self.fetch_all(), raw)
+
+
+class BreakdownPagingTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        # /u{n} gets n views; spread over days so rollups and raw edges both contribute
+        Event.objects.bulk_create(
+            Event(site=self.site, url=f"/u{n}", session_id="s", timestamp=now - timedelta(hours=9 * i))
+            for n in range(1, 9)
+            for i in range(n)
+        )
+
+    def test_sql_ranking_pages_and_other_bucket(self):
+        from .rollups import rank_counts, ranked_counts, run_rollup
+
+        since = timezone.now() - timedelta(days=30)
+        run_rollup()
+        Event.objects.create(site=self.site, url="/u1", session_id="s", timestamp=timezone.now())
+        counts = {f"/u{n}": n for n in range(2, 9)} | {"/u1": 2}
+        for args in [{}, {"limit": 3}, {"limit": 3, "offset": 3}, {"limit": 2, "min_count": 5}, {"limit": 4, "after": (5, "/u5")}]:
+            self.assertEqual(ranked_counts(self.site, "url", since, **args), rank_counts(counts, **args))
+        self.assertEqual(ranked_counts(self.site, "url", since, limit=3), ([("/u8", 8), ("/u7", 7), ("/u6", 6)], 16, True))
+
+        res = self.client.get("/api/analytics/pages/site-a/?limit=3")
+        self.assertEqual([p["views"] for p in res.data["top_pages"]], [8, 7, 6])
+        self.assertEqual(res.data["other_views"], 16)
+        res = self.client.get(f"/api/analytics/pages/site-a/?limit=3&cursor={res.data['next_cursor']}")
+        self.assertEqual([p["url"] for p in res.data["top_pages"]], ["/u5", "/u4", "/u3"])
+
+    def test_list_breakdown_cursor_header(self):
+        Event.objects.bulk_create(
+            Event(site=self.site, url="/", session_id="s", country=f"C{n}", timestamp=timezone.now())
+            for n in range(1, 6)
+            for _ in range(n)
+        )
+        res = self.client.get("/api/analytics/geography/site-a/?limit=2&min_count=2")
+        self.assertEqual(res.data, [
+            {"country": "Unknown", "count": 36},
+            {"country": "C5", "count": 5},
+            {"country": "Other", "count": 10, "other": True},
+        ])
+        res = self.client.get(f"/api/analytics/geography/site-a/?limit=2&min_count=2&cursor={res['X-Next-Cursor']}")
+        self.assertEqual([r["count"] for r in res.data], [4, 3, 3])
+        res = self.client.get(f"/api/analytics/geography/site-a/?limit=2&min_count=2&cursor={res['X-Next-Cursor']}")
+        # the last page: C1 is below min_count and only shows up in "Other"
+        self.assertEqual(res.data, [{"country": "C2", "count": 2}, {"country": "Other", "count": 1, "other": True}])
+        self.assertNotIn("X-Next-Cursor", res)
+
+
+class TrendGranularityTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com", timezone="Asia/Kolkata")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_dense_hourly_buckets_in_site_timezone(self):
+        now = timezone.now()
+        Event.objects.bulk_create([
+            Event(site=self.site, url="/", session_id="a", timestamp=now - timedelta(minutes=5)),
+            Event(site=self.site, url="/", session_id="a", timestamp=now - timedelta(minutes=1)),
+            Event(site=self.site, url="/", session_id="b", timestamp=now - timedelta(hours=20)),
+        ])
+        trend = self.client.get("/api/analytics/pages/site-a/?days=1&granularity=hour").data["trend"]
+        self.assertIn(len(trend), (24, 25))
+        self.assertEqual(sum(p["views"] for p in trend), 3)
+        hour_start = timezone.localtime(now, trend[-1]["date"].tzinfo).replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(trend[-1]["date"], hour_start)
+        self.assertEqual(trend[-1]["views"], sum(1 for m in (5, 1) if now - timedelta(minutes=m) >= hour_start))
+        first = trend[0]["date"]
+        # buckets start on the hour of the site's wall clock (UTC+05:30)
+        self.assertEqual((first.utcoffset(), first.minute), (timedelta(hours=5, minutes=30), 0))
+        self.assertEqual(trend[1]["date"] - first, timedelta(hours=1))
+
+        sessions = self.client.get("/api/analytics/sessions/site-a/?days=1&granularity=minute&interval=15").data
+        self.assertIn(len(sessions["trend"]), (96, 97))
+        self.assertEqual(sum(p["sessions"] for p in sessions["trend"]), 2)
+        self.assertEqual(sessions["session_count"], 2)
+
+    def test_bad_granularity(self):
+        self.assertEqual(self.client.get("/api/analytics/pages/site-a/?granularity=year").status_code, 400)
+        self.assertEqual(self.client.get("/api/analytics/pages/site-a/?days=90&granularity=minute").status_code, 400)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com", retention_days=10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        Event.objects.bulk_create(
+            Event(site=self.site, url=f"/p{i % 3}", session_id=f"s{i}", timestamp=now - timedelta(days=days, minutes=i))
+            for days in (20, 15, 12, 2)
+            for i in range(3)
+        )
+
+    def views(self):
+        return sum(p["views"] for p in self.client.get("/api/analytics/pages/site-a/?days=30").data["trend"])
+
+    def test_dry_run_then_purge_keeps_trends(self):
+        from django.core.management import call_command
+
+        from .models import DailyRollup
+        from .rollups import run_rollup
+
+        out = io.StringIO()
+        call_command("purge_events", "--dry-run", "--chunk-size", "4", stdout=out)
+        self.assertIn("site-a: keep 10 days", out.getvalue())
+        self.assertIn("9 events to delete in 3 chunks, 3 days to downsample", out.getvalue())
+        self.assertEqual(Event.objects.count(), 12)
+
+        run_rollup()
+        before = self.views()
+        call_command("purge_events", "--chunk-size", "4", "--sleep", "0", stdout=io.StringIO())
+        self.assertEqual(Event.objects.count(), 3)
+        self.site.refresh_from_db()
+        self.assertEqual(self.site.purged_before.date(), timezone.localdate() - timedelta(days=10))
+        self.assertEqual(self.views(), before)
+
+        # neither a late event for a purged day nor a full rebuild touches the downsampled days
+        Event.objects.create(site=self.site, url="/late", session_id="x", timestamp=timezone.now() - timedelta(days=15))
+        run_rollup()
+        run_rollup(rebuild=True)
+        self.assertFalse(DailyRollup.objects.filter(key="/late").exists())
+        self.assertEqual(self.views(), before)
+
+    def test_sites_without_retention_are_kept(self):
+        from django.core.management import call_command
+
+        self.site.retention_days = None
+        self.site.save()
+        call_command("purge_events", stdout=io.StringIO())
+        self.assertEqual(Event.objects.count(), 12)
+        with override_settings(EVENT_RETENTION_DAYS=13):
+            call_command("purge_events", "--no-downsample", stdout=io.StringIO())
+        self.assertEqual(Event.objects.count(), 6)
+
+
+class EventPartitionTests(TestCase):
+    def test_month_math(self):
+        from datetime import date
+
+        from .management.commands.manage_event_partitions import _add_months, _expire_cutoff, _is_expired, _partition_month
+
+        self.assertEqual(_add_months(date(2025, 11, 1), 3), date(2026, 2, 1))
+        self.assertEqual(_add_months(date(2025, 1, 1), -13), date(2023, 12, 1))
+        self.assertEqual(_add_months(date(2025, 12, 1), 0), date(2025, 12, 1))
+        self.assertEqual(_expire_cutoff(date(2026, 3, 15), 12), date(2025, 3, 1))
+        self.assertTrue(_is_expired(date(2025, 2, 1), date(2025, 3, 1)))
+        self.assertFalse(_is_expired(date(2025, 3, 1), date(2025, 3, 1)))
+        self.assertEqual(_partition_month("analytics_event_p202502"), date(2025, 2, 1))
+        self.assertEqual(_partition_month("analytics_event_detached_p202502", "analytics_event_detached_p"), date(2025, 2, 1))
+        self.assertIsNone(_partition_month("analytics_event_default"))
+        self.assertIsNone(_partition_month("analytics_event_p2025"))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "Event partitioning requires PostgreSQL")
+class PostgresEventPartitionTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.month = timezone.now().replace(day=15, hour=12, minute=0, second=0, microsecond=0)
+        self.old = self.month - timedelta(days=3 * 365)
+
+    def partitions(self, prefix="analytics_event_"):
+        with connection.cursor() as cur:
+            cur.execute(
+                "SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r' "
+                "AND relnamespace = current_schema()::regnamespace",
+                [f"{prefix}%"],
+            )
+            return {name for (name,) in cur.fetchall()}
+
+    def count(self, table):
+        with connection.cursor() as cur:
+            cur.execute(f'SELECT COUNT(*) FROM "{table}"')
+            return cur.fetchone()[0]
+
+    def partition(self, when):
+        return f"analytics_event_p{when:%Y%m}"
+
+    def manage(self, *args):
+        from django.core.management import call_command
+
+        # fire the deferred foreign key checks of this test's inserts: Postgres refuses to
+        # ALTER a table with pending trigger events
+        connection.check_constraints()
+        out = io.StringIO()
+        call_command("manage_event_partitions", *args, stdout=out)
+        return out.getvalue()
+
+    def test_convert_keeps_rows_and_creates_partitions(self):
+        Event.objects.create(site=self.site, url="/old", session_id="s1", timestamp=self.old)
+        Event.objects.create(site=self.site, url="/now", session_id="s2", timestamp=self.month)
+        self.manage("--convert", "--ahead", "1", "--retain", "0")
+        partitions = self.partitions()
+        self.assertLessEqual({self.partition(self.old), self.partition(self.month), "analytics_event_default"}, partitions)
+        self.assertIn(self.partition(self.month + timedelta(days=31)), partitions)
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(self.count(self.partition(self.old)), 1)
+        Event.objects.create(site=self.site, url="/new", session_id="s3", timestamp=self.month)
+        self.assertEqual(Event.objects.count(), 3)
+
+    def test_create_partitions_moves_rows_out_of_default(self):
+        self.manage("--convert", "--ahead", "0", "--retain", "0")
+        later = self.month + timedelta(days=62)
+        self.assertNotIn(self.partition(later), self.partitions())
+        Event.objects.create(site=self.site, url="/late", session_id="s1", timestamp=later)
+        self.assertEqual(self.count("analytics_event_default"), 1)
+
+        out = self.manage("--ahead", "3", "--retain", "0")
+        self.assertIn("moving them", out)
+        self.assertEqual(self.count("analytics_event_default"), 0)
+        self.assertEqual(self.count(self.partition(later)), 1)
+        self.assertEqual(Event.objects.get().url, "/late")
+
+    def test_expire_downsamples_then_detaches_and_drops_later(self):
+        from .models import DailyRollup
+
+        Event.objects.create(site=self.site, url="/old", session_id="s1", timestamp=self.old)
+        Event.objects.create(site=self.site, url="/now", session_id="s2", timestamp=self.month)
+        self.manage("--convert", "--ahead", "0", "--retain", "0")
+
+        self.manage("--retain", "12")
+        old = self.partition(self.old)
+        self.assertNotIn(old, self.partitions())
+        self.assertEqual(self.partitions("analytics_event_detached_p"), {f"analytics_event_detached_p{self.old:%Y%m}"})
+        self.assertEqual(list(Event.objects.values_list("url", flat=True)), ["/now"])
+        self.assertTrue(DailyRollup.objects.filter(site=self.site, key="/old").exists())
+        self.site.refresh_from_db()
+        self.assertGreater(self.site.purged_before, self.old)
+
+        self.manage("--retain", "12", "--drop")
+        self.assertEqual(self.partitions("analytics_event_detached_p"), set())
+
+    def test_expire_respects_site_retention(self):
+        self.site.retention_days = 5 * 365
+        self.site.save()
+        Event.objects.create(site=self.site, url="/old", session_id="s1", timestamp=self.old)
+        self.manage("--convert", "--ahead", "0", "--retain", "0")
+        out = self.manage("--retain", "12", "--drop")
+        self.assertIn("keeping", out)
+        self.assertIn(self.partition(self.old), self.partitions())
+        self.assertEqual(Event.objects.count(), 1)
+
+
+class UserAgentColumnsTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=owner, site_id="site-a", domain="a.example.com")
+
+    def test_track_classifies_user_agent(self):
+        ua = "Mozilla/5.0 (Linux; Android 14; Pixel 7) AppleWebKit/537.36 Chrome/125.0 Mobile Safari/537.36"
+        APIClient().post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1", "user_agent": ua}, format="json")
+        event = Event.objects.get()
+        self.assertEqual((event.device, event.browser, event.os), ("mobile", "Chrome", "Android"))
+
+    def test_backfill_command(self):
+        from django.core.management import call_command
+
+        Event.objects.bulk_create(
+            Event(site=self.site, url="/", session_id=f"s{i}", user_agent="Mozilla/5.0 (iPad; CPU OS 16_7) Safari/604.1" if i % 2 else None, timestamp=timezone.now())
+            for i in range(5)
+        )
+        call_command("backfill_event_fields", "--fields", "ua", "--chunk-size", "2", stdout=io.StringIO())
+        self.assertEqual(
+            sorted(Event.objects.values_list("device", "browser", "os")),
+            [("tablet", "Safari", "iOS")] * 2 + [("unknown", "other", "unknown")] * 3,
+        )
+
+
+class SourceColumnTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+
+    def test_source_key_and_services_filter(self):
+        client = APIClient()
+        for payload in (
+            {"utm_source": "Google"},
+            {"referrer": "https://News.Example.com/post"},
+            {"utm_source": "newsletter", "referrer": "https://google.com"},
+            {},
+        ):
+            client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1", **payload}, format="json")
+        self.assertEqual(
+            sorted(Event.objects.values_list("source", flat=True)),
+            ["direct", "google", "news.example.com", "newsletter"],
+        )
+        client.force_authenticate(self.owner)
+        res = client.get("/api/analytics/kpis/site-a/?services=Google,news.example.com")
+        self.assertEqual(res.data["totals"]["page_views"], 2)
+
+
+class SessionsMetricsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now().replace(microsecond=0)
+        # 6 sessions, each with 3 events 90s apart, started on different days
+        Event.objects.bulk_create(
+            Event(site=self.site, url="/", session_id=f"s{i}", timestamp=now - timedelta(days=i % 3, hours=i) + timedelta(seconds=90 * j))
+            for i in range(6)
+            for j in range(3)
+        )
+
+    def test_totals_and_trend(self):
+        res = self.client.get("/api/analytics/sessions/site-a/?days=30").data
+        self.assertEqual(res["session_count"], 6)
+        self.assertAlmostEqual(res["avg_duration_seconds"], 180, places=1)
+        self.assertEqual(sum(r["sessions"] for r in res["trend"]), 6)
+        self.assertNotIn("sessions", res)
+
+    def test_session_list_keyset_pages(self):
+        seen = []
+        cursor = ""
+        while True:
+            res = self.client.get(f"/api/analytics/sessions/site-a/?include_sessions=1&limit=4&cursor={cursor}").data
+            seen += [s["session_id"] for s in res["sessions"]]
+            cursor = res["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(sorted(seen), [f"s{i}" for i in range(6)])
+
+
+class NewVsReturningTests(TestCase):
+    def setUp(self):
+        from .ingest import known_sessions
+
+        known_sessions.clear()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_counts_from_first_seen_table(self):
+        from .models import VisitorFirstSeen
+        from .rollups import run_rollup
+
+        now = timezone.now()
+        Event.objects.bulk_create([
+            Event(site=self.site, url="/", session_id="old", timestamp=now - timedelta(days=40)),
+            Event(site=self.site, url="/", session_id="old", timestamp=now - timedelta(days=2)),
+            Event(site=self.site, url="/", session_id="gone", timestamp=now - timedelta(days=50)),
+        ])
+        run_rollup()  # backfills VisitorFirstSeen for rows written outside ingest
+        self.assertEqual(VisitorFirstSeen.objects.count(), 2)
+
+        APIClient().post("/track/", {"site_id": "site-a", "url": "/", "session_id": "fresh"}, format="json")
+        res = self.client.get("/api/analytics/new-vs-returning/site-a/?days=30").data
+        self.assertEqual((res["new"], res["returning"]), (1, 1))
+        self.assertEqual(sum(d["new_sessions"] for d in res["daily"]), 1)
+        self.assertEqual(sum(d["returning_sessions"] for d in res["daily"]), 1)
+
+    def test_rollup_lowers_first_seen_for_late_older_events(self):
+        from .models import VisitorFirstSeen
+        from .rollups import run_rollup
+
+        APIClient().post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1"}, format="json")
+        older = timezone.now() - timedelta(days=45)
+        Event.objects.create(site=self.site, url="/", session_id="s1", timestamp=older)
+        run_rollup()
+        self.assertEqual(VisitorFirstSeen.objects.get(session_id="s1").first_seen, older)
+        res = self.client.get("/api/analytics/new-vs-returning/site-a/?days=30").data
+        self.assertEqual((res["new"], res["returning"]), (0, 1))
+
+
+class HyperLogLogTests(TestCase):
+    def test_estimates_within_documented_error(self):
+        from .hll import HyperLogLog, relative_error
+
+        for precision in (10, 14):
+            bound = 3 * relative_error(precision)
+            for n in (10, 1000, 50000):
+                estimate = HyperLogLog(precision).update(f"session-{i}" for i in range(n)).count()
+                self.assertLessEqual(abs(estimate - n) / n, bound, (precision, n, estimate))
+
+    def test_merge_is_union_and_roundtrips(self):
+        from .hll import HyperLogLog
+
+        a = HyperLogLog(12).update(range(0, 3000))
+        b = HyperLogLog(12).update(range(2000, 5000))
+        union = HyperLogLog(12).update(range(0, 5000))
+        self.assertEqual(HyperLogLog.from_bytes(a.to_bytes()).merge(b).registers, union.registers)
+        self.assertEqual(HyperLogLog(12).count(), 0)
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(10))
+
+    def test_kpis_approx_mode(self):
+        from .rollups import run_rollup
+
+        owner = User.objects.create_user(username="owner", password="pw")
+        site = Site.objects.create(owner=owner, site_id="site-a", domain="a.example.com")
+        now = timezone.now()
+        Event.objects.bulk_create(
+            Event(site=site, url="/", session_id=f"s{i % 40}", timestamp=now - timedelta(hours=5 * i))
+            for i in range(120)
+        )
+        run_rollup()
+        client = APIClient()
+        client.force_authenticate(owner)
+        exact = client.get("/api/analytics/kpis/site-a/?days=20&compare=1").data
+        approx = client.get("/api/analytics/kpis/site-a/?days=20&compare=1&distinct=approx").data
+        self.assertEqual(approx["distinct"]["mode"], "approx")
+        self.assertEqual(approx["totals"]["sessions"], exact["totals"]["sessions"])  # tiny counts are exact
+        filtered = client.get("/api/analytics/kpis/site-a/?distinct=approx&posts=/").data
+        self.assertEqual(filtered["distinct"]["mode"], "exact")
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        from .response_cache import reset_stats
+
+        reset_stats()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_closed_window_cached_until_late_event(self):
+        from .response_cache import stats
+
+        day = (timezone.localtime() - timedelta(days=5)).date()
+        url = f"/api/analytics/kpis/site-a/?start={day}T00:00:00Z&end={day}T23:59:59Z"
+        self.assertEqual(self.client.get(url).data["totals"]["page_views"], 0)
+        with self.assertNumQueries(0):  # ownership comes from the auth cache too
+            self.assertEqual(self.client.get(url).data["totals"]["page_views"], 0)
+        self.assertEqual((stats()["hits"], stats()["misses"]), (1, 1))
+
+        # an event for a closed day moves the site's generation, so the next read recomputes
+        self.client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "s1",
+                                     "timestamp": f"{day}T12:00:00Z"}, format="json")
+        self.assertEqual(self.client.get(url).data["totals"]["page_views"], 1)
+
+    def test_closed_windows_expire_with_a_process_local_backend(self):
+        from .response_cache import closed_ttl, stats
+
+        self.assertEqual(closed_ttl(), 600)
+        with override_settings(ANALYTICS_CACHE_BACKEND="file"):
+            self.assertIsNone(closed_ttl())
+        day = (timezone.localtime() - timedelta(days=5)).date()
+        url = f"/api/analytics/kpis/site-a/?start={day}T00:00:00Z&end={day}T23:59:59Z"
+        with override_settings(ANALYTICS_CACHE_CLOSED_TTL=-1):  # already expired when read back
+            self.client.get(url)
+            # a bump this process never sees, e.g. from the drain worker or rollup_events
+            Event.objects.create(site=self.site, url="/", session_id="s1", timestamp=timezone.now() - timedelta(days=5))
+            self.assertEqual(self.client.get(url).data["totals"]["page_views"], 1)
+        self.assertEqual(stats()["hits"], 0)
+
+    def test_segment_filter_order_shares_an_entry(self):
+        from .response_cache import stats
+
+        self.client.get("/api/analytics/kpis/site-a/?services=google,bing")
+        self.client.get("/api/analytics/kpis/site-a/?services=Bing,google&")
+        self.assertEqual(stats()["hits"], 1)
+
+    def test_file_backend_culls_least_recently_read(self):
+        from .cache_backends import LRUFileBasedCache
+
+        with tempfile.TemporaryDirectory() as location:
+            cache = LRUFileBasedCache(location, {"OPTIONS": {"MAX_ENTRIES": 4, "CULL_FREQUENCY": 2}})
+            for i in range(4):
+                cache.set(f"k{i}", i)
+                os.utime(cache._key_to_file(f"k{i}"), (i, i))
+            cache.get("k0")  # refreshes k0, so k1 and k2 are the oldest now
+            cache.set("k4", 4)
+            self.assertEqual([cache.get(f"k{i}") for i in range(5)], [0, None, None, 3, 4])
+
+    def test_stats_endpoint_is_admin_only(self):
+        self.assertEqual(self.client.get("/api/analytics/cache-stats/").status_code, 403)
+        self.owner.is_staff = True
+        self.owner.save()
+        self.assertEqual(set(self.client.get("/api/analytics/cache-stats/").data), {"backend", "hits", "misses", "hit_ratio"})
+
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        Event.objects.bulk_create(
+            enrich(Event(
+                site=self.site, url=f"/blog/{i % 3}" if i % 2 else "/", session_id=f"s{i % 5}",
+                user_agent="Mozilla/5.0 (Windows NT 10.0) Chrome/125.0", country="India" if i % 3 else None,
+                utm_source="google" if i % 4 == 0 else None, timestamp=now - timedelta(hours=5 * i),
+            ))
+            for i in range(40)
+        )
+
+    def test_widgets_match_individual_endpoints(self):
+        res = self.client.get("/api/analytics/dashboard/site-a/?days=30").data["widgets"]
+        self.assertEqual(list(res), ["kpis", "pages", "sessions", "new-vs-returning", "sources", "devices", "browsers", "geography"])
+        for name in ("sources", "devices", "browsers", "geography"):
+            self.assertEqual(res[name], self.client.get(f"/api/analytics/{name}/site-a/?days=30").data)
+        self.assertEqual(res["pages"]["top_pages"], self.client.get("/api/analytics/pages/site-a/?days=30").data["top_pages"])
+        self.assertEqual(res["sessions"]["session_count"], 5)
+
+    def test_full_dashboard_shares_rollup_coverage_and_raw_pass(self):
+        from django.core.management import call_command
+
+        call_command("rollup_events", stdout=io.StringIO())
+        expected = {name: self.client.get(f"/api/analytics/{name}/site-a/?days=30").data for name in ("sources", "devices", "kpis")}
+        # ownership is cached by now; rollup coverage once, two DailyRollup queries and one grouped
+        # raw pass for every breakdown, the trend and the top country, one kpis aggregate,
+        # sessions and new-vs-returning (2)
+        with self.assertNumQueries(8):
+            res = self.client.get("/api/analytics/dashboard/site-a/?days=30").data["widgets"]
+        self.assertEqual(res["sources"], expected["sources"])
+        self.assertEqual(res["devices"], expected["devices"])
+        self.assertEqual(res["kpis"]["totals"], expected["kpis"]["totals"])
+
+    def test_filtered_subset_uses_one_breakdown_query(self):
+        url = "/api/analytics/dashboard/site-a/?days=30&posts=/blog/&widgets=pages,sources,geography"
+        # ownership check + one grouped query
+        with self.assertNumQueries(2):
+            res = self.client.get(url).data["widgets"]
+        self.assertEqual(set(res), {"pages", "sources", "geography"})
+        self.assertEqual(sum(p["views"] for p in res["pages"]["top_pages"]), 20)
+        self.assertEqual(sum(c["count"] for c in res["geography"]), 20)
+
+    def test_unknown_widget(self):
+        self.assertEqual(self.client.get("/api/analytics/dashboard/site-a/?widgets=pages,nope").status_code, 400)
+
+
+class TrackerScriptTests(TestCase):
+    def test_minified_gzip_with_etag(self):
+        from . import tracker
+
+        res = self.client.get("/api/tracker/", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(res["Content-Encoding"], "gzip")
+        self.assertEqual(res["Cache-Control"], "public, max-age=300")
+        self.assertIn("Accept-Encoding", res["Vary"])
+        body = gzip.decompress(res.content).decode()
+        self.assertNotIn("// ", body)
+        self.assertIn('const INGEST_URL = "https://lakshitajain.pythonanywhere.com";', body)
+        self.assertLess(len(res.content), len(tracker.SOURCE.read_bytes()) / 2)
+
+        again = self.client.get("/api/tracker/", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b"")
+        # the identity representation has a different ETag
+        self.assertEqual(self.client.get("/api/tracker/", HTTP_IF_NONE_MATCH=res["ETag"]).status_code, 200)
+
+    def test_versioned_url_and_ingest_setting(self):
+        from . import tracker
+
+        version = self.client.get("/api/tracker/")["X-Tracker-Version"]
+        res = self.client.get(f"/api/tracker/?v={version}")
+        self.assertEqual(res["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(self.client.get("/api/tracker/?v=stale")["Cache-Control"], "public, max-age=300")
+        try:
+            with override_settings(TRACKER_INGEST_URL="https://ingest.example.com/"):
+                tracker.load(rebuild=True)
+                res = self.client.get("/api/tracker/")
+            self.assertIn(b'fetch(INGEST_URL + "/track/"', res.content)
+            self.assertIn(b'"https://ingest.example.com"', res.content)
+            self.assertNotEqual(res["X-Tracker-Version"], version)
+        finally:
+            tracker.load(rebuild=True)
+
+
+class AuthCacheTests(TestCase):
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(self.owner).access_token}")
+        Event.objects.create(site=self.site, url="/blog/1", session_id="s1", timestamp=timezone.now())
+
+    def test_warm_fanout_skips_auth_and_ownership_queries(self):
+        self.assertEqual(self.client.get("/api/analytics/dashboard/site-a/?widgets=pages").status_code, 200)
+        # just the breakdown query of a widget set that isn't in the response cache yet
+        with self.assertNumQueries(1):
+            res = self.client.get("/api/analytics/dashboard/site-a/?posts=/blog/&widgets=sources")
+        self.assertEqual(res.status_code, 200)
+
+    def test_changes_invalidate(self):
+        self.client.get("/api/analytics/sources/site-a/")
+        other = User.objects.create_user(username="other", password="pw")
+        self.site.owner = other
+        self.site.save()
+        self.assertEqual(self.client.get("/api/analytics/sources/site-a/").status_code, 403)
+        self.owner.is_active = False
+        self.owner.save()
+        self.assertEqual(self.client.get("/api/analytics/sources/site-a/").status_code, 401)
+
+    def test_site_saved_by_another_process_is_read_again(self):
+        from .caching import owned_site_cache, site_for_owner
+        from .response_cache import bump_generation
+
+        self.addCleanup(owned_site_cache.clear)
+        self.assertIsNone(site_for_owner(self.owner, "site-a").purged_before)
+        # purge_events saving the site elsewhere: its signals bump the shared generation, but
+        # can't drop this process's entry
+        cutoff = timezone.now().replace(microsecond=0) - timedelta(days=3)
+        Site.objects.filter(pk=self.site.pk).update(purged_before=cutoff, timezone="Asia/Kolkata")
+        bump_generation(self.site.pk)
+        with self.assertNumQueries(1):
+            site = site_for_owner(self.owner, "site-a")
+        self.assertEqual((site.purged_before, site.timezone), (cutoff, "Asia/Kolkata"))
+        with self.assertNumQueries(0):
+            self.assertEqual(site_for_owner(self.owner, "site-a").purged_before, cutoff)
+
+
+@override_settings(LIVE_STREAM_SECONDS=0)
+class LiveVisitorsTests(TestCase):
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        from . import live
+
+        live.reset()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.token = str(RefreshToken.for_user(self.owner).access_token)
+
+    def frames(self, body):
+        return [json.loads(chunk[len("data: "):]) for chunk in body.split("\n\n") if chunk.startswith("data: ")]
+
+    def test_ingest_feeds_the_stream_without_queries(self):
+        for session, url in [("a", "/"), ("a", "/x"), ("b", "/x")]:
+            self.client.post("/track/", {"site_id": "site-a", "url": url, "session_id": session}, content_type="application/json")
+        url = f"/api/analytics/live/site-a/?token={self.token}"
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            res = self.client.get(url)
+        # WSGI: one snapshot, no stream holding the worker; EventSource polls at the interval
+        self.assertFalse(res.streaming)
+        self.assertTrue(res.content.decode().startswith("retry: 2000\n\n"))
+        [frame] = self.frames(res.content.decode())
+        self.assertEqual(res["Content-Type"], "text/event-stream")
+        self.assertEqual((frame["active_visitors"], frame["pageviews"]), (2, 3))
+        self.assertEqual(frame["top_pages"][0], {"url": "/x", "views": 2})
+
+    async def test_asgi_streams(self):
+        from django.test import AsyncClient
+
+        res = await AsyncClient().get(f"/api/analytics/live/site-a/?token={self.token}")
+        self.assertTrue(res.streaming)
+        body = b"".join([chunk async for chunk in res.streaming_content]).decode()
+        self.assertEqual(self.frames(body)[0]["active_visitors"], 0)
+
+    def test_window_expiry_and_auth(self):
+        from . import live
+
+        with override_settings(LIVE_WINDOW_SECONDS=0, LIVE_SNAPSHOT_SECONDS=0):
+            self.client.post("/track/", {"site_id": "site-a", "url": "/", "session_id": "a"}, content_type="application/json")
+            self.assertEqual(live.snapshot(self.site.pk)["active_visitors"], 0)
+        self.assertEqual(self.client.get("/api/analytics/live/site-a/").status_code, 401)
+        self.assertEqual(self.client.get("/api/analytics/live/site-a/?token=nope").status_code, 401)
+        other = User.objects.create_user(username="other", password="pw")
+        self.site.owner = other
+        self.site.save()
+        self.assertEqual(self.client.get(f"/api/analytics/live/site-a/?token={self.token}").status_code, 403)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        # pairs of events share a timestamp, so pages have to break ties on id
+        Event.objects.bulk_create(
+            Event(site=self.site, url=f"/p{i}", session_id=f"s{i}", timestamp=now - timedelta(hours=i // 2))
+            for i in range(25)
+        )
+
+    @override_settings(EXPORT_CHUNK_SIZE=4)
+    def test_ndjson_pages_cover_every_row_once(self):
+        res = self.client.get("/api/analytics/export/site-a/?days=3&output=ndjson")
+        self.assertEqual(res.status_code, 200)
+        rows = [json.loads(line) for line in b"".join(res.streaming_content).decode().splitlines()]
+        self.assertEqual(sorted(r["url"] for r in rows), sorted(f"/p{i}" for i in range(25)))
+        self.assertEqual([(r["timestamp"], r["id"]) for r in rows], sorted((r["timestamp"], r["id"]) for r in rows))
+
+    def test_csv_command(self):
+        import csv
+        from django.core.management import call_command
+
+        out = io.StringIO()
+        call_command("export_events", "site-a", "--days", "3", "--chunk-size", "7", stdout=out)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]["url"], "/p24")
+
+    def test_bad_output(self):
+        self.assertEqual(self.client.get("/api/analytics/export/site-a/?output=xml").status_code, 400)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    @override_settings(EXPORT_CHUNK_SIZE=10)
+    def test_parquet_reads_back(self):
+        import pyarrow.parquet as pq
+        from .export import FIELDS
+
+        res = self.client.get("/api/analytics/export/site-a/?days=3&output=parquet&compression=snappy")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["Content-Type"], "application/vnd.apache.parquet")
+        parquet = pq.ParquetFile(io.BytesIO(b"".join(res.streaming_content)))
+        self.assertEqual(parquet.metadata.num_row_groups, 3)  # one per page
+        table = parquet.read()
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.column_names, list(FIELDS))
+        self.assertEqual(sorted(table.column("url").to_pylist()), sorted(f"/p{i}" for i in range(25)))
+
+    def test_parquet_without_pyarrow(self):
+        import sys
+        from unittest import mock
+
+        with mock.patch.dict(sys.modules, {"pyarrow": None, "pyarrow.parquet": None}):
+            res = self.client.get("/api/analytics/export/site-a/?output=parquet")
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("pyarrow", res.data["error"])
+
+
+@unittest.skipUnless(columnar.np is not None, "numpy is not installed")
+class ColumnarTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        now = timezone.now()
+        Event.objects.bulk_create(
+            enrich(Event(
+                site=self.site, url=f"/blog/{i % 4}" if i % 3 else "/", session_id=f"s{i % 9}",
+                utm_source="Google" if i % 5 == 0 else None, referrer="https://news.example.com/x" if i % 2 else None,
+                country="India" if i % 3 else None, timestamp=now - timedelta(hours=9 * i),
+            ))
+            for i in range(80)
+        )
+
+    def fetch(self):
+        urls = [
+            "/api/analytics/pages/site-a/?days=40",
+            "/api/analytics/sources/site-a/?days=40",
+            "/api/analytics/geography/site-a/?days=40",
+            "/api/analytics/kpis/site-a/?days=40&compare=1",
+            "/api/analytics/kpis/site-a/?days=40&services=google&posts=/blog/",
+        ]
+        data = [self.client.get(url).data for url in urls]
+        for kpis in data[3:]:
+            del kpis["period"], kpis["compare"]  # computed from now
+        return data
+
+    def test_columnar_matches_orm(self):
+        with override_settings(ANALYTICS_CACHE_ENABLED=False):
+            orm = self.fetch()
+        with override_settings(ANALYTICS_CACHE_ENABLED=False, COLUMNAR_ENABLED=True, COLUMNAR_PATH=self.tmp.name,
+                               ROLLUP_WATERMARK_OVERLAP=0):
+            self.assertGreater(columnar.run_compaction(), 0)
+            # today's events stay on the ORM side and past the watermark
+            self.assertEqual(columnar.run_compaction(), 0)
+            self.assertEqual(self.fetch(), orm)
+
+    def test_kpis_tie_break_and_window_end_match_orm(self):
+        from .rollups import day_start
+
+        site = Site.objects.create(owner=self.owner, site_id="site-b", domain="b.example.com")
+        since = day_start(timezone.localdate() - timedelta(days=30))
+        until = day_start(timezone.localdate() - timedelta(days=2)) + timedelta(hours=12)
+        # Brazil 3, Austria 2 plus one exactly at `until`: a tie only when `until` is counted
+        Event.objects.bulk_create(
+            Event(site=site, url="/", session_id=f"s{i}", country=country, timestamp=until - timedelta(days=5 + i))
+            for i, country in enumerate(["Brazil", "Brazil", "Brazil", "Austria", "Austria"])
+        )
+        Event.objects.create(site=site, url="/", session_id="last", country="Austria", timestamp=until)
+        url = "/api/analytics/kpis/site-b/"
+        params = {"start": since.isoformat(), "end": until.isoformat()}
+        with override_settings(ANALYTICS_CACHE_ENABLED=False):
+            orm = self.client.get(url, params).data
+        self.assertEqual((orm["totals"]["page_views"], orm["totals"]["top_country"]), (6, "Austria"))
+        with override_settings(ANALYTICS_CACHE_ENABLED=False, COLUMNAR_ENABLED=True, COLUMNAR_PATH=self.tmp.name,
+                               ROLLUP_WATERMARK_OVERLAP=0):
+            self.assertGreater(columnar.run_compaction(), 0)
+            self.assertTrue(columnar.use_for(since, until, site))
+            self.assertEqual(self.client.get(url, params).data, orm)
+
+
+class SeedEventTests(TestCase):
+    def seed(self):
+        from django.core.management import call_command
+
+        call_command("seed_event", "--sites", "2", "--days", "9", "--sessions", "2-4", "--distribution", "weekly",
+                     "--seed", "7", "--end-date", "2026-01-10", "--chunk-size", "16", stdout=io.StringIO())
+        return sorted(Event.objects.values_list("site__domain", "url", "session_id", "timestamp", "source"))
+
+    def test_seed_is_reproducible(self):
+        first = self.seed()
+        self.assertEqual({domain for domain, *_ in first}, {"example.com", "site1.example.com"})
+        self.assertEqual(self.seed(), first)
+
+    def test_reseed_clears_derived_rows(self):
+        from django.core.management import call_command
+        from django.db.models import Sum
+        from .models import DailyRollup, DailySketch, VisitorFirstSeen
+
+        self.seed()
+        call_command("rollup_events", stdout=io.StringIO())
+        views = DailyRollup.objects.filter(dimension="url").aggregate(n=Sum("count"))["n"]
+        self.assertEqual(views, Event.objects.count())
+        self.seed()
+        self.assertFalse(DailyRollup.objects.exists() or DailySketch.objects.exists() or VisitorFirstSeen.objects.exists())
+        call_command("rollup_events", stdout=io.StringIO())
+        self.assertEqual(DailyRollup.objects.filter(dimension="url").aggregate(n=Sum("count"))["n"], views)
+
+
+class BenchmarkCompareTests(TestCase):
+    def test_percentile_and_regressions(self):
+        from .benchmarks import compare, percentile
+
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        baseline = {"1000": {"kpis": {"p95_ms": 10.0, "queries": 5, "peak_kb": 40.0}}}
+        ok = {"1000": {"kpis": {"p95_ms": 11.9, "queries": 5, "peak_kb": 30.0}, "new_case": {"p95_ms": 99.0}}}
+        self.assertEqual(compare(ok, baseline, 0.2), [])
+        bad = {"1000": {"kpis": {"p95_ms": 12.5, "queries": 6, "peak_kb": 40.0}}}
+        self.assertEqual(compare(bad, baseline, 0.2), [("1000", "kpis", "p95_ms", 10.0, 12.5), ("1000", "kpis", "queries", 5, 6)])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_request_metrics_exposed(self):
+        from .metrics import registry
+
+        before = registry.queries.series.get(("kpis",), [0])[-1]
+        self.client.get("/api/analytics/kpis/site-a/?days=7&services=google")
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        res = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(res.status_code, 200)
+        body = res.content.decode()
+        self.assertIn(f'analytics_request_queries_count{{view="kpis"}} {before + 1}', body)
+        self.assertIn('analytics_request_duration_seconds_bucket{view="kpis",le="+Inf"}', body)
+
+    def test_metrics_disabled_without_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+    @override_settings(METRICS_QUERY_LOG_THRESHOLD_MS=0.001, METRICS_QUERY_LOG_SAMPLE_RATE=1.0)
+    def test_slow_requests_log_their_queries(self):
+        with self.assertLogs("analytics.metrics", "WARNING") as logs:
+            self.client.get("/api/analytics/kpis/site-a/?days=7&services=google")
+        self.assertIn("slow request GET /api/analytics/kpis/site-a/ (kpis)", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+
+class AsyncTrackTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.site = Site.objects.create(owner=self.owner, site_id="site-a", domain="a.example.com")
+
+    @override_settings(TRACK_ASYNC_FLUSH_MS=50)
+    async def test_concurrent_beacons_share_one_store(self):
+        import asyncio
+        from unittest import mock
+        from django.test import AsyncClient
+        from . import async_ingest
+
+        client = AsyncClient()
+        with mock.patch.object(async_ingest, "store_events", wraps=async_ingest.store_events) as store:
+            responses = await asyncio.gather(*[
+                client.post("/track/async/", json.dumps({"site_id": "site-a", "url": "/", "session_id": f"s{i}"}),
+                            content_type="application/json")
+                for i in range(20)
+            ])
+        self.assertEqual({r.status_code for r in responses}, {201})
+        self.assertEqual(store.call_count, 1)
+        self.assertEqual(await Event.objects.filter(site=self.site).acount(), 20)
+
+    async def test_metrics_leave_sql_series_alone(self):
+        from django.test import AsyncClient
+        from .metrics import registry
+
+        labels = ("track-event-async",)
+        before = registry.request_seconds.series.get(labels, [0])[-1]
+        await AsyncClient().post("/track/async/", json.dumps({"site_id": "site-a", "url": "/", "session_id": "m"}), content_type="application/json")
+        # SQL can't be measured under ASGI, so no zero is recorded for it
+        self.assertEqual(registry.request_seconds.series[labels][-1], before + 1)
+        self.assertNotIn(labels, registry.queries.series)
+        self.assertNotIn(labels, registry.sql_seconds.series)
+
+    async def test_rejects_unknown_site_and_bad_body(self):
+        from django.test import AsyncClient
+
+        client = AsyncClient()
+        res = await client.post("/track/async/", json.dumps({"site_id": "nope", "url": "/", "session_id": "s"}), content_type="application/json")
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("site_id", res.json())
+        res = await client.post("/track/async/", "{not json", content_type="application/json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual((await client.get("/track/async/")).status_code, 405)
+
+    async def beacon(self, session_id):
+        from .ingest import avalidate_events
+
+        events, _ = await avalidate_events([{"site_id": "site-a", "url": "/", "session_id": session_id}])
+        return events
+
+    @override_settings(TRACK_ASYNC_FLUSH_MS=60_000)
+    async def test_lifespan_shutdown_stores_the_waiting_batch(self):
+        import asyncio
+        from web_analytics_backend.asgi import application
+        from . import async_ingest
+
+        waiting = asyncio.ensure_future(async_ingest.submit(await self.beacon("s1")))
+        await asyncio.sleep(0)
+        self.assertEqual(await Event.objects.acount(), 0)
+
+        received, sent = asyncio.Queue(), []
+        for message in ("lifespan.startup", "lifespan.shutdown"):
+            received.put_nowait({"type": message})
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await application({"type": "lifespan"}, received.get, send)
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertFalse(await waiting)  # stored, not queued
+        self.assertEqual(await Event.objects.acount(), 1)
+
+    async def test_failed_store_is_logged_and_released(self):
+        import asyncio
+        from unittest import mock
+        from . import async_ingest
+
+        events = await self.beacon("s1")
+        batcher = async_ingest.EventBatcher()
+        with mock.patch.object(async_ingest, "store_events", side_effect=RuntimeError("database down")):
+            with self.assertLogs("analytics.async_ingest", "ERROR"):
+                waiting = asyncio.ensure_future(batcher.submit(events))
+                await asyncio.sleep(0)
+                batcher.flush()
+                with self.assertRaises(RuntimeError):
+                    await waiting
+                await batcher.aclose()
+        self.assertEqual(batcher.tasks, set())
@@ -0,0 +1,78 @@
+(function() {
+  // Read site id from a global or from the current script tag data attribute
+  const scriptEl = document.currentScript;
+  const INGEST_URL = __TRACKER_INGEST_URL__; // filled in by analytics/tracker.py
+  const siteId = window.SITE_ID || (scriptEl && scriptEl.dataset && scriptEl.dataset.siteId) || window.__SITE_ID__;
+
+  // Simple cookie helpers
+  function getCookie(name) {
+    const match = document.cookie.match(new RegExp('(?:^|; )' + name.replace(/([.$?*|{}()\[\]\\/\+^])/g, '\$1') + '=([^;]*)'));
+    return match ? decodeURIComponent(match[1]) : null;
+  }
+  function setCookie(name, value, days) {
+    const d = new Date();
+    d.setTime(d.getTime() + (days*24*60*60*1000));
+    const expires = 'expires=' + d.toUTCString();
+    document.cookie = name + '=' + encodeURIComponent(value) + '; ' + expires + '; path=/; SameSite=Lax';
+  }
+
+  // Ensure we have a persistent session id
+  let sessionId = getCookie('wa_session_id');
+  if (!sessionId) {
+    sessionId = (typeof crypto !== 'undefined' && crypto.randomUUID) ? crypto.randomUUID() : String(Math.random()).slice(2) + Date.now();
+    setCookie('wa_session_id', sessionId, 1); // 1 day
+  }
+
+  const eventData = {
+    site_id: siteId,
+    url: window.location.href,
+    referrer: document.referrer,
+    user_agent: navigator.userAgent,
+    language: navigator.language,
+    screen_width: window.innerWidth,
+    screen_height: window.innerHeight,
+    session_id: sessionId,
+    timestamp: new Date().toISOString(), // client time: buffered events keep it and ingest dedupes retries on it
+  };
+
+  // Batch mode: buffer events (kept across page loads) and flush them together with sendBeacon
+  const batchMode = window.WA_BATCH || (scriptEl && scriptEl.dataset && scriptEl.dataset.batch === 'true');
+  if (batchMode && navigator.sendBeacon) {
+    const QUEUE_KEY = 'wa_event_queue';
+    const MAX_BUFFERED = 20;
+    function readQueue() {
+      try { return JSON.parse(localStorage.getItem(QUEUE_KEY)) || []; } catch (e) { return []; }
+    }
+    function writeQueue(queue) {
+      try { localStorage.setItem(QUEUE_KEY, JSON.stringify(queue)); } catch (e) {}
+    }
+    function flush() {
+      const queue = readQueue();
+      if (!queue.length) return;
+      // text/plain body keeps the beacon a simple CORS request
+      if (navigator.sendBeacon(INGEST_URL + "/track/batch/", JSON.stringify(queue))) {
+        writeQueue([]);
+      }
+    }
+
+    const queue = readQueue();
+    queue.push(eventData);
+    writeQueue(queue);
+    if (queue.length >= MAX_BUFFERED) flush();
+
+    document.addEventListener('visibilitychange', function() {
+      if (document.visibilityState === 'hidden') flush();
+    });
+    window.addEventListener('pagehide', flush);
+    return;
+  }
+
+  // Post to local backend ingest endpoint
+  fetch(INGEST_URL + "/track/", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(eventData),
+    credentials: 'include', // allow cookie roundtrip
+  }).catch(err => console.error("Tracking error:", err));
+})();
+    
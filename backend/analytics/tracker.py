@@ -0,0 +1,116 @@
+"""Delivery of the embeddable tracker (`GET /api/tracker/`).
+
+tracker.js is minified, stamped with TRACKER_INGEST_URL and compressed (gzip, plus
+brotli when the optional `brotli` package is installed) once per process, so a
+request only picks a prebuilt body. The version is a content hash: it is the ETag
+(conditional requests get a 304), and `/api/tracker/?v=<version>` URLs are cached
+by browsers and CDNs for a year since their content can never change.
+"""
+import gzip
+import hashlib
+import json
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+SOURCE = Path(__file__).with_name("tracker.js")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# whole-line comments, and trailing "// ..." comments after a statement; string literals
+# in tracker.js (URLs, the cookie regex) never contain "// " after a space
+_LINE_COMMENT = re.compile(r"^\s*//.*$")
+_TRAILING_COMMENT = re.compile(r"(?<=[;,{(])\s+//\s.*$")
+
+_bundle = None
+
+
+def minify(source):
+    """Conservative minifier: drops comments, indentation and blank lines but keeps
+    line breaks, so automatic semicolon insertion behaves exactly as in the source."""
+    lines = []
+    for line in source.splitlines():
+        if _LINE_COMMENT.match(line):
+            continue
+        line = _TRAILING_COMMENT.sub("", line).strip()
+        if line:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def build():
+    """{"version", "identity", "gzip"[, "br"]}: the minified tracker and its encodings."""
+    code = SOURCE.read_text().replace("__TRACKER_INGEST_URL__", json.dumps(settings.TRACKER_INGEST_URL.rstrip("/")))
+    body = minify(code).encode()
+    bundle = {
+        "version": hashlib.sha256(body).hexdigest()[:16],
+        "identity": body,
+        # mtime=0 keeps the bytes (and so the ETag) identical across workers and restarts
+        "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+    }
+    if brotli is not None:
+        bundle["br"] = brotli.compress(body, quality=11)
+    return bundle
+
+
+def load(rebuild=False):
+    global _bundle
+    if _bundle is None or rebuild:
+        _bundle = build()
+    return _bundle
+
+
+def version():
+    return load()["version"]
+
+
+def _accepted_encodings(header):
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def response(request):
+    bundle = load()
+    accepted = _accepted_encodings(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    encoding = next((e for e in ("br", "gzip") if e in bundle and e in accepted), "identity")
+    # each encoding is a different representation, so it gets its own ETag
+    etag = f'"{bundle["version"]}"' if encoding == "identity" else f'"{bundle["version"]}-{encoding}"'
+
+    versioned = request.GET.get("v") == bundle["version"]
+    max_age = IMMUTABLE_MAX_AGE if versioned else settings.TRACKER_MAX_AGE
+    cache_control = f"public, max-age={max_age}" + (", immutable" if versioned else "")
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or etag in (e.removeprefix("W/") for e in parse_etags(if_none_match))
+    ):
+        res = HttpResponseNotModified()
+    else:
+        res = HttpResponse(bundle[encoding], content_type="application/javascript; charset=utf-8")
+        if encoding != "identity":
+            res["Content-Encoding"] = encoding
+    res["ETag"] = etag
+    res["Cache-Control"] = cache_control
+    res["X-Tracker-Version"] = bundle["version"]
+    patch_vary_headers(res, ("Accept-Encoding",))
+    return res
@@ -1,80 +1,59 @@
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from django.db.models import Count, Avg, Min, Max, Q
 from django.db.models.functions import TruncDate
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from .models import Event, Site
-from .serializers import EventSerializer, SiteSerializer
+from .serializers import SiteSerializer
+from .ingest import avalidate_events, parse_batch_body, validate_events, store_events
+from .ingest_queue import QueueFull
+from . import rollups
+from . import sql
+from . import response_cache
+from . import export
+from . import columnar
+from . import metrics
+from . import async_ingest
+from . import tracker
+from . import live
+from .ingest_filters import client_ip
+from .authentication import CachedJWTAuthentication
+from .hll import relative_error
+from .caching import site_for_owner
+import base64
+from collections import namedtuple
+import hmac
+import json
+import logging
 import dateutil.parser
 from django.contrib.auth.models import User
 
-from django.http import HttpResponse
-from django.views.decorators.http import require_GET
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+logger = logging.getLogger(__name__)
 
 @require_GET
 def tracker_js(request):
-    js_code = """
-   (function() {
-  // Read site id from a global or from the current script tag data attribute
-  const scriptEl = document.currentScript;
-  const siteId = window.SITE_ID || (scriptEl && scriptEl.dataset && scriptEl.dataset.siteId) || window.__SITE_ID__;
-
-  // Simple cookie helpers
-  function getCookie(name) {
-    const match = document.cookie.match(new RegExp('(?:^|; )' + name.replace(/([.$?*|{}()\[\]\\\/\+^])/g, '\\$1') + '=([^;]*)'));
-    return match ? decodeURIComponent(match[1]) : null;
-  }
-  function setCookie(name, value, days) {
-    const d = new Date();
-    d.setTime(d.getTime() + (days*24*60*60*1000));
-    const expires = 'expires=' + d.toUTCString();
-    document.cookie = name + '=' + encodeURIComponent(value) + '; ' + expires + '; path=/; SameSite=Lax';
-  }
-
-  // Ensure we have a persistent session id
-  let sessionId = getCookie('wa_session_id');
-  if (!sessionId) {
-    sessionId = (typeof crypto !== 'undefined' && crypto.randomUUID) ? crypto.randomUUID() : String(Math.random()).slice(2) + Date.now();
-    setCookie('wa_session_id', sessionId, 1); // 1 day
-  }
-
-  const eventData = {
-    site_id: siteId,
-    url: window.location.href,
-    referrer: document.referrer,
-    user_agent: navigator.userAgent,
-    language: navigator.language,
-    screen_width: window.innerWidth,
-    screen_height: window.innerHeight,
-    session_id: sessionId,
-  };
-
-  // Post to local backend ingest endpoint
-  fetch("https://lakshitajain.pythonanywhere.com/track/", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(eventData),
-    credentials: 'include', // allow cookie roundtrip
-  }).catch(err => console.error("Tracking error:", err));
-})();
-    """
-    return HttpResponse(js_code, content_type="application/javascript")
+    return tracker.response(request)
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def register_user(request):
-    print(0)
     username = request.data.get("username")
     password = request.data.get("password")
     if User.objects.filter(username=username).exists():
-        print(13)
         return Response({"error": "Username already taken"}, status=400)
-    print(1)
     user = User.objects.create_user(username=username, password=password)
-    print(2)
+    logger.info("registered user %s", user.pk)
     return Response({"message": "User created successfully"})
 
 
@@ -83,32 +62,80 @@ def register_user(request):
 @permission_classes([AllowAny])
 def track_event(request):
     data = request.data.copy()
-    # DEBUG: log incoming payload and site existence
+    events, results = validate_events([data], ip=client_ip(request))
+    if results[0]["status"] == "filtered":
+        # dropped on purpose (bot, denylist, duplicate): nothing for the tracker to retry
+        return Response({"status": "filtered", "reason": results[0]["reason"]}, status=status.HTTP_202_ACCEPTED)
+    if not events:
+        return Response(results[0]["errors"], status=status.HTTP_400_BAD_REQUEST)
+    try:
+        queued = store_events(events)
+    except QueueFull:
+        return _queue_full_response()
+    if queued:
+        return Response({"status": "queued"}, status=status.HTTP_202_ACCEPTED)
+    return Response({"status": "ok"}, status=status.HTTP_201_CREATED)
+
+def _queue_full_response():
+    # write-behind spool is too deep; ask the tracker to back off
+    return Response(
+        {"error": "ingest queue is full, retry later"},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(settings.INGEST_QUEUE_RETRY_AFTER)},
+    )
+
+# async ingest for ASGI servers (uvicorn): same contract as /track/, but validation never
+# blocks the event loop and concurrent requests are stored together by async_ingest
+@csrf_exempt
+@require_POST
+async def track_event_async(request):
     try:
-        incoming_site_id = data.get("site_id")
-        site_exists = False
-        cleaned = None
-        if incoming_site_id is not None:
-            cleaned = str(incoming_site_id)
-            site_exists = Site.objects.filter(site_id=cleaned).exists()
-        print(
-            f"[track_event] site_id raw={repr(incoming_site_id)} len={len(incoming_site_id) if isinstance(incoming_site_id, str) else 'n/a'} exists={site_exists}"
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+    events, results = await avalidate_events([data], ip=client_ip(request))
+    if results[0]["status"] == "filtered":
+        return JsonResponse({"status": "filtered", "reason": results[0]["reason"]}, status=status.HTTP_202_ACCEPTED)
+    if not events:
+        return JsonResponse(results[0]["errors"], status=status.HTTP_400_BAD_REQUEST)
+    try:
+        queued = await async_ingest.submit(events)
+    except QueueFull:
+        return JsonResponse(
+            {"error": "ingest queue is full, retry later"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(settings.INGEST_QUEUE_RETRY_AFTER)},
         )
-    except Exception as e:
-        print(f"[track_event] debug error: {e}")
-    if "timestamp" in data:
-        try:
-            data["timestamp"] = dateutil.parser.isoparse(data["timestamp"])
-        except Exception:
-            data["timestamp"] = timezone.now()
-    else:
-        data["timestamp"] = timezone.now()
+    if queued:
+        return JsonResponse({"status": "queued"}, status=status.HTTP_202_ACCEPTED)
+    return JsonResponse({"status": "ok"}, status=status.HTTP_201_CREATED)
 
-    serializer = EventSerializer(data=data)
-    if serializer.is_valid():
-        serializer.save()
-        return Response({"status": "ok"}, status=status.HTTP_201_CREATED)
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+# batched ingest used by tracker.js in batch mode (AllowAny)
+# accepts a JSON array, {"events": [...]} or NDJSON; one bad row doesn't fail the batch
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def track_batch(request):
+    try:
+        payloads = parse_batch_body(request.body)
+    except ValueError as e:
+        return Response({"error": f"invalid batch body: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(payloads) > settings.TRACK_BATCH_MAX_EVENTS:
+        return Response(
+            {"error": f"batch too large (max {settings.TRACK_BATCH_MAX_EVENTS} events)"},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+
+    events, results = validate_events(payloads, ip=client_ip(request))
+    try:
+        queued = store_events(events)
+    except QueueFull:
+        return _queue_full_response()
+    filtered = sum(1 for r in results if r["status"] == "filtered")
+    accepted = len(events)
+    return Response(
+        {"accepted": accepted, "rejected": len(results) - accepted - filtered, "filtered": filtered, "queued": queued, "results": results},
+        status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK,
+    )
 
 # create site for a logged in user (returns site_id)
 @api_view(["POST"])
@@ -119,10 +146,15 @@ def create_site(request):
     domain = request.data.get("domain")
     if not domain:
         return Response({"error": "domain required"}, status=400)
+    tz = request.data.get("timezone") or "UTC"
+    try:
+        ZoneInfo(tz)
+    except (ValueError, ZoneInfoNotFoundError):
+        return Response({"error": f"unknown timezone: {tz}"}, status=400)
     import uuid
     site_id = str(uuid.uuid4())
-    site = Site.objects.create(owner=request.user, domain=domain, site_id=site_id)
-    return Response({"site_id": site.site_id, "domain": site.domain})
+    site = Site.objects.create(owner=request.user, domain=domain, site_id=site_id, timezone=tz)
+    return Response({"site_id": site.site_id, "domain": site.domain, "timezone": site.timezone})
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
@@ -131,238 +163,264 @@ def list_sites(request):
     return Response(SiteSerializer(sites, many=True).data)
 
 def ensure_site_belongs_to_user(user, site_id):
-    site = Site.objects.filter(site_id=site_id, owner=user).first()
-    return site
+    return site_for_owner(user, site_id)
 
-@api_view(["GET"])
-@permission_classes([IsAuthenticated])
-def page_views(request, site_id):
+# a list payload plus the cursor of its next page, sent as the X-Next-Cursor header
+Paged = namedtuple("Paged", "data next_cursor")
+
+def _cached_response(request, site_id, endpoint, compute, until=None):
+    """Ownership check, then compute(site, request) through the response cache."""
     site = ensure_site_belongs_to_user(request.user, site_id)
     if not site:
         return Response({"error": "not allowed"}, status=403)
+    data = response_cache.get_or_compute(site, endpoint, request.query_params, lambda: compute(site, request), until)
+    if isinstance(data, Paged):
+        return Response(data.data, headers={"X-Next-Cursor": data.next_cursor} if data.next_cursor else None)
+    return Response(data)
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def page_views(request, site_id):
+    return _cached_response(request, site_id, "pages", _page_views_data)
+
+def _page_views_data(site, request):
     last_n_days = request.query_params.get("days", 30)
     try:
         last_n_days = int(last_n_days)
     except:
         last_n_days = 30
     since = timezone.now() - timedelta(days=last_n_days)
-    trend_qs = (
-        Event.objects.filter(site=site, timestamp__gte=since)
-        .annotate(day=TruncDate("timestamp"))
-        .values("day")
-        .annotate(views=Count("id"))
-        .order_by("day")
-    )
-    trend = [{"date": r["day"], "views": r["views"]} for r in trend_qs]
-
-    # top pages
-    top_qs = (
-        Event.objects.filter(site=site, timestamp__gte=since)
-        .values("url")
-        .annotate(views=Count("id"))
-        .order_by("-views")[:10]
-    )
-    top = list(top_qs)
-    return Response({"trend": trend, "top_pages": top})
+    # closed days come from DailyRollup, only the partial edge days scan raw events
+    res = _pages_payload(_daily_views(site, since), _top(site, "url", since, None, _breakdown_paging(request, 10)))
+    _add_dense_trend(res, site, request, Event.objects.filter(site=site, timestamp__gte=since), "timestamp", since, None, "views")
+    return res
+
+def _trend_granularity(request):
+    """(bucket width in seconds, origin) for ?granularity=minute|hour|day|week[&interval=N],
+    or None for the default daily trend (read from rollups, server time zone, days with
+    no events left out)."""
+    granularity = request.query_params.get("granularity")
+    if not granularity:
+        return None
+    if granularity not in sql.GRANULARITIES:
+        raise ValidationError({"granularity": f"must be one of {', '.join(sql.GRANULARITIES)}"})
+    try:
+        interval = int(request.query_params.get("interval", 1))
+    except ValueError:
+        interval = 0
+    if interval < 1:
+        raise ValidationError({"interval": "must be a positive integer"})
+    return sql.GRANULARITIES[granularity] * interval, sql.WEEK_ORIGIN if granularity == "week" else 0
+
+def _add_dense_trend(res, site, request, qs, column, since, until, label):
+    """Replace res["trend"] with one point per bucket of the window, zeros included,
+    bucketed in the site's time zone, when the request asks for a granularity."""
+    buckets = _trend_granularity(request)
+    if buckets is None:
+        return
+    width, origin = buckets
+    until = until or timezone.now()
+    if (until - since).total_seconds() / width > settings.ANALYTICS_TREND_MAX_BUCKETS:
+        raise ValidationError({"granularity": f"more than {settings.ANALYTICS_TREND_MAX_BUCKETS} buckets; use a coarser granularity or a shorter window"})
+    tz = ZoneInfo(site.timezone)
+    res["trend"] = [
+        {"date": timezone.make_aware(datetime.fromtimestamp(b, dt_timezone.utc).replace(tzinfo=None), tz), label: n}
+        for b, n in sql.dense_buckets(qs, column, since, until, site.timezone, width, origin)
+    ]
+
+def _dimension_counts(site, dimension, since, until=None, covered=rollups.LOAD_COVERAGE):
+    # long windows read the columnar day files when they are enabled
+    if dimension in columnar.DIMENSIONS and columnar.use_for(since, until, site):
+        return columnar.dimension_counts(site, dimension, since, until)
+    return rollups.dimension_counts(site, dimension, since, until, covered)
+
+def _top(site, dimension, since, until, paging, covered=rollups.LOAD_COVERAGE):
+    """One ranked page of a dimension: ([(key, count)], other, has_more)."""
+    if dimension in columnar.DIMENSIONS and columnar.use_for(since, until, site):
+        return rollups.rank_counts(columnar.dimension_counts(site, dimension, since, until), **paging)
+    return rollups.ranked_counts(site, dimension, since, until, covered=covered, **paging)
+
+def _breakdown_paging(request, default_limit):
+    """?limit=N (capped by ANALYTICS_BREAKDOWN_MAX_LIMIT), ?offset=N or ?cursor=<next cursor>,
+    ?min_count=N for the ranked breakdowns."""
+    params = request.query_params
+    try:
+        limit = min(max(int(params.get("limit", default_limit)), 1), settings.ANALYTICS_BREAKDOWN_MAX_LIMIT)
+    except ValueError:
+        limit = default_limit
+    try:
+        offset = max(int(params.get("offset", 0)), 0)
+    except ValueError:
+        offset = 0
+    try:
+        min_count = max(int(params.get("min_count", 1)), 1)
+    except ValueError:
+        min_count = 1
+    after = None
+    cursor = params.get("cursor")
+    if cursor:
+        try:
+            count, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            after = (int(count), str(key))
+            offset = 0  # the cursor already marks the position
+        except Exception:
+            after = None
+    return {"limit": limit, "offset": offset, "after": after, "min_count": min_count}
+
+def _next_cursor(ranked):
+    rows, _, has_more = ranked
+    if not has_more:
+        return None
+    count_key = [rows[-1][1], rows[-1][0]]
+    return base64.urlsafe_b64encode(json.dumps(count_key).encode()).decode()
+
+def _daily_views(site, since, until=None, covered=rollups.LOAD_COVERAGE):
+    if columnar.use_for(since, until, site):
+        return columnar.daily_views(site, since, until)
+    return rollups.daily_views(site, since, until, covered)
+
+def _pages_payload(daily, ranked):
+    trend = [{"date": day, "views": views} for day, views in daily]
+    # top pages, ranked in the database; the views of every later page go to other_views
+    rows, other, _ = ranked
+    top = [{"url": url, "views": views} for url, views in rows]
+    return {"trend": trend, "top_pages": top, "other_views": other, "next_cursor": _next_cursor(ranked)}
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def sessions_metrics(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    return _cached_response(request, site_id, "sessions", _sessions_data)
 
+def _sessions_data(site, request):
     since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
+    qs = Event.objects.filter(site=site, timestamp__gte=since)
 
-    # Count unique sessions
-    sessions = (
-        Event.objects.filter(site=site, timestamp__gte=since)
-        .values("session_id")
-        .annotate(start=Min("timestamp"), end=Max("timestamp"), count=Count("id"))
-    )
+    res = _sessions_payload(qs)
+    _add_dense_trend(res, site, request, _session_starts(qs), "session_start", since, None, "sessions")
+    if str(request.query_params.get("include_sessions", "false")).lower() in ("1", "true", "yes"):
+        res["sessions"], res["next_cursor"] = _session_page(qs, request)
+    return res
+
+def _sessions_payload(qs):
+    # sessions grouped in the database, then per start day: count, total duration and trend in one query
+    per_day = sql.session_stats(qs)
+    session_count = sum(n for _, n, _ in per_day)
+    total_duration_seconds = sum(total for _, _, total in per_day)
+    avg_duration = total_duration_seconds / session_count if session_count else 0
+    trend = [{"date": day, "sessions": n} for day, n, _ in per_day]
 
-    session_list = []
-    total_duration_seconds = 0
-    for s in sessions:
-        duration = (s["end"] - s["start"]).total_seconds()
-        session_list.append(
-            {"session_id": s["session_id"], "start": s["start"], "end": s["end"], "duration": duration, "events": s["count"]}
-        )
-        total_duration_seconds += duration
+    return {"session_count": session_count, "avg_duration_seconds": avg_duration, "trend": trend}
 
-    session_count = len(session_list)
-    avg_duration = total_duration_seconds / session_count if session_count else 0
+def _session_starts(qs):
+    return qs.order_by().values("session_id").annotate(session_start=Min("timestamp"))
 
-    # Correct trend: unique sessions per day (by session start date)
-    session_starts = (
-        Event.objects.filter(site=site, timestamp__gte=since)
+def _session_page(qs, request):
+    """One keyset page of sessions, newest first; ?limit=N&cursor=<next_cursor>."""
+    try:
+        limit = min(max(int(request.query_params.get("limit", 50)), 1), 500)
+    except ValueError:
+        limit = 50
+    sessions = (
+        qs.order_by()
         .values("session_id")
-        .annotate(start=Min("timestamp"))
-        .annotate(day=TruncDate("start"))
-        .values("day", "session_id")
-        .distinct()
+        .annotate(start=Min("timestamp"), end=Max("timestamp"), count=Count("id"))
+        .order_by("-start", "-session_id")
     )
-    trend_dict = {}
-    for row in session_starts:
-        day = row["day"]
-        trend_dict[day] = trend_dict.get(day, 0) + 1
-    trend = [{"date": day, "sessions": count} for day, count in sorted(trend_dict.items())]
+    cursor = request.query_params.get("cursor")
+    if cursor:
+        try:
+            start, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            start = dateutil.parser.isoparse(start)
+        except Exception:
+            start = None
+        if start is not None:
+            sessions = sessions.filter(Q(start__lt=start) | Q(start=start, session_id__lt=session_id))
+    page = [
+        {"session_id": s["session_id"], "start": s["start"], "end": s["end"],
+         "duration": (s["end"] - s["start"]).total_seconds(), "events": s["count"]}
+        for s in sessions[:limit + 1]
+    ]
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_cursor = base64.urlsafe_b64encode(json.dumps([last["start"].isoformat(), last["session_id"]]).encode()).decode()
+    return page, next_cursor
 
-    return Response({"session_count": session_count, "avg_duration_seconds": avg_duration, "trend": trend})
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def new_vs_returning(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    return _cached_response(request, site_id, "new-vs-returning", _new_vs_returning_data)
 
+def _new_vs_returning_data(site, request):
     since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
-    # define 'new' users as those session_ids whose first ever event (for this site) occurred within the window
-    # and 'returning' as session_ids with previous event before window
-    session_first = (
-        Event.objects.filter(site=site)
-        .values("session_id")
-        .annotate(first_ts=Min("timestamp"))
-    )
-    new = 0
-    returning = 0
-    for s in session_first:
-        if s["first_ts"] >= since:
-            new += 1
-        else:
-            returning += 1
-
-    # daily trend for both new and returning sessions
-    from django.db.models.functions import TruncDate
-    from django.db.models import OuterRef, Subquery, Q
-
-    # Subquery to fetch first timestamp per session
-    first_ts_sub = (
-        Event.objects.filter(site=site, session_id=OuterRef("session_id"))
-        .values("session_id")
-        .annotate(first_ts=Min("timestamp"))
-        .values("first_ts")[:1]
-    )
+    # 'new' sessions were first seen inside the window, 'returning' ones are active in the window
+    # but were first seen before it; first visits come from VisitorFirstSeen, not a history scan
+    return _new_vs_returning_payload(Event.objects.filter(site=site, timestamp__gte=since), site, since)
 
-    daily = (
-        Event.objects.filter(site=site, timestamp__gte=since)
-        .annotate(day=TruncDate("timestamp"))
-        .annotate(first_ts=Subquery(first_ts_sub))
-        .values("day")
-        .annotate(
-            new_sessions=Count("session_id", filter=Q(first_ts__gte=since), distinct=True),
-            returning_sessions=Count("session_id", filter=Q(first_ts__lt=since), distinct=True),
-        )
-        .order_by("day")
-    )
+def _new_vs_returning_payload(qs, site, since):
+    (new, returning), daily = sql.new_vs_returning(qs, site.pk, since)
     daily_trend = [
-        {
-            "date": r["day"],
-            "new_sessions": r["new_sessions"],
-            "returning_sessions": r["returning_sessions"],
-        }
-        for r in daily
+        {"date": day, "new_sessions": n, "returning_sessions": r}
+        for day, n, r in daily
     ]
 
-    return Response({"new": new, "returning": returning, "daily": daily_trend})
+    return {"new": new, "returning": returning, "daily": daily_trend}
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def sources(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    return _cached_response(request, site_id, "sources", _sources_data)
+
+def _sources_data(site, request):
     since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
 
     # use utm_source if present else derive from referrer host
-    from urllib.parse import urlparse
-    qs = Event.objects.filter(site=site, timestamp__gte=since)
-    sources = {}
-    for ev in qs.values("utm_source", "referrer"):
-        if ev["utm_source"]:
-            key = ev["utm_source"].lower()
-        elif ev["referrer"]:
-            try:
-                parsed = urlparse(ev["referrer"])
-                key = parsed.netloc or "direct"
-            except:
-                key = "referral"
-        else:
-            key = "direct"
-        sources[key] = sources.get(key, 0) + 1
-    output = [{"source": k, "count": v} for k, v in sorted(sources.items(), key=lambda x: -x[1])]
-    return Response(output)
+    return _ranked_page(_top(site, "source", since, None, _breakdown_paging(request, settings.ANALYTICS_BREAKDOWN_LIMIT)), "source")
+
+def _ranked(ranked, label):
+    rows, other, _ = ranked
+    res = [{label: k, "count": v} for k, v in rows]
+    if other:
+        res.append({label: "Other", "count": other, "other": True})
+    return res
+
+def _ranked_page(ranked, label):
+    return Paged(_ranked(ranked, label), _next_cursor(ranked))
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def devices(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    return _cached_response(request, site_id, "devices", _devices_data)
+
+def _devices_data(site, request):
     since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
+    return _devices_payload(rollups.dimension_counts(site, "device", since))
 
-    # naive device classification by user_agent string
-    qs = Event.objects.filter(site=site, timestamp__gte=since)
+def _devices_payload(device_counts):
     counts = {"mobile": 0, "desktop": 0, "tablet": 0, "bot": 0, "unknown": 0}
-    for row in qs.values_list("user_agent", flat=True):
-        ua = (row or "").lower()
-        if "mobile" in ua and "tablet" not in ua:
-            counts["mobile"] += 1
-        elif "tablet" in ua or "ipad" in ua:
-            counts["tablet"] += 1
-        elif "bot" in ua or "spider" in ua or "crawl" in ua:
-            counts["bot"] += 1
-        elif ua:
-            counts["desktop"] += 1
-        else:
-            counts["unknown"] += 1
-    out = [{"device": k, "count": v} for k, v in counts.items()]
-    return Response(out)
+    for device, c in device_counts.items():
+        counts[device] = counts.get(device, 0) + c
+    return [{"device": k, "count": v} for k, v in counts.items()]
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def browsers(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
-    since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
+    return _cached_response(request, site_id, "browsers", _browsers_data)
 
-    # naive browser family extraction
-    qs = Event.objects.filter(site=site, timestamp__gte=since)
-    counts = {}
-    for ua in qs.values_list("user_agent", flat=True):
-        ua_low = (ua or "").lower()
-        fam = "other"
-        if "chrome" in ua_low and "edg" not in ua_low and "chromium" not in ua_low:
-            fam = "Chrome"
-        elif "firefox" in ua_low:
-            fam = "Firefox"
-        elif "safari" in ua_low and "chrome" not in ua_low:
-            fam = "Safari"
-        elif "edg" in ua_low or "edge" in ua_low:
-            fam = "Edge"
-        elif "opr" in ua_low or "opera" in ua_low:
-            fam = "Opera"
-        counts[fam] = counts.get(fam, 0) + 1
-    out = [{"browser": k, "count": v} for k, v in sorted(counts.items(), key=lambda x: -x[1])]
-    return Response(out)
+def _browsers_data(site, request):
+    since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
+    return _ranked_page(_top(site, "browser", since, None, _breakdown_paging(request, settings.ANALYTICS_BREAKDOWN_LIMIT)), "browser")
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def geography(request, site_id):
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    return _cached_response(request, site_id, "geography", _geography_data)
+
+def _geography_data(site, request):
     since = timezone.now() - timedelta(days=int(request.query_params.get("days", 30)))
-    qs = Event.objects.filter(site=site, timestamp__gte=since)
-    counts = {}
-    for c in qs.values_list("country", flat=True):
-        key = (c or "Unknown")
-        counts[key] = counts.get(key, 0) + 1
-    out = [{"country": k, "count": v} for k, v in sorted(counts.items(), key=lambda x: -x[1])]
-    return Response(out)
+    return _ranked_page(_top(site, "country", since, None, _breakdown_paging(request, settings.ANALYTICS_BREAKDOWN_LIMIT)), "country")
 
 from django.db.models import Q
 
@@ -374,11 +432,15 @@ def _parse_date_range(request):
       - days=N (fallback, default 30)
     Returns (since, until) where until is now if not specified.
     """
+    return parse_date_range(request.query_params)
+
+def parse_date_range(params):
+    """_parse_date_range for a plain mapping of query parameters (used by management commands)."""
     now = timezone.now()
-    start = request.query_params.get("start")
-    end = request.query_params.get("end")
-    preset = request.query_params.get("preset")
-    days = request.query_params.get("days")
+    start = params.get("start")
+    end = params.get("end")
+    preset = params.get("preset")
+    days = params.get("days")
 
     if start and end:
         try:
@@ -413,33 +475,33 @@ def _parse_date_range(request):
 
 def _apply_segment_filters(qs, request):
     """Apply optional filters to an Event queryset.
-    - services: comma-separated utm_source values (case-insensitive)
+    - services: comma-separated traffic sources (utm_source or referrer host, case-insensitive)
     - posts: url path prefix (single value or comma-separated), matches startswith
     """
-    services = request.query_params.get("services")
-    posts = request.query_params.get("posts")
-
-    if services:
-        parts = [p.strip().lower() for p in services.split(",") if p.strip()]
-        if parts:
-            cond = Q()
-            for p in parts:
-                cond |= Q(utm_source__iexact=p)
-            qs = qs.filter(cond)
-
-    if posts:
-        prefixes = [p.strip() for p in posts.split(",") if p.strip()]
+    parts, prefixes = _segment_params(request)
+    if parts:
+        # Event.source is stored lowercased, so this is an indexed IN lookup
+        qs = qs.filter(source__in=parts)
+
+    if prefixes:
         cond = Q()
         for pref in prefixes:
             cond |= Q(url__startswith=pref)
-        if prefixes:
-            qs = qs.filter(cond)
+        qs = qs.filter(cond)
     return qs
 
+def _segment_params(request):
+    """(lowercased services, posts prefixes) from the query string."""
+    services = request.query_params.get("services") or ""
+    posts = request.query_params.get("posts") or ""
+    return [p.strip().lower() for p in services.split(",") if p.strip()], [p.strip() for p in posts.split(",") if p.strip()]
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def kpis(request, site_id):
     """Aggregate KPIs for the dashboard, with optional comparison window.
+    ?distinct=approx estimates sessions/users from the daily HyperLogLog sketches instead of
+    an exact distinct count (ignored when segment filters are set; see hll.py for the error).
     Returns:
     {
       period: { start, end },
@@ -447,30 +509,53 @@ def kpis(request, site_id):
       totals: {
         page_views, sessions, users, top_country
       },
-      deltas: { page_views_pct, sessions_pct, users_pct } | null
+      deltas: { page_views_pct, sessions_pct, users_pct } | null,
+      distinct: { mode: "exact" | "approx", relative_error }
     }
     """
-    site = ensure_site_belongs_to_user(request.user, site_id)
-    if not site:
-        return Response({"error": "not allowed"}, status=403)
+    # windows ending before today are cached until an event for a closed day arrives
+    _, until = _parse_date_range(request)
+    return _cached_response(request, site_id, "kpis", _kpis_data, until)
 
+def _kpis_data(site, request, country_counts=None, covered=rollups.LOAD_COVERAGE):
+    """`country_counts` ({country: events} of the same window and filters) saves the top
+    country query when the caller has them already; `covered` is the rollup coverage."""
     since, until = _parse_date_range(request)
     compare_flag = str(request.query_params.get("compare", "false")).lower() in ("1", "true", "yes")
 
     base_qs = Event.objects.filter(site=site, timestamp__gte=since, timestamp__lte=until)
     base_qs = _apply_segment_filters(base_qs, request)
 
-    # Compute sessions: distinct session_id
-    sessions = base_qs.values("session_id").distinct().count()
+    # sketches only cover whole sites, so segment filters always need the exact count
+    approx = (
+        request.query_params.get("distinct", "exact").lower() == "approx"
+        and not request.query_params.get("services")
+        and not request.query_params.get("posts")
+    )
+
+    def totals(qs, start, end):
+        """(page views, distinct sessions) of a window; exact ones from a single query."""
+        if approx:
+            return qs.count(), rollups.approx_distinct_sessions(site, start, end, covered)
+        row = qs.aggregate(page_views=Count("id"), sessions=Count("session_id", distinct=True))
+        return row["page_views"], row["sessions"]
+
+    # long exact windows are counted over the columnar day files when they are enabled
+    use_columnar = not approx and columnar.use_for(since, until, site)
+    if use_columnar:
+        page_views_cnt, sessions, top_country_name = columnar.kpi_totals(site, since, until, *_segment_params(request))
+    else:
+        page_views_cnt, sessions = totals(base_qs, since, until)
+        # Top country
+        if country_counts is not None:
+            top_country_name = min(country_counts, key=lambda c: (-country_counts[c], c)) if country_counts else None
+        else:
+            top_country = (
+                base_qs.values("country").annotate(c=Count("id")).order_by("-c", "country").first()
+            )
+            top_country_name = top_country.get("country") if top_country else None
     # Users: same as sessions for now (can switch to visitor_id later)
     users = sessions
-    # Page views: count of events
-    page_views_cnt = base_qs.count()
-    # Top country
-    top_country = (
-        base_qs.values("country").annotate(c=Count("id")).order_by("-c").first()
-    )
-    top_country_name = top_country.get("country") if top_country else None
 
     res = {
         "period": {"start": since, "end": until},
@@ -482,6 +567,10 @@ def kpis(request, site_id):
             "top_country": top_country_name or "Unknown",
         },
         "deltas": None,
+        "distinct": {
+            "mode": "approx" if approx else "exact",
+            "relative_error": relative_error(settings.HLL_PRECISION) if approx else 0.0,
+        },
     }
 
     if compare_flag:
@@ -492,9 +581,11 @@ def kpis(request, site_id):
         prev_qs = Event.objects.filter(site=site, timestamp__gte=prev_start, timestamp__lte=prev_end)
         prev_qs = _apply_segment_filters(prev_qs, request)
 
-        prev_sessions = prev_qs.values("session_id").distinct().count()
+        if use_columnar:
+            prev_page_views, prev_sessions, _ = columnar.kpi_totals(site, prev_start, prev_end, *_segment_params(request))
+        else:
+            prev_page_views, prev_sessions = totals(prev_qs, prev_start, prev_end)
         prev_users = prev_sessions
-        prev_page_views = prev_qs.count()
 
         def pct(cur, prev):
             if prev == 0:
@@ -508,4 +599,157 @@ def kpis(request, site_id):
             "users_pct": pct(users, prev_users),
         }
 
-    return Response(res)
+    return res
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """Hit/miss counters of the analytics response cache in this worker."""
+    return Response(response_cache.stats())
+
+
+DASHBOARD_WIDGETS = ("kpis", "pages", "sessions", "new-vs-returning", "sources", "devices", "browsers", "geography")
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def dashboard(request, site_id):
+    """Every dashboard widget for one window and one set of segment filters.
+    Takes the kpis parameters (start/end, preset or days; services, posts, compare, distinct)
+    plus ?widgets=kpis,pages,... to pick a subset (default: all of DASHBOARD_WIDGETS).
+    Returns { period: { start, end }, widgets: { <name>: <same payload as its endpoint> } }.
+    """
+    widgets = request.query_params.get("widgets")
+    widgets = [w.strip() for w in widgets.split(",") if w.strip()] if widgets else list(DASHBOARD_WIDGETS)
+    unknown = sorted(set(widgets) - set(DASHBOARD_WIDGETS))
+    if unknown:
+        return Response({"error": f"unknown widgets: {', '.join(unknown)}"}, status=400)
+    _, until = _parse_date_range(request)
+    return _cached_response(request, site_id, "dashboard", lambda site, request: _dashboard_data(site, request, widgets), until)
+
+def _dashboard_data(site, request, widgets):
+    since, until = _parse_date_range(request)
+    qs = _apply_segment_filters(Event.objects.filter(site=site, timestamp__gte=since, timestamp__lte=until), request)
+
+    filtered = bool(request.query_params.get("services") or request.query_params.get("posts"))
+    # read once for every widget instead of once per rollup helper (filtered windows don't use rollups)
+    covered = rollups.LOAD_COVERAGE if filtered else rollups.rollup_coverage()
+    use_columnar = not filtered and columnar.use_for(since, until, site)
+    breakdown = None
+
+    def counts(dimension):
+        nonlocal breakdown
+        if use_columnar:
+            return _dimension_counts(site, dimension, since, until, covered)
+        # one grouped pass feeds every breakdown, the trend and the top country: over the
+        # filtered window (rollups have no segments), or over the raw edge days plus rollups
+        if breakdown is None:
+            breakdown = rollups.window_breakdown(qs) if filtered else rollups.merged_breakdown(site, since, until, covered)
+        return breakdown[0][dimension]
+
+    def daily():
+        if use_columnar:
+            return _daily_views(site, since, until, covered)
+        counts("url")
+        return breakdown[1]
+
+    def top(dimension, default_limit):
+        paging = _breakdown_paging(request, default_limit)
+        if use_columnar:
+            return _top(site, dimension, since, until, paging, covered)
+        return rollups.rank_counts(counts(dimension), **paging)
+
+    def kpis():
+        # reuse the breakdown's country counts when another widget needs the breakdown anyway
+        shared = not use_columnar and {"pages", "sources", "devices", "browsers", "geography"} & set(widgets)
+        return _kpis_data(site, request, counts("country") if shared else None, covered)
+
+    def _with_dense_trend(res, trend_qs, column, label):
+        _add_dense_trend(res, site, request, trend_qs, column, since, until, label)
+        return res
+
+    limit = settings.ANALYTICS_BREAKDOWN_LIMIT
+    builders = {
+        "kpis": kpis,
+        "pages": lambda: _with_dense_trend(_pages_payload(daily(), top("url", 10)), qs, "timestamp", "views"),
+        "sessions": lambda: _with_dense_trend(_sessions_payload(qs), _session_starts(qs), "session_start", "sessions"),
+        "new-vs-returning": lambda: _new_vs_returning_payload(qs, site, since),
+        "sources": lambda: _ranked(top("source", limit), "source"),
+        "devices": lambda: _devices_payload(counts("device")),
+        "browsers": lambda: _ranked(top("browser", limit), "browser"),
+        "geography": lambda: _ranked(top("country", limit), "country"),
+    }
+    return {
+        "period": {"start": since, "end": until},
+        "widgets": {name: builders[name]() for name in widgets},
+    }
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_events(request, site_id):
+    """Stream the site's raw events for a _parse_date_range window, oldest first.
+    ?output=csv (default) | ndjson | parquet, &compression=zstd|snappy|gzip|none for parquet.
+    (`format` is taken by DRF's content negotiation, hence `output`.)
+    """
+    site = ensure_site_belongs_to_user(request.user, site_id)
+    if not site:
+        return Response({"error": "not allowed"}, status=403)
+
+    output = request.query_params.get("output", "csv").lower()
+    since, until = _parse_date_range(request)
+    try:
+        chunks = export.export_chunks(
+            output, export.event_pages(site, since, until), request.query_params.get("compression", "zstd").lower()
+        )
+    except export.ExportError as e:
+        return Response({"error": str(e)}, status=400)
+    content_type, extension = export.FORMATS[output]
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{site.site_id}-events.{extension}"'
+    return response
+
+
+@require_GET
+def live_visitors(request, site_id):
+    """Server-Sent Events stream of the site's live window (see live.py): a long-lived
+    stream under ASGI, a single snapshot per request under WSGI.
+    EventSource can't send headers, so the access token may come as ?token=<access JWT>
+    as well as in `Authorization: Bearer`. Auth and ownership go through the same caches
+    as the dashboard, so a reconnecting viewer costs no queries once they are warm.
+    """
+    raw = request.GET.get("token")
+    if not raw:
+        scheme, _, raw = request.headers.get("Authorization", "").partition(" ")
+        raw = raw if scheme == "Bearer" else ""
+    auth = CachedJWTAuthentication()
+    try:
+        user = auth.get_user(auth.get_validated_token(raw.encode())) if raw else None
+    except AuthenticationFailed:  # includes simplejwt's InvalidToken
+        user = None
+    if user is None:
+        return JsonResponse({"error": "authentication required"}, status=401)
+    site = ensure_site_belongs_to_user(user, site_id)
+    if not site:
+        return JsonResponse({"error": "not allowed"}, status=403)
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(live.astream(site.pk), content_type="text/event-stream")
+    else:
+        # a sleeping stream would pin a sync worker; answer one snapshot and let EventSource poll
+        response = HttpResponse(live.poll(site.pk), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # nginx would otherwise buffer the stream
+    return response
+
+
+@require_GET
+def metrics_endpoint(request):
+    """Prometheus text exposition of this worker's request metrics.
+    Needs `Authorization: Bearer <METRICS_TOKEN>`; answers 404 while no token is configured.
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web_analytics_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from analytics import async_ingest  # noqa: E402  (needs the app registry loaded above)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        # lets uvicorn store the async ingest batch still waiting when it shuts down
+        return await async_ingest.lifespan(receive, send)
+    return await django_application(scope, receive, send)
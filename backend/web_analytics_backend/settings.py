@@ -48,7 +48,7 @@ INSTALLED_APPS = [
 ]
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "analytics.authentication.CachedJWTAuthentication",
     )
 }
 SIMPLE_JWT = {
@@ -56,6 +56,7 @@ SIMPLE_JWT = {
     "REFRESH_TOKEN_LIFETIME": timedelta(days=30),
 }
 MIDDLEWARE = [
+    'analytics.metrics.QueryMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -166,3 +167,141 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Batched ingest (/track/batch/)
+TRACK_BATCH_MAX_EVENTS = int(os.getenv("TRACK_BATCH_MAX_EVENTS", "500"))
+TRACK_BATCH_CHUNK_SIZE = int(os.getenv("TRACK_BATCH_CHUNK_SIZE", "200"))
+
+# Write-behind ingest: "sync" writes each event to the database in the request,
+# "queue" appends it to a local spool drained by `manage.py drain_ingest_queue`
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", str(BASE_DIR / "ingest_queue.sqlite3"))
+INGEST_QUEUE_MAX_DEPTH = int(os.getenv("INGEST_QUEUE_MAX_DEPTH", "100000"))
+INGEST_QUEUE_RETRY_AFTER = int(os.getenv("INGEST_QUEUE_RETRY_AFTER", "5"))
+INGEST_QUEUE_FLUSH_SIZE = int(os.getenv("INGEST_QUEUE_FLUSH_SIZE", "500"))
+INGEST_QUEUE_FLUSH_INTERVAL = float(os.getenv("INGEST_QUEUE_FLUSH_INTERVAL", "2"))
+
+# In-process site_id -> Site pk cache used by ingest
+SITE_CACHE_TTL = int(os.getenv("SITE_CACHE_TTL", "300"))
+SITE_CACHE_NEGATIVE_TTL = int(os.getenv("SITE_CACHE_NEGATIVE_TTL", "60"))
+SITE_CACHE_MAX_ENTRIES = int(os.getenv("SITE_CACHE_MAX_ENTRIES", "10000"))
+
+# Dashboard auth: verified JWTs, their users and site ownership kept in process for this long
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+# Daily rollups (`manage.py rollup_events`): ids below the watermark re-scanned on each
+# run to pick up inserts that committed out of id order
+ROLLUP_WATERMARK_OVERLAP = int(os.getenv("ROLLUP_WATERMARK_OVERLAP", "1000"))
+ROLLUP_FIRST_SEEN_CHUNK = int(os.getenv("ROLLUP_FIRST_SEEN_CHUNK", "100000"))
+
+# Days of raw events `manage.py purge_events` keeps for sites without their own
+# retention_days (0 keeps everything)
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", "0"))
+
+# Distinct user agents memoized by the ingest-time classifier
+UA_CLASSIFIER_CACHE_SIZE = int(os.getenv("UA_CLASSIFIER_CACHE_SIZE", "4096"))
+
+# Monthly Event partitions on Postgres (`manage.py manage_event_partitions`)
+EVENT_PARTITION_MONTHS_AHEAD = int(os.getenv("EVENT_PARTITION_MONTHS_AHEAD", "3"))
+EVENT_PARTITION_RETAIN_MONTHS = int(os.getenv("EVENT_PARTITION_RETAIN_MONTHS", "0"))  # 0 keeps everything
+
+# (site, session_id) pairs an ingest worker remembers as already recorded in VisitorFirstSeen
+FIRST_SEEN_CACHE_SIZE = int(os.getenv("FIRST_SEEN_CACHE_SIZE", "100000"))
+FIRST_SEEN_CACHE_TTL = int(os.getenv("FIRST_SEEN_CACHE_TTL", "3600"))
+
+# HyperLogLog precision of the daily session sketches: 2**p registers, ~1.04/sqrt(2**p)
+# relative error (14 -> 0.81%). Run `rollup_events --rebuild` after changing it.
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "14"))
+
+# Response cache of the analytics endpoints. "locmem" is per process (LRU); "file" is shared
+# by every worker on the host (LRU by last read), so ingest and drain workers can invalidate
+# the dashboard's entries. Live windows are kept for LIVE_TTL seconds; closed ones until evicted
+# with "file", and for CLOSED_TTL seconds with "locmem", which can't see other processes' bumps.
+ANALYTICS_CACHE_ENABLED = os.getenv("ANALYTICS_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANALYTICS_CACHE_BACKEND = os.getenv("ANALYTICS_CACHE_BACKEND", "locmem")
+ANALYTICS_CACHE_LOCATION = os.getenv("ANALYTICS_CACHE_LOCATION", str(BASE_DIR / "analytics_cache"))
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", "5000"))
+ANALYTICS_CACHE_LIVE_TTL = int(os.getenv("ANALYTICS_CACHE_LIVE_TTL", "60"))
+ANALYTICS_CACHE_CLOSED_TTL = int(os.getenv("ANALYTICS_CACHE_CLOSED_TTL", "600"))
+ANALYTICS_CACHE_ALIAS = "analytics"
+
+# Ranked breakdowns (sources, browsers, geography; pages default to 10): keys per page by
+# default and at most; the rest of the window is folded into an "Other" entry
+ANALYTICS_BREAKDOWN_LIMIT = int(os.getenv("ANALYTICS_BREAKDOWN_LIMIT", "50"))
+ANALYTICS_BREAKDOWN_MAX_LIMIT = int(os.getenv("ANALYTICS_BREAKDOWN_MAX_LIMIT", "1000"))
+# most points a ?granularity= trend may have (1440 = a day of minutes)
+ANALYTICS_TREND_MAX_BUCKETS = int(os.getenv("ANALYTICS_TREND_MAX_BUCKETS", "2000"))
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    ANALYTICS_CACHE_ALIAS: {
+        "BACKEND": (
+            "analytics.cache_backends.LRUFileBasedCache"
+            if ANALYTICS_CACHE_BACKEND == "file"
+            else "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": ANALYTICS_CACHE_LOCATION if ANALYTICS_CACHE_BACKEND == "file" else "analytics",
+        "OPTIONS": {"MAX_ENTRIES": ANALYTICS_CACHE_MAX_ENTRIES, "CULL_FREQUENCY": 10},
+    },
+}
+
+# Rows per keyset page of the raw event export (/api/analytics/export/, `manage.py export_events`)
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+# Optional columnar copy of closed days (`manage.py compact_events`, needs numpy), used by
+# pages, sources, geography and kpis for windows of at least COLUMNAR_MIN_DAYS days
+COLUMNAR_ENABLED = os.getenv("COLUMNAR_ENABLED", "false").lower() in ("1", "true", "yes")
+COLUMNAR_PATH = os.getenv("COLUMNAR_PATH", str(BASE_DIR / "columnar"))
+COLUMNAR_MIN_DAYS = int(os.getenv("COLUMNAR_MIN_DAYS", "14"))
+
+# Request/SQL metrics (analytics.metrics), scraped from /metrics with `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# log the full query list of requests slower than this (0 disables), for this fraction of them
+METRICS_QUERY_LOG_THRESHOLD_MS = float(os.getenv("METRICS_QUERY_LOG_THRESHOLD_MS", "0"))
+METRICS_QUERY_LOG_SAMPLE_RATE = float(os.getenv("METRICS_QUERY_LOG_SAMPLE_RATE", "1.0"))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {"analytics": {"handlers": ["console"], "level": os.getenv("ANALYTICS_LOG_LEVEL", "INFO")}},
+}
+
+# /track/async/ (ASGI): events of concurrent requests are stored together once this many
+# arrived or after this many milliseconds
+TRACK_ASYNC_BATCH_SIZE = int(os.getenv("TRACK_ASYNC_BATCH_SIZE", "200"))
+TRACK_ASYNC_FLUSH_MS = float(os.getenv("TRACK_ASYNC_FLUSH_MS", "10"))
+
+# Tracker script (`GET /api/tracker/`): where it sends events, and how long browsers may
+# cache the unversioned URL (`?v=<version>` URLs are cached for a year)
+TRACKER_INGEST_URL = os.getenv("TRACKER_INGEST_URL", "https://lakshitajain.pythonanywhere.com")
+TRACKER_MAX_AGE = int(os.getenv("TRACKER_MAX_AGE", "300"))
+
+# Live visitors SSE stream (`/api/analytics/live/<site_id>/`): the sliding window, how often
+# snapshots are rebuilt and pushed, and how long one stream lasts before the client reconnects
+LIVE_WINDOW_SECONDS = int(os.getenv("LIVE_WINDOW_SECONDS", "300"))
+LIVE_SNAPSHOT_SECONDS = float(os.getenv("LIVE_SNAPSHOT_SECONDS", "1"))
+LIVE_INTERVAL_SECONDS = float(os.getenv("LIVE_INTERVAL_SECONDS", "2"))
+LIVE_STREAM_SECONDS = int(os.getenv("LIVE_STREAM_SECONDS", "300"))
+LIVE_RETRY_MS = int(os.getenv("LIVE_RETRY_MS", "3000"))
+LIVE_TOP_PAGES = int(os.getenv("LIVE_TOP_PAGES", "10"))
+LIVE_MAX_HITS_PER_SITE = int(os.getenv("LIVE_MAX_HITS_PER_SITE", "100000"))
+
+# Ingest filters (see analytics/ingest_filters.py): dropped events are counted in
+# analytics_ingest_filtered_total, never stored. TRACK_DENY_IPS takes IPs or CIDRs and
+# TRACK_DENY_USER_AGENTS case-insensitive substrings, both comma separated. Payloads with
+# the same site, session_id, url and client timestamp bucket of TRACK_DEDUPE_SECONDS are
+# stored once (0 disables); TRACK_TRUST_X_FORWARDED_FOR only behind a proxy that sets it
+TRACK_FILTER_BOTS = os.getenv("TRACK_FILTER_BOTS", "true").lower() in ("1", "true", "yes")
+TRACK_BOT_PATTERN = os.getenv(
+    "TRACK_BOT_PATTERN",
+    r"bot\b|bot/|crawl|spider|slurp|archiver|headless|lighthouse|phantomjs|selenium|puppeteer|playwright"
+    r"|facebookexternalhit|embedly|pingdom|uptimerobot|statuscake|monitor"
+    r"|curl/|wget/|python-requests|python-urllib|aiohttp|httpx|go-http-client|java/|okhttp|libwww|scrapy",
+)
+TRACK_DENY_IPS = os.getenv("TRACK_DENY_IPS", "")
+TRACK_DENY_USER_AGENTS = os.getenv("TRACK_DENY_USER_AGENTS", "")
+TRACK_DEDUPE_SECONDS = int(os.getenv("TRACK_DEDUPE_SECONDS", "10"))
+TRACK_DEDUPE_MAX_ENTRIES = int(os.getenv("TRACK_DEDUPE_MAX_ENTRIES", "100000"))
+TRACK_TRUST_X_FORWARDED_FOR = os.getenv("TRACK_TRUST_X_FORWARDED_FOR", "false").lower() in ("1", "true", "yes")
@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from analytics.views import register_user, create_site, track_event, page_views, sessions_metrics, new_vs_returning, sources, devices, browsers, geography, list_sites, tracker_js, kpis
+from analytics.views import register_user, create_site, track_event, track_event_async, track_batch, page_views, sessions_metrics, new_vs_returning, sources, devices, browsers, geography, list_sites, tracker_js, kpis, cache_stats, dashboard, export_events, metrics_endpoint, live_visitors
 from django.urls import re_path
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
@@ -40,6 +40,8 @@ urlpatterns = [
     path("api/tracker/", tracker_js, name="tracker-js"),
     path("api/create_site/", create_site, name="create-site"),
     path("track/", track_event, name="track-event"),
+    path("track/batch/", track_batch, name="track-batch"),
+    path("track/async/", track_event_async, name="track-event-async"),
     path("api/analytics/pages/<str:site_id>/", page_views, name="page-views"),
     path("api/analytics/sessions/<str:site_id>/", sessions_metrics, name="sessions"),
     path("api/analytics/new-vs-returning/<str:site_id>/", new_vs_returning, name="new-returning"),
@@ -48,6 +50,11 @@ urlpatterns = [
     path("api/analytics/browsers/<str:site_id>/", browsers, name="browsers"),
     path("api/analytics/geography/<str:site_id>/", geography, name="geography"),
     path("api/analytics/kpis/<str:site_id>/", kpis, name="kpis"),
+    path("api/analytics/dashboard/<str:site_id>/", dashboard, name="dashboard"),
+    path("api/analytics/export/<str:site_id>/", export_events, name="export-events"),
+    path("api/analytics/live/<str:site_id>/", live_visitors, name="live-visitors"),
+    path("api/analytics/cache-stats/", cache_stats, name="cache-stats"),
+    path("metrics", metrics_endpoint, name="metrics"),
     re_path(r"^swagger(?P<format>\.json|\.yaml)$", schema_view.without_ui(cache_timeout=0), name="schema-json"),
     path("swagger/", schema_view.with_ui("swagger", cache_timeout=0), name="schema-swagger-ui"),
     path("redoc/", schema_view.with_ui("redoc", cache_timeout=0), name="schema-redoc"),